@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Timing benchmark of the free energy estimators in pmx.estimators.
+
+Jarz, JarzGauss, Crooks and BAR are timed on forward/reverse work
+distributions of increasing size, without error estimates, with bootstrap
+and with blocks. Three kinds of work distributions are used:
+
+    protlig   Gaussian work distributions obeying the Crooks theorem, with
+              the dG values and uncertainties of the edges in
+              protLig_benchmark/dg_data_allRepeats
+    gaussian  Gaussian work distributions of fixed dG and width
+    skewed    Gamma distributed dissipated work, with a long tail
+
+The results are written as JSON, and a previous result file can be passed
+with --compare to flag the cases that became slower::
+
+    $ python benchmarks/bench_estimators.py -o before.json
+    $ python benchmarks/bench_estimators.py -o after.json --compare before.json
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import numpy as np
+import scipy
+from pmx import __version__ as pmx_version
+from pmx.estimators import Jarz, JarzGauss, Crooks, BAR
+
+kb = 0.00831447215   # kJ/(K*mol)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'protLig_benchmark', 'dg_data_allRepeats')
+
+DATASETS = ['protlig', 'gaussian', 'skewed']
+ESTIMATORS = ['jarz', 'jarz_gauss', 'cgi', 'bar']
+SIZES = [50, 100, 200, 500, 1000, 2000, 5000]
+
+# number of transitions behind the uncertainties in dg_data_allRepeats,
+# used to turn a standard error into the width of the work distribution
+NREF = 100
+
+
+def read_dg_data(path=DATA_DIR):
+    '''Reads the per-repeat dG values of all edges in dg_data_allRepeats.
+
+    Returns
+    -------
+    edges : list of tuples
+        (name, dg, err) for every edge and repeat, in kJ/mol.
+    '''
+    edges = []
+    for fn in sorted(os.listdir(path)):
+        if not fn.endswith('.dat'):
+            continue
+        system = os.path.splitext(fn)[0]
+        for line in open(os.path.join(path, fn)):
+            if line.startswith('#') or not line.strip():
+                continue
+            entr = line.split()
+            vals = [float(v) for v in entr[1:]]
+            for i in range(0, len(vals) - 1, 2):
+                edges.append(('%s/%s/%d' % (system, entr[0], i//2 + 1),
+                              vals[i], vals[i+1]))
+    return edges
+
+
+def work_values(dataset, n, rng, T=298.15, edges=None):
+    '''Draws n forward and n reverse work values (kJ/mol) of one of the
+    benchmark datasets.
+
+    Returns
+    -------
+    wf, wr : ndarray
+    source : str
+        where dG and the width of the distributions come from.
+    '''
+    beta = 1. / (kb * T)
+    if dataset == 'protlig':
+        name, dg, err = edges[rng.randint(len(edges))]
+        sigma = err * np.sqrt(NREF)
+        diss = beta * sigma**2 / 2.
+        wf = rng.normal(dg + diss, sigma, n)
+        wr = rng.normal(-dg + diss, sigma, n)
+        return wf, wr, name
+    elif dataset == 'gaussian':
+        dg, sigma = 10., 5.
+        diss = beta * sigma**2 / 2.
+        wf = rng.normal(dg + diss, sigma, n)
+        wr = rng.normal(-dg + diss, sigma, n)
+        return wf, wr, 'dg=%g sigma=%g' % (dg, sigma)
+    elif dataset == 'skewed':
+        dg, shape, scale = 10., 2., 4.
+        wf = dg + rng.gamma(shape, scale, n)
+        wr = -dg + rng.gamma(shape, scale, n)
+        return wf, wr, 'dg=%g gamma(%g, %g)' % (dg, shape, scale)
+    raise ValueError('unknown dataset %s' % dataset)
+
+
+def run_estimator(name, wf, wr, T, nboots, nblocks, seed):
+    '''Runs one estimator and returns its free energy estimate.'''
+    if name == 'jarz':
+        return Jarz(wf, wr, T=T, nboots=nboots, nblocks=nblocks,
+                    seed=seed).dg_mean
+    elif name == 'jarz_gauss':
+        est = JarzGauss(wf, wr, T=T, nboots=nboots, nblocks=nblocks,
+                        seed=seed)
+        return (est.dg_for + est.dg_rev) / 2.
+    elif name == 'cgi':
+        return Crooks(wf, wr, nboots=nboots, nblocks=nblocks, seed=seed).dg
+    elif name == 'bar':
+        return BAR(wf, wr, T=T, nboots=nboots, nblocks=nblocks,
+                   seed=seed).dg
+    raise ValueError('unknown estimator %s' % name)
+
+
+def time_call(func, repeats):
+    '''Calls func repeats times; returns its last result and the timings.'''
+    times = []
+    for i in range(repeats):
+        t0 = timeit.default_timer()
+        res = func()
+        times.append(timeit.default_timer() - t0)
+    return res, times
+
+
+def run_benchmark(datasets=DATASETS, estimators=ESTIMATORS, sizes=SIZES,
+                  nboots=100, nblocks=5, repeats=3, T=298.15, seed=1,
+                  out=sys.stdout):
+    '''Times all combinations of dataset, size, estimator and error
+    estimate.
+
+    Returns
+    -------
+    results : list of dict
+        one record per combination, with the best and median time in
+        seconds and the free energy estimate.
+    '''
+    edges = read_dg_data() if 'protlig' in datasets else None
+    errors = [('none', 0, 1), ('boots', nboots, 1), ('blocks', 0, nblocks)]
+    results = []
+    for dataset in datasets:
+        for n in sizes:
+            # the same work values for all estimators of a (dataset, n) pair
+            rng = np.random.RandomState([seed, n, DATASETS.index(dataset)])
+            wf, wr, source = work_values(dataset, n, rng, T=T, edges=edges)
+            for est in estimators:
+                for err, nb, nbl in errors:
+                    if err == 'boots' and nb == 0:
+                        continue
+                    if err == 'blocks' and nbl < 2:
+                        continue
+                    dg, times = time_call(
+                        lambda: run_estimator(est, wf, wr, T, nb, nbl, seed),
+                        repeats)
+                    rec = {'dataset': dataset, 'source': source, 'n': n,
+                           'estimator': est, 'errors': err,
+                           'nboots': nb, 'nblocks': nbl,
+                           'best': min(times),
+                           'median': float(np.median(times)),
+                           'dg': float(dg)}
+                    results.append(rec)
+                    print('%-9s %5d %-10s %-6s %10.4f s %10.4f s' %
+                          (dataset, n, est, err, rec['best'], rec['median']),
+                          file=out)
+    return results
+
+
+def _key(rec):
+    return (rec['dataset'], rec['n'], rec['estimator'], rec['errors'])
+
+
+def compare(results, baseline, threshold=1.25, out=sys.stdout):
+    '''Compares the best times of two benchmark runs.
+
+    Returns
+    -------
+    regressions : list of tuples
+        (key, baseline time, new time) of the cases that are slower than the
+        baseline by more than the factor threshold.
+    '''
+    base = dict((_key(r), r) for r in baseline)
+    regressions = []
+    print('\n%-9s %5s %-10s %-6s %10s %10s %7s' %
+          ('dataset', 'n', 'estimator', 'errors', 'base [s]', 'new [s]',
+           'ratio'), file=out)
+    for rec in results:
+        key = _key(rec)
+        if key not in base:
+            continue
+        t0 = base[key]['best']
+        t1 = rec['best']
+        ratio = t1 / t0 if t0 > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- slower'
+            regressions.append((key, t0, t1))
+        print('%-9s %5d %-10s %-6s %10.4f %10.4f %7.2f%s' %
+              (key + (t0, t1, ratio, flag)), file=out)
+    return regressions
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Times the free energy '
+            'estimators of pmx on work distributions of increasing size, and '
+            'optionally compares the timings with a previous run.')
+    parser.add_argument('-o',
+                        metavar='',
+                        dest='outfn',
+                        type=str,
+                        help='JSON file the results are written to. '
+                        'Default is "bench_estimators.json".',
+                        default='bench_estimators.json')
+    parser.add_argument('--compare',
+                        metavar='',
+                        dest='compare',
+                        type=str,
+                        help='JSON file of a previous run to compare the '
+                        'timings with. Default is None.',
+                        default=None)
+    parser.add_argument('--threshold',
+                        metavar='',
+                        dest='threshold',
+                        type=float,
+                        help='Ratio of the new to the old time above which a '
+                        'case is reported as slower. Default is 1.25.',
+                        default=1.25)
+    parser.add_argument('--datasets',
+                        metavar='',
+                        dest='datasets',
+                        type=str,
+                        nargs='+',
+                        choices=DATASETS,
+                        help='Work distributions to use. Default is all of '
+                        '%s.' % ', '.join(DATASETS),
+                        default=DATASETS)
+    parser.add_argument('--estimators',
+                        metavar='',
+                        dest='estimators',
+                        type=str,
+                        nargs='+',
+                        choices=ESTIMATORS,
+                        help='Estimators to time. Default is all of %s.'
+                        % ', '.join(ESTIMATORS),
+                        default=ESTIMATORS)
+    parser.add_argument('-n',
+                        metavar='',
+                        dest='sizes',
+                        type=int,
+                        nargs='+',
+                        help='Numbers of work values per direction. Default '
+                        'is %s.' % ' '.join(str(n) for n in SIZES),
+                        default=SIZES)
+    parser.add_argument('--nboots',
+                        metavar='',
+                        dest='nboots',
+                        type=int,
+                        help='Number of bootstrap samples of the "boots" '
+                        'cases; 0 skips them. Default is 100.',
+                        default=100)
+    parser.add_argument('--nblocks',
+                        metavar='',
+                        dest='nblocks',
+                        type=int,
+                        help='Number of blocks of the "blocks" cases; 1 '
+                        'skips them. Default is 5.',
+                        default=5)
+    parser.add_argument('-r',
+                        metavar='',
+                        dest='repeats',
+                        type=int,
+                        help='Number of times every case is timed. Default '
+                        'is 3.',
+                        default=3)
+    parser.add_argument('--seed',
+                        metavar='',
+                        dest='seed',
+                        type=int,
+                        help='Random seed of the work values and of the '
+                        'bootstrap. Default is 1.',
+                        default=1)
+    return parser.parse_args()
+
+
+def main(args):
+    meta = {'pmx_version': pmx_version,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'machine': platform.node(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'seed': args.seed,
+            'repeats': args.repeats}
+    print('%-9s %5s %-10s %-6s %12s %12s' %
+          ('dataset', 'n', 'estimator', 'errors', 'best', 'median'))
+    results = run_benchmark(datasets=args.datasets,
+                            estimators=args.estimators, sizes=args.sizes,
+                            nboots=args.nboots, nblocks=args.nblocks,
+                            repeats=args.repeats, seed=args.seed)
+    with open(args.outfn, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1,
+                  sort_keys=True)
+    print('\nResults written to %s' % args.outfn)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('Baseline: pmx %s, %s' % (baseline['meta']['pmx_version'],
+                                        baseline['meta']['date']))
+        regressions = compare(results, baseline['results'],
+                              threshold=args.threshold)
+        if regressions:
+            print('\n%d case(s) slower than the baseline by more than a '
+                  'factor %.2f' % (len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -1,10 +1,11 @@
 from __future__ import print_function, division
 import numpy as np
-import sys
-from scipy.optimize import fmin
-from scipy.special import erf
+from scipy.optimize import fmin, brentq
+from scipy.special import erf, expit, logsumexp, kolmogorov
 import scipy.stats
-from copy import deepcopy
+from functools import partial
+import multiprocessing
+from workarchive import WorkArchive
 
 # Constants
 kb = 0.00831447215   # kJ/(K*mol)
@@ -17,13 +18,18 @@ class Jarz(object):
 
     Parameters
     ----------
-    wf : array_like
-        array of forward work values.
-    wr : array_like
+    wf : array_like or WorkArchive
+        array of forward work values, or a WorkArchive holding the forward
+        and reverse work values (and the temperature).
+    wr : array_like, optional
         array of reverse work values.
     T : float or int
+        temperature in Kelvin. Optional if wf is a WorkArchive.
     nboots : int
         number of bootstrap samples to use for error estimation.
+    seed : int, optional
+        seed for the bootstrap random number generator. Default is None
+        (not reproducible).
 
     Examples
     --------
@@ -31,10 +37,22 @@ class Jarz(object):
 
     Attributes
     ----------
+    dg_for : float
+        the forward free energy estimate.
+    dg_rev : float
+        the reverse free energy estimate.
+    dg_mean : float
+        average of the forward and reverse estimates.
+    dg_fd_for : float
+        forward fluctuation-dissipation estimate, mean(W) - beta*var(W)/2.
+    dg_fd_rev : float
+        reverse fluctuation-dissipation estimate.
 
     '''
 
-    def __init__(self, wf, wr, T, nboots=0, nblocks=1, statesProvided='AB'):
+    def __init__(self, wf, wr=None, T=None, nboots=0, nblocks=1,
+                 statesProvided='AB', seed=None):
+        wf, wr, T = _unpack_archive(wf, wr, T)
         if 'A' in statesProvided:
             self.wf = np.array(wf)
         if 'B' in statesProvided:
@@ -42,22 +60,28 @@ class Jarz(object):
         self.T = float(T)
         self.nboots = nboots
         self.nblocks = nblocks
+        self.seed = seed
 
         # Calculate all Jarz properties available
         if 'A' in statesProvided:
             self.dg_for = self.calc_dg(w=self.wf, c=1.0, T=self.T)
+            self.dg_fd_for = self.calc_dg_fd(w=self.wf, c=1.0, T=self.T)
         if 'B' in statesProvided:
             self.dg_rev = -1.0 * self.calc_dg(w=self.wr, c=-1.0, T=self.T)
+            self.dg_fd_rev = -1.0 * self.calc_dg_fd(w=self.wr, c=-1.0,
+                                                    T=self.T)
         if 'AB' in statesProvided:
             self.dg_mean = (self.dg_for + self.dg_rev) * 0.5
 
         if nboots > 0:
             if 'A' in statesProvided:
                 self.err_boot_for = self.calc_err_boot(w=self.wf, T=self.T,
-                                                   c=1.0, nboots=nboots)
+                                                   c=1.0, nboots=nboots,
+                                                   seed=seed)
             if 'B' in statesProvided:
                 self.err_boot_rev = self.calc_err_boot(w=self.wr, T=self.T,
-                                                   c=-1.0, nboots=nboots)
+                                                   c=-1.0, nboots=nboots,
+                                                   seed=seed)
 
         if nblocks > 1:
             if 'A' in statesProvided:
@@ -71,31 +95,55 @@ class Jarz(object):
 
     @staticmethod
     def calc_dg(w, T, c):
-        '''to be filled
+        '''Calculates the free energy difference with the Jarzynski equality,
+        -kT*log(<exp(-beta*c*W)>). The exponential average is evaluated as a
+        log-sum-exp, so it neither overflows nor underflows for large
+        dissipated work.
+
+        Parameters
+        ----------
+        w : array_like
+            array of work values.
+        T : float
+            temperature.
+        c : [1,-1]
+            sign of the work values: 1 for the forward and -1 for the
+            reverse direction.
+
+        Returns
+        -------
+        dg : float
+            the Jarzynski free energy estimate.
         '''
         beta = 1./(kb*T)
-        n = float(len(w))
-        mexp = 0.0
-        m = 0.0
-        m2 = 0.0
-        for i in w:
-            mexp = mexp + np.exp(-beta*c*i)
-            m = m + c*i
-            m2 = m2 + i*i
-        mexp = mexp/n
-        m = m/n
-        m2 = m2/n
-        var = (m2-m*m)*(n/(n-1))
-        # Jarzynski estimator
-        dg = -kb*T*np.log(mexp)
-        # Fluctuation-Dissipation estimator
-        # FIXME: unused atm, remove or return?
-        dg2 = m - beta*var/2.0
-
-        return dg
+        return float(_jarz_dg(w, beta, c))
 
     @staticmethod
-    def calc_err_boot(w, T, c, nboots):
+    def calc_dg_fd(w, T, c):
+        '''Calculates the fluctuation-dissipation estimate of the free
+        energy difference, mean(c*W) - beta*var(W)/2, i.e. the second order
+        cumulant expansion of the Jarzynski equality.
+
+        Parameters
+        ----------
+        w : array_like
+            array of work values.
+        T : float
+            temperature.
+        c : [1,-1]
+            sign of the work values: 1 for the forward and -1 for the
+            reverse direction.
+
+        Returns
+        -------
+        dg : float
+            the fluctuation-dissipation free energy estimate.
+        '''
+        beta = 1./(kb*T)
+        return float(_jarz_fd(w, beta, c))
+
+    @staticmethod
+    def calc_err_boot(w, T, c, nboots, seed=None):
         '''Calculates the standard error via bootstrap. The work values are
         resampled randomly with replacement multiple (nboots) times,
         and the Jarzinski free energy recalculated for each bootstrap samples.
@@ -112,23 +160,17 @@ class Jarz(object):
             ???
         nboots: int
             number of bootstrap samples to use for the error estimate.
+        seed : int, optional
+            seed for the random number generator. See :func:`bootstrap`.
 
         Returns
         -------
         err : float
             standard error of the mean.
         '''
-        dg_boots = []
-        n = len(w)
-        for k in range(nboots):
-            sys.stdout.write('\r  Bootstrap (Std Err): iteration %s/%s'
-                             % (k+1, nboots))
-            sys.stdout.flush()
-
-            boot = np.random.choice(w, size=n, replace=True)
-            dg_boot = -1.0 * Jarz.calc_dg(boot, T, c)
-            dg_boots.append(dg_boot)
-        sys.stdout.write('\n')
+        beta = 1./(kb*T)
+        dg_boots = -1.0 * bootstrap(partial(_jarz_dg, beta=beta, c=c), [w],
+                                    nboots, seed=seed)
         err = np.std(dg_boots)
         return err
 
@@ -177,12 +219,14 @@ class JarzGauss:
     separating the work values into blocks.
     Parameters
     ----------
-    wf : array_like
-        array of forward work values.
-    wr : array_like
+    wf : array_like or WorkArchive
+        array of forward work values, or a WorkArchive holding the forward
+        and reverse work values (and the temperature).
+    wr : array_like, optional
         array of reverse work values.
     T : float, optional
-        temperature in Kelvin. Default is 298.15 K.
+        temperature in Kelvin. Default is that of the WorkArchive, if given,
+        or 298.15 K.
     nboots : int, optional
         how many bootstrap samples to draw for estimating the standard error.
         Default is zero (do not estimate the error).
@@ -191,6 +235,9 @@ class JarzGauss:
         of the standard error. Default is one (do not estimate the error).
     statesProvided: str, optional
         two directions or one
+    seed : int, optional
+        seed for the bootstrap random number generator. Default is None
+        (not reproducible).
     Examples
     --------
     >>> estimate = JarzGauss(wf, wr, T=300, nboots=1000, nblocks=10)
@@ -225,7 +272,9 @@ class JarzGauss:
         separating the input work values into groups/blocks.
     '''
 
-    def __init__(self, wf, wr, T=298.15, nboots=0, nblocks=1, statesProvided='AB'):
+    def __init__(self, wf, wr=None, T=None, nboots=0, nblocks=1,
+                 statesProvided='AB', seed=None):
+        wf, wr, T = _unpack_archive(wf, wr, T, default_T=298.15)
         if 'A' in statesProvided:
             self.wf = np.array(wf)
         if 'B' in statesProvided:
@@ -233,6 +282,7 @@ class JarzGauss:
         self.T = float(T)
         self.nboots = nboots
         self.nblocks = nblocks
+        self.seed = seed
 
         # Calculate all Jarz properties available
         if 'A' in statesProvided:
@@ -246,11 +296,13 @@ class JarzGauss:
             if 'A' in statesProvided:
                 self.err_boot_for = self.calc_err_boot(w=self.wf, T=self.T,
                                                        nboots=self.nboots,
-                                                       bReverse=False)
+                                                       bReverse=False,
+                                                       seed=seed)
             if 'B' in statesProvided:
                 self.err_boot_rev = self.calc_err_boot(w=self.wr, T=self.T,
                                                        nboots=self.nboots,
-                                                       bReverse=True)
+                                                       bReverse=True,
+                                                       seed=seed)
 
         if nblocks > 1:
             if 'A' in statesProvided:
@@ -321,7 +373,7 @@ class JarzGauss:
         return dg_stderr
 
     @staticmethod
-    def calc_err_boot(w, T, nboots, bReverse=False):
+    def calc_err_boot(w, T, nboots, bReverse=False, seed=None):
         '''Calculates the standard error via bootstrap. The work values are
         resampled randomly with replacement multiple (nboots) times,
         and the Gaussian approximation for Jarzinski free energy
@@ -340,22 +392,22 @@ class JarzGauss:
             whether the work values provided are for the reverse transition.
             Default if False. If they are for the reverse transition, set it to
             True.
+        seed : int, optional
+            seed for the random number generator. See :func:`bootstrap`.
         Returns
         -------
         err : float
             standard error of the mean.
         '''
-        dg_boots = []
-        n = len(w)
-        for k in range(nboots):
-            sys.stdout.write('\r  Bootstrap (Std Err): iteration %s/%s'
-                             % (k+1, nboots))
-            sys.stdout.flush()
-
-            boot = np.random.choice(w, size=n, replace=True)
-            dg_boot = JarzGauss.calc_dg(boot, T, bReverse)
-            dg_boots.append(dg_boot)
-        sys.stdout.write('\n')
+        beta = 1./(kb*T)
+        c = -1.0 if bReverse else 1.0
+
+        def jarz_gauss_rows(boot):
+            dg = (np.mean(c*boot, axis=1) -
+                  (beta * np.var(c*boot, axis=1, ddof=1)) * 0.5)
+            return c * dg
+
+        dg_boots = bootstrap(jarz_gauss_rows, [w], nboots, seed=seed)
         err = np.std(dg_boots)
         return err
 
@@ -410,10 +462,18 @@ class Crooks(object):
 
     Parameters
     ----------
-    wf : array_like
-        array of forward work values.
-    wr : array_like
+    wf : array_like or WorkArchive
+        array of forward work values, or a WorkArchive holding the forward
+        and reverse work values (and the temperature).
+    wr : array_like, optional
         array of reverse work values.
+    nboots : int, optional
+        number of bootstrap samples for the non-parametric bootstrap error.
+    nblocks : int, optional
+        number of blocks to divide the data into for error estimation.
+    seed : int, optional
+        seed for the bootstrap random number generator. Default is None
+        (not reproducible).
 
     Examples
     --------
@@ -444,13 +504,15 @@ class Crooks(object):
         standard deviation of the reverse Gaussian.
     '''
 
-    def __init__(self, wf, wr, nboots=0, nblocks=1):
+    def __init__(self, wf, wr=None, nboots=0, nblocks=1, seed=None):
+        wf, wr, _ = _unpack_archive(wf, wr, require_T=False)
 
         # inputs
         self.wf = np.array(wf)
         self.wr = np.array(wr)
         self.nboots = nboots
         self.nblocks = nblocks
+        self.seed = seed
         # params of the gaussians
         self.mf, self.devf, self.Af = data2gauss(wf)
         self.mr, self.devr, self.Ar = data2gauss(wr)
@@ -461,10 +523,10 @@ class Crooks(object):
         self.err_boot1 = self.calc_err_boot1(m1=self.mf, s1=self.devf,
                                              n1=len(wf), m2=self.mr,
                                              s2=self.devr, n2=len(wr),
-                                             nboots=1000)
+                                             nboots=1000, seed=seed)
         if nboots > 0:
             self.err_boot2 = self.calc_err_boot2(wf=self.wf, wr=self.wr,
-                                                 nboots=nboots)
+                                                 nboots=nboots, seed=seed)
 
         if nblocks > 1:
             self.err_blocks = self.calc_err_blocks(self.wf, self.wr, nblocks)
@@ -497,31 +559,44 @@ class Crooks(object):
 
         m1, s1, A1 = data2gauss(wf)
         m2, s2, A2 = data2gauss(wr)
+        dg, inters = Crooks.calc_dg_gauss(m1, s1, m2, s2)
+        return float(dg), bool(inters)
 
-        p1 = m1/s1**2-m2/s2**2
-        p2 = np.sqrt(1/(s1**2*s2**2)*(m1-m2)**2+2*(1/s1**2-1/s2**2)*np.log(s2/s1))
-        p3 = 1/s1**2-1/s2**2
-        x1 = (p1+p2)/p3
-        x2 = (p1-p2)/p3
+    @staticmethod
+    def calc_dg_gauss(m1, s1, m2, s2):
+        '''Calculates the intersection of pairs of forward and reverse
+        Gaussians given their means and standard deviations. The quadratic
+        equations of all pairs are solved at once, so that e.g. thousands of
+        bootstrap replicates cost a handful of array operations. The root
+        lying between the two means is taken; if there is none, the average
+        of the means is returned instead, as in :meth:`calc_dg`.
+
+        Parameters
+        ----------
+        m1 : float or array_like
+            means of the forward Gaussians.
+        s1 : float or array_like
+            standard deviations of the forward Gaussians.
+        m2 : float or array_like
+            means of the reverse Gaussians.
+        s2 : float or array_like
+            standard deviations of the reverse Gaussians.
 
-        # determine which solution to take
-        if x1 > m1 and x1 < m2 or x1 > m2 and x1 < m1:
-            dg = x1
-            return dg, True
-        elif x2 > m1 and x2 < m2 or x2 > m2 and x2 < m1:
-            dg = x2
-            return dg, True
-        else:
-            # we do not take the intersection but the average of the means
-            dg = (m1 + m2) * 0.5
-            return dg, False
+        Returns
+        -------
+        dg : ndarray
+            the intersections (or averages of the means).
+        inters : ndarray of bool
+            whether the intersection could be calculated.
+        '''
+        return _cgi_intersect(m1, s1, m2, s2)
 
     # Possible change of behaviour compared to the original script:
     # here it is not determined in advanced whether to take the intersection
     # or the mean, but for each bootstrap sample if the intersecion cannot
     # be taken, then the mean is used automatically.
     @staticmethod
-    def calc_err_boot1(m1, s1, n1, m2, s2, n2, nboots=1000):
+    def calc_err_boot1(m1, s1, n1, m2, s2, n2, nboots=1000, seed=None):
         '''Calculates the standard error of the Crooks Gaussian Intersection
         via parametric bootstrap. Given the parameters of the forward and
         reverse Gaussian distributions, multiple (nboots) bootstrap samples
@@ -531,6 +606,13 @@ class Crooks(object):
         is returned as the standard deviation of the bootstrapped free
         energies.
 
+        Only the mean and standard deviation of each bootstrap sample enter
+        the CGI, so instead of drawing the n1 and n2 work values these are
+        drawn directly from their sampling distributions: the mean of n
+        values from a Gaussian is Gaussian with standard deviation s/sqrt(n),
+        and n times their variance over s**2 is chi-square distributed with
+        n-1 degrees of freedom, independently of the mean.
+
         Parameters
         ----------
         m1 : float
@@ -549,6 +631,8 @@ class Crooks(object):
             number of bootstrap samples to use for the error estimate.
             Parametric bootstrap is used where work values are resampled from
             two Gaussians.
+        seed : int, optional
+            seed for the random number generator. See :func:`spawn_rngs`.
 
         Returns
         -------
@@ -556,18 +640,18 @@ class Crooks(object):
             standard error of the mean.
         '''
 
-        dg_boots = []
-        for k in range(nboots):
-            bootA = np.random.normal(loc=m1, scale=s1, size=n1)
-            bootB = np.random.normal(loc=m2, scale=s2, size=n2)
+        rng = spawn_rngs(seed, 1)[0]
+        mA = rng.normal(loc=m1, scale=s1/np.sqrt(n1), size=nboots)
+        mB = rng.normal(loc=m2, scale=s2/np.sqrt(n2), size=nboots)
+        sA = s1*np.sqrt(rng.chisquare(n1 - 1, size=nboots)/n1)
+        sB = s2*np.sqrt(rng.chisquare(n2 - 1, size=nboots)/n2)
 
-            dg_boot, _ = Crooks.calc_dg(bootA, bootB)
-            dg_boots.append(dg_boot)
+        dg_boots, _ = _cgi_intersect(mA, sA, mB, sB)
         err = np.std(dg_boots)
         return err
 
     @staticmethod
-    def calc_err_boot2(wf, wr, nboots):
+    def calc_err_boot2(wf, wr, nboots, seed=None):
         '''Calculates the standard error of the Crooks Gaussian Intersection
         via non-parametric bootstrap. The work values are resampled randomly
         with replacement multiple (nboots) times, and the CGI free energy
@@ -583,6 +667,8 @@ class Crooks(object):
             array of reverse work values.
         nboots: int
             number of bootstrap samples to use for the error estimate.
+        seed : int, optional
+            seed for the random number generator. See :func:`bootstrap`.
 
         Returns
         -------
@@ -590,22 +676,14 @@ class Crooks(object):
             standard error of the mean.
         '''
 
-        nf = len(wf)
-        nr = len(wr)
-
-        dg_boots = []
-        for k in range(nboots):
-            sys.stdout.write('\r  Bootstrap (Std Err): iteration %s/%s'
-                             % (k+1, nboots))
-            sys.stdout.flush()
+        def crooks_rows(bootA, bootB):
+            dg, _ = _cgi_intersect(np.average(bootA, axis=1),
+                                   np.std(bootA, axis=1),
+                                   np.average(bootB, axis=1),
+                                   np.std(bootB, axis=1))
+            return dg
 
-            bootA = np.random.choice(wf, size=nf, replace=True)
-            bootB = np.random.choice(wr, size=nr, replace=True)
-
-            dg_boot, _ = Crooks.calc_dg(bootA, bootB)
-            dg_boots.append(dg_boot)
-
-        sys.stdout.write('\n')
+        dg_boots = bootstrap(crooks_rows, [wf, wr], nboots, seed=seed)
         err = np.std(dg_boots)
         return err
 
@@ -628,15 +706,14 @@ class Crooks(object):
             you ran.
         '''
 
-        dg_blocks = []
         # loosely split the arrays
         wf_split = np.array_split(wf, nblocks)
         wr_split = np.array_split(wr, nblocks)
 
         # calculate all dg
-        for wf_block, wr_block in zip(wf_split, wr_split):
-            dg_block, _ = Crooks.calc_dg(wf_block, wr_block)
-            dg_blocks.append(dg_block)
+        mf, sf, _ = np.transpose([data2gauss(b) for b in wf_split])
+        mr, sr, _ = np.transpose([data2gauss(b) for b in wr_split])
+        dg_blocks, _ = _cgi_intersect(mf, sf, mr, sr)
 
         # get std err
         err_blocks = scipy.stats.sem(dg_blocks, ddof=1)
@@ -651,17 +728,49 @@ class BAR(object):
 
     Parameters
     ----------
+    wf : array_like or WorkArchive
+        array of forward work values, or a WorkArchive holding the forward
+        and reverse work values (and the temperature).
+    wr : array_like, optional
+        array of reverse work values.
+    T : float or int
+        temperature in Kelvin. Optional if wf is a WorkArchive.
+    nboots : int, optional
+        number of bootstrap samples to use for error estimation.
+    nblocks : int, optional
+        number of blocks to divide the data into for error estimation.
+    solver : str, optional
+        how to solve the implicit BAR equation. 'brentq' (default) finds the
+        root of the vectorized BAR residual within a bracket; 'simplex' is
+        the original Nelder-Mead minimization of the squared residual.
+    seed : int, optional
+        seed for the bootstrap random number generator. Default is None
+        (not reproducible).
+    n_jobs : int, optional
+        number of processes used for the bootstrap. Default is 1 (serial);
+        -1 uses all CPUs. The result does not depend on ``n_jobs``.
+    stage : callable, optional
+        called with the name of the 'bootstrap' and 'blocks' error
+        estimates before each is run, e.g. to time them. Default is None.
 
     Examples
     --------
+    >>> bar = BAR(wf, wr, T=298.15, nboots=100)
+    >>> dg = bar.dg
+    >>> err = bar.err_boot
     '''
 
-    def __init__(self, wf, wr, T, nboots=0, nblocks=1):
+    def __init__(self, wf, wr=None, T=None, nboots=0, nblocks=1,
+                 solver='brentq', seed=None, n_jobs=1, stage=None):
+        wf, wr, T = _unpack_archive(wf, wr, T)
         self.wf = np.array(wf)
         self.wr = np.array(wr)
         self.T = float(T)
         self.nboots = nboots
         self.nblocks = nblocks
+        self.solver = solver
+        self.seed = seed
+        self.n_jobs = n_jobs
 
         self.nf = len(wf)
         self.nr = len(wr)
@@ -669,22 +778,27 @@ class BAR(object):
         self.M = kb * self.T * np.log(float(self.nf) / float(self.nr))
 
         # Calculate all BAR properties available
-        self.dg = self.calc_dg(self.wf, self.wr, self.T)
+        self.dg = self.calc_dg(self.wf, self.wr, self.T, solver=solver)
         self.err = self.calc_err(self.dg, self.wf, self.wr, self.T)
-        if nboots > 0:
-            self.err_boot = self.calc_err_boot(self.wf, self.wr, nboots,
-                                               self.T)
         self.conv = self.calc_conv(self.dg, self.wf, self.wr, self.T)
         if nboots > 0:
+            if stage is not None:
+                stage('bootstrap')
+            self.err_boot = self.calc_err_boot(self.wf, self.wr, nboots,
+                                               self.T, solver=solver,
+                                               seed=seed, n_jobs=n_jobs)
             self.conv_err_boot = self.calc_conv_err_boot(self.dg, self.wf,
                                                          self.wr, nboots,
-                                                         self.T)
+                                                         self.T, seed=seed,
+                                                         n_jobs=n_jobs)
         if nblocks > 1:
+            if stage is not None:
+                stage('blocks')
             self.err_blocks = self.calc_err_blocks(self.wf, self.wr, nblocks,
-                                                   self.T)
+                                                   self.T, solver=solver)
 
     @staticmethod
-    def calc_dg(wf, wr, T):
+    def calc_dg(wf, wr, T, solver='brentq'):
         '''Estimates and returns the free energy difference.
 
         Parameters
@@ -695,6 +809,8 @@ class BAR(object):
             array of reverse work values.
         T : float
             temperature
+        solver : str, optional
+            'brentq' (default) or 'simplex'. See :class:`BAR`.
 
         Returns
         ----------
@@ -707,6 +823,12 @@ class BAR(object):
         beta = 1./(kb*T)
         M = kb * T * np.log(nf/nr)
 
+        if solver == 'brentq':
+            return _bar_solve(np.asarray(wf, dtype=float),
+                              np.asarray(wr, dtype=float), beta, M)
+        elif solver != 'simplex':
+            raise ValueError('Unknown BAR solver \'%s\'' % solver)
+
         def func(x, wf, wr):
             sf = 0
             for v in wf:
@@ -747,11 +869,8 @@ class BAR(object):
         beta = 1./(kb*T)
         M = kb * T * np.log(nf/nr)
 
-        err = 0
-        for v in wf:
-            err += 1./(2+2*np.cosh(beta * (M+v-dg)))
-        for v in wr:
-            err += 1./(2+2*np.cosh(beta * (M+v-dg)))
+        err = (np.sum(1./(2+2*np.cosh(beta * (M+np.asarray(wf)-dg)))) +
+               np.sum(1./(2+2*np.cosh(beta * (M+np.asarray(wr)-dg)))))
         N = nf + nr
         err /= float(N)
         tot = 1/(beta**2*N)*(1./err-(N/nf + N/nr))
@@ -760,7 +879,8 @@ class BAR(object):
         return err
 
     @staticmethod
-    def calc_err_boot(wf, wr, nboots, T):
+    def calc_err_boot(wf, wr, nboots, T, solver='brentq', seed=None,
+                      n_jobs=1):
         '''Calculates the error by bootstrapping.
 
         Parameters
@@ -773,29 +893,26 @@ class BAR(object):
             temperature
         nboots: int
             number of bootstrap samples.
+        solver : str, optional
+            'brentq' (default) or 'simplex'. See :class:`BAR`.
+        seed : int, optional
+            seed for the random number generator. See :func:`bootstrap`.
+        n_jobs : int, optional
+            number of processes to spread the bootstrap samples over.
 
         '''
 
-        nf = len(wf)
-        nr = len(wr)
-        dg_boots = []
-        for k in range(nboots):
-            sys.stdout.write('\r  Bootstrap (Std Err): iteration %s/%s'
-                             % (k+1, nboots))
-            sys.stdout.flush()
-
-            bootA = np.random.choice(wf, size=nf, replace=True)
-            bootB = np.random.choice(wr, size=nr, replace=True)
-            dg_boot = BAR.calc_dg(bootA, bootB, T)
-            dg_boots.append(dg_boot)
-
-        sys.stdout.write('\n')
+        # every resample needs its own root search, so the replicates are
+        # cut into small fixed chunks that can be farmed out to processes
+        dg_boots = bootstrap(partial(_bar_dg_rows, T=T, solver=solver),
+                             [wf, wr], nboots, seed=seed,
+                             chunksize=BAR_BOOT_CHUNK, n_jobs=n_jobs)
         err_boot = np.std(dg_boots)
 
         return err_boot
 
     @staticmethod
-    def calc_err_blocks(wf, wr, nblocks, T):
+    def calc_err_blocks(wf, wr, nblocks, T, solver='brentq'):
         '''Calculates the standard error based on a number of blocks the
         work values are divided into. It is useful when you run independent
         equilibrium simulations, so that you can then use their respective
@@ -813,6 +930,8 @@ class BAR(object):
             number of blocks to divide the data into. This can be for
             instance the number of independent equilibrium simulations
             you ran.
+        solver : str, optional
+            'brentq' (default) or 'simplex'. See :class:`BAR`.
         '''
 
         dg_blocks = []
@@ -822,7 +941,7 @@ class BAR(object):
 
         # calculate all dg
         for wf_block, wr_block in zip(wf_split, wr_split):
-            dg_block = BAR.calc_dg(wf_block, wr_block, T)
+            dg_block = BAR.calc_dg(wf_block, wr_block, T, solver=solver)
             dg_blocks.append(dg_block)
 
         # get std err
@@ -868,25 +987,566 @@ class BAR(object):
         return conv
 
     @staticmethod
-    def calc_conv_err_boot(dg, wf, wr, nboots, T):
-        nf = len(wf)
-        nr = len(wr)
-        conv_boots = []
-        for k in range(nboots):
-            sys.stdout.write('\r  Bootstrap (Conv): '
-                             'iteration %s/%s' % (k+1, nboots))
-            sys.stdout.flush()
-
-            bootA = np.random.choice(wf, size=nf, replace=True)
-            bootB = np.random.choice(wr, size=nr, replace=True)
-            conv_boot = BAR.calc_conv(dg, bootA, bootB, T)
-            conv_boots.append(conv_boot)
-
-        sys.stdout.write('\n')
+    def calc_conv_err_boot(dg, wf, wr, nboots, T, seed=None, n_jobs=1):
+        '''Calculates the standard error of the BAR convergence measure
+        (see :meth:`calc_conv`) via bootstrap. The free energy ``dg`` is
+        kept fixed while the work values are resampled.
+
+        Parameters
+        ----------
+        dg : float
+            the BAR free energy estimate
+        wf : array_like
+            array of forward work values.
+        wr : array_like
+            array of reverse work values.
+        nboots: int
+            number of bootstrap samples.
+        T : float
+            temperature
+        seed : int, optional
+            seed for the random number generator. See :func:`bootstrap`.
+        n_jobs : int, optional
+            number of processes to spread the bootstrap samples over.
+        '''
+        conv_boots = bootstrap(partial(_bar_conv_rows, dg=dg, T=T),
+                               [wf, wr], nboots, seed=seed,
+                               chunksize=BAR_BOOT_CHUNK, n_jobs=n_jobs)
         err = np.std(conv_boots)
         return err
 
 
+class MBAR(object):
+    '''Multistate Bennett acceptance ratio (MBAR) for samples collected in
+    K thermodynamic states, e.g. the lambda windows of a discrete TI
+    calculation.
+
+    The dimensionless free energies f_k are the solution of the
+    self-consistent MBAR equations, found by Newton-Raphson iterations on
+    the convex MBAR objective; in every iteration the self-consistent update
+    is tried as well, and whichever satisfies the equations better is kept,
+    so that far from the solution no wild Newton step is taken. All sums over
+    the samples are log-sum-exp reductions evaluated in chunks of samples,
+    so that apart from u_kn itself memory use is O(K x chunksize).
+
+    Parameters
+    ----------
+    u_kn : array_like
+        (K x N) matrix of reduced potentials u_k(x_n) = beta*U_k(x_n) of all
+        N samples evaluated in all K states. Any per-sample constant may be
+        added, e.g. only the energy differences to the sampled state are
+        needed.
+    N_k : array_like
+        number of samples drawn from each of the K states. The order of the
+        samples in u_kn does not matter.
+    T : float, optional
+        temperature in Kelvin, used to report the free energies in kJ/mol.
+        Default is 298.15 K.
+    tol : float, optional
+        convergence threshold on the MBAR equations. Default is 1e-10.
+    maxiter : int, optional
+        maximum number of iterations. Default is 1000.
+    chunksize : int, optional
+        number of samples evaluated at once. Default is 100000.
+    f_k : array_like, optional
+        initial guess of the dimensionless free energies.
+
+    Examples
+    --------
+    >>> mbar = MBAR(u_kn, N_k, T=298.15)
+    >>> dg = mbar.dg[0, -1]
+    >>> err = mbar.err[0, -1]
+
+    Attributes
+    ----------
+    f_k : ndarray
+        dimensionless free energies of the K states, with f_k[0] = 0.
+    dg : ndarray
+        (K x K) matrix of free energy differences G_l - G_k in kJ/mol.
+    err : ndarray
+        (K x K) matrix of the asymptotic standard errors of dg in kJ/mol.
+    niter : int
+        number of iterations used.
+    converged : bool
+        whether the MBAR equations were solved within tol in maxiter
+        iterations.
+    '''
+
+    def __init__(self, u_kn, N_k, T=298.15, tol=1e-10, maxiter=1000,
+                 chunksize=100000, f_k=None):
+        self.u_kn = u_kn
+        self.N_k = np.asarray(N_k, dtype=float)
+        self.T = float(T)
+        self.tol = tol
+        self.maxiter = maxiter
+        self.chunksize = chunksize
+        K, N = np.shape(u_kn)
+        if len(self.N_k) != K or self.N_k.sum() != N:
+            raise ValueError('u_kn has shape %s, which does not match N_k'
+                             % str((K, N)))
+
+        self.f_k, self.niter, self.converged = self.calc_f(f_k)
+        self.theta = self.calc_cov(self.f_k)
+
+        kT = kb * self.T
+        self.dg = kT * (self.f_k[np.newaxis, :] - self.f_k[:, np.newaxis])
+        d = np.diag(self.theta)
+        var = d[:, np.newaxis] + d[np.newaxis, :] - 2*self.theta
+        self.err = kT * np.sqrt(np.maximum(var, 0.))
+
+    def _pass(self, f, gram=False):
+        '''One pass over the samples. Returns, for every state i,
+        log(sum_n W_in) with the MBAR weights
+        W_in = exp(f_i - u_in) / sum_k N_k exp(f_k - u_kn), and optionally
+        the (K x K) matrix sum_n W_in W_jn.'''
+        K, N = np.shape(self.u_kn)
+        with np.errstate(divide='ignore'):
+            logN = np.log(self.N_k)
+        lse = np.full(K, -np.inf)
+        A = np.zeros((K, K)) if gram else None
+        for i in range(0, N, self.chunksize):
+            u = np.asarray(self.u_kn[:, i:i+self.chunksize], dtype=float)
+            a = (logN + f)[:, np.newaxis] - u
+            # log of the denominators, one per sample
+            d = logsumexp(a, axis=0)
+            logw = (f[:, np.newaxis] - u) - d
+            lse = np.logaddexp(lse, logsumexp(logw, axis=1))
+            if gram:
+                w = np.exp(logw)
+                A += np.dot(w, w.T)
+        return lse, A
+
+    def calc_f(self, f_k=None):
+        '''Solves the MBAR equations for the dimensionless free energies.
+
+        Parameters
+        ----------
+        f_k : array_like, optional
+            initial guess. Default is zero for all states.
+
+        Returns
+        -------
+        f_k : ndarray
+            the free energies, with f_k[0] = 0.
+        niter : int
+            number of iterations used.
+        converged : bool
+            whether the residuals are below tol.
+        '''
+        K = len(self.N_k)
+        N = self.N_k
+        f = np.zeros(K) if f_k is None else np.array(f_k, dtype=float)
+        sampled = np.where(N > 0)[0]
+        ref = sampled[0]
+        # states whose free energy is updated by the Newton steps
+        free = sampled[1:]
+        unsampled = N == 0
+
+        def evaluate(f):
+            lse, A = self._pass(f, gram=True)
+            # residuals of the MBAR equations, sum_n W_in = 1
+            return f, lse, A, np.max(np.abs(np.expm1(lse[sampled])))
+
+        f, lse, A, gnorm = evaluate(f - f[ref])
+        for it in range(1, self.maxiter + 1):
+            if gnorm < self.tol:
+                break
+            # self-consistent update, also used for the unsampled states,
+            # which do not enter the denominators
+            f_sc = f - lse
+            candidates = [f_sc - f_sc[ref]]
+            # Newton step with the gradient and Hessian of the MBAR objective
+            S = np.exp(lse)
+            grad = N * (S - 1.)
+            H = np.diag(N * S) - N[:, np.newaxis] * A * N[np.newaxis, :]
+            try:
+                step = np.linalg.solve(H[np.ix_(free, free)], grad[free])
+                f_nr = f_sc.copy()
+                f_nr[sampled] = f[sampled]
+                f_nr[free] -= step
+                if np.all(np.isfinite(f_nr)):
+                    candidates.append(f_nr - f_nr[ref])
+            except np.linalg.LinAlgError:
+                pass
+            f, lse, A, gnorm = min([evaluate(c) for c in candidates],
+                                   key=lambda r: r[3])
+        # the unsampled states follow from the converged denominators
+        f = f.copy()
+        f[unsampled] -= lse[unsampled]
+        return f - f[0], it, gnorm < self.tol
+
+    def calc_cov(self, f_k):
+        '''Calculates the asymptotic covariance matrix of the dimensionless
+        free energies, Theta = W' (I - W N W')^+ W, from the (K x K) matrix
+        W'W only: with W'W = V S^2 V', Theta = V S (I - S V' N V S)^+ S V'.
+
+        Parameters
+        ----------
+        f_k : array_like
+            the converged free energies.
+
+        Returns
+        -------
+        theta : ndarray
+            (K x K) covariance matrix.
+        '''
+        _, A = self._pass(np.asarray(f_k, dtype=float), gram=True)
+        s2, V = np.linalg.eigh(A)
+        S = np.sqrt(np.maximum(s2, 0.))
+        VS = V * S
+        M = np.eye(len(S)) - np.dot(VS.T * self.N_k, VS)
+        # M is singular by construction, as the f_k are only defined up to a
+        # constant: its null space is cut off well above round-off, which
+        # would otherwise be inverted
+        return np.dot(np.dot(VS, np.linalg.pinv(M, rcond=1e-10)), VS.T)
+
+
+class RunningEstimate(object):
+    '''Free energy estimates that are updated as work values come in, e.g.
+    while non-equilibrium transitions are still running.
+
+    New forward/reverse work values are added with :meth:`add`. Instead of
+    recomputing everything from scratch, a running log-sum-exp (Jarzynski)
+    and running mean and variance (Jarzynski with Gaussian approximation and
+    CGI) are updated, and the BAR root search is started from the previous
+    BAR estimate.
+
+    Parameters
+    ----------
+    T : float, optional
+        temperature in Kelvin. Default is 298.15 K.
+    solver : str, optional
+        BAR solver, see :class:`BAR`. Default is 'brentq'.
+    nboots : int, optional
+        number of parametric bootstrap samples for the CGI error, see
+        :meth:`Crooks.calc_err_boot1`. Default is 0 (no CGI error).
+    seed : int, optional
+        seed for the CGI parametric bootstrap. Default is None.
+
+    Examples
+    --------
+    >>> run = RunningEstimate(T=298.15)
+    >>> run.add(wf=wf[:10], wr=wr[:10])
+    >>> run.add(wf=wf[10:])
+    >>> dg = run.dg_bar
+
+    Attributes
+    ----------
+    wf : ndarray
+        all forward work values added so far.
+    wr : ndarray
+        all reverse work values added so far.
+    dg_jarz_for, dg_jarz_rev : float
+        Jarzynski estimates (None without forward/reverse work values).
+    err_jarz_for, err_jarz_rev : float
+        standard errors of the Jarzynski estimates from first order error
+        propagation of the exponential average.
+    dg_gauss_for, dg_gauss_rev : float
+        Jarzynski estimates with the Gaussian approximation.
+    err_gauss_for, err_gauss_rev : float
+        analytical standard errors of the Gaussian approximation.
+    dg_cgi : float
+        Crooks Gaussian Intersection estimate (None unless both directions
+        are available).
+    err_cgi : float
+        parametric bootstrap error of the CGI estimate (None if nboots is
+        zero).
+    dg_bar : float
+        BAR estimate (None unless both directions are available).
+    err_bar : float
+        analytical standard error of the BAR estimate.
+    '''
+
+    def __init__(self, T=298.15, solver='brentq', nboots=0, seed=None):
+        self.T = float(T)
+        self.beta = 1./(kb*self.T)
+        self.solver = solver
+        self.nboots = nboots
+        self.seed = seed
+        self.wf = np.zeros(0)
+        self.wr = np.zeros(0)
+        # n, mean, sum of squared deviations, log-sum-exp of -beta*c*w and
+        # of -2*beta*c*w
+        self._stats = {1.0: (0, 0., 0., -np.inf, -np.inf),
+                       -1.0: (0, 0., 0., -np.inf, -np.inf)}
+        self.dg_jarz_for = self.dg_jarz_rev = None
+        self.err_jarz_for = self.err_jarz_rev = None
+        self.dg_gauss_for = self.dg_gauss_rev = None
+        self.err_gauss_for = self.err_gauss_rev = None
+        self.dg_cgi = None
+        self.err_cgi = None
+        self.dg_bar = None
+        self.err_bar = None
+
+    def add(self, wf=(), wr=()):
+        '''Adds forward and/or reverse work values and updates the
+        estimates.'''
+        wf = np.asarray(wf, dtype=float)
+        wr = np.asarray(wr, dtype=float)
+        self.wf = np.concatenate([self.wf, wf])
+        self.wr = np.concatenate([self.wr, wr])
+        for c, w in ((1.0, wf), (-1.0, wr)):
+            if len(w) > 0:
+                self._stats[c] = self._update_stats(self._stats[c], w, c)
+        self._update()
+
+    def _update_stats(self, stats, w, c):
+        '''Merges the statistics of a batch of work values (Chan et al.).'''
+        n_a, mean_a, m2_a, lse_a, lse2_a = stats
+        n_b = len(w)
+        mean_b = np.mean(w)
+        m2_b = np.sum((w-mean_b)**2)
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta*n_b/float(n)
+        m2 = m2_a + m2_b + delta**2*n_a*n_b/float(n)
+        lse = np.logaddexp(lse_a, logsumexp(-self.beta*c*w))
+        lse2 = np.logaddexp(lse2_a, logsumexp(-2.*self.beta*c*w))
+        return n, mean, m2, lse, lse2
+
+    def _update(self):
+        beta = self.beta
+        res = {}
+        for c in (1.0, -1.0):
+            n, mean, m2, lse, lse2 = self._stats[c]
+            if n == 0:
+                res[c] = None
+                continue
+            var = m2/(n-1) if n > 1 else 0.
+            # forward: Jarz.calc_dg(w, c=1); reverse: -Jarz.calc_dg(w, c=-1)
+            dg_jarz = -c*(lse - np.log(n))/beta
+            # var(dg) = kT**2 * var(x) / (n * mean(x)**2), x = exp(-beta*c*w)
+            err_jarz = np.sqrt(max(n*np.exp(lse2 - 2.*lse) - 1., 0.) /
+                               (n-1.))/beta if n > 1 else np.nan
+            dg_gauss = mean - c*beta*var*0.5
+            err_gauss = np.sqrt(var/n + np.power(beta*var, 2)/(2.0*(n-1.0))) \
+                if n > 1 else np.nan
+            res[c] = (dg_jarz, err_jarz, dg_gauss, err_gauss, mean,
+                      np.sqrt(m2/n), n)
+        if res[1.0] is not None:
+            (self.dg_jarz_for, self.err_jarz_for, self.dg_gauss_for,
+             self.err_gauss_for) = res[1.0][:4]
+        if res[-1.0] is not None:
+            (self.dg_jarz_rev, self.err_jarz_rev, self.dg_gauss_rev,
+             self.err_gauss_rev) = res[-1.0][:4]
+        if res[1.0] is not None and res[-1.0] is not None:
+            mf, sf, nf = res[1.0][4:]
+            mr, sr, nr = res[-1.0][4:]
+            dg, _ = _cgi_intersect(mf, sf, mr, sr)
+            self.dg_cgi = float(dg)
+            if self.nboots > 0 and nf > 1 and nr > 1:
+                self.err_cgi = Crooks.calc_err_boot1(mf, sf, nf, mr, sr, nr,
+                                                     nboots=self.nboots,
+                                                     seed=self.seed)
+            M = kb * self.T * np.log(float(len(self.wf)) / len(self.wr))
+            if self.solver == 'brentq':
+                self.dg_bar = _bar_solve(self.wf, self.wr, beta, M,
+                                         x0=self.dg_bar)
+            else:
+                self.dg_bar = BAR.calc_dg(self.wf, self.wr, self.T,
+                                          solver=self.solver)
+            self.err_bar = BAR.calc_err(self.dg_bar, self.wf, self.wr, self.T)
+
+
+# ==============================================================================
+#                               BOOTSTRAP
+# ==============================================================================
+# upper bound on the number of resampled values held in memory at once
+BOOT_CHUNK_ELEMENTS = 2**22
+# bootstrap samples per chunk (and per process pool task) for BAR
+BAR_BOOT_CHUNK = 10
+
+
+def bootstrap(func, samples, nboots, seed=None, chunksize=None, n_jobs=1):
+    '''Evaluates a statistic on ``nboots`` bootstrap resamples at once.
+
+    All resampling indices are drawn as (nboots x N) integer matrices and
+    ``func`` is called on the resampled matrices, so that a vectorized
+    statistic processes every bootstrap sample in one pass. The replicates
+    are split into chunks of ``chunksize`` rows to keep memory bounded, and
+    with ``n_jobs`` > 1 the chunks are evaluated in a process pool. Every
+    replicate draws from its own random stream derived from ``seed``, so
+    for a given seed the result depends neither on ``chunksize`` nor on
+    ``n_jobs``.
+
+    Parameters
+    ----------
+    func : callable
+        called as ``func(boot_1, boot_2, ...)`` with one 2-D array of shape
+        (nrows, len(sample_i)) per input sample, each row being one
+        resample. It has to return a 1-D array with the nrows statistics.
+    samples : list of array_like
+        the data sets to resample, e.g. ``[wf]`` or ``[wf, wr]``. Each one is
+        resampled independently.
+    nboots : int
+        number of bootstrap samples.
+    seed : int or numpy random generator, optional
+        seed for the random numbers. Default is None (fresh entropy).
+    chunksize : int, optional
+        number of bootstrap samples evaluated per call to ``func``. Default
+        is chosen such that at most ``BOOT_CHUNK_ELEMENTS`` values are
+        resampled at once.
+    n_jobs : int, optional
+        number of processes. Default is 1 (serial); -1 uses all CPUs.
+        ``func`` needs to be picklable (e.g. a module level function or a
+        functools.partial of one) when n_jobs > 1.
+
+    Returns
+    -------
+    stats : ndarray
+        array of the nboots bootstrapped statistics.
+    '''
+    samples = [np.asarray(w, dtype=float) for w in samples]
+    if chunksize is None:
+        ntot = max(sum(len(w) for w in samples), 1)
+        chunksize = max(BOOT_CHUNK_ELEMENTS // ntot, 1)
+    chunks = [(i, min(i+chunksize, nboots))
+              for i in range(0, nboots, chunksize)]
+    seeds = _spawn_seeds(seed, nboots)
+    tasks = [(func, samples, seeds[start:stop]) for start, stop in chunks]
+
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_bootstrap_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_bootstrap_chunk(t) for t in tasks]
+
+    stats = np.empty(nboots)
+    for (start, stop), res in zip(chunks, results):
+        stats[start:stop] = res
+    return stats
+
+
+def _bootstrap_chunk(task):
+    '''Resamples and evaluates one chunk of bootstrap replicates, each one
+    drawn from the generator of its own seed.'''
+    func, samples, seeds = task
+    idx = [np.empty((len(seeds), len(w)), dtype=np.intp) for w in samples]
+    for i, s in enumerate(seeds):
+        rng = _make_rng(s)
+        for j, w in enumerate(samples):
+            idx[j][i] = _randint(rng, len(w), len(w))
+    return func(*[w[ix] for w, ix in zip(samples, idx)])
+
+
+def spawn_rngs(seed, n):
+    '''Returns ``n`` independent random number generators derived
+    deterministically from ``seed``. NumPy ``Generator`` objects are used
+    when available (NumPy >= 1.17), ``RandomState`` objects otherwise.
+
+    Parameters
+    ----------
+    seed : None, int, array_like or numpy random generator
+        the master seed. If a generator is given, the child seeds are drawn
+        from it.
+    n : int
+        number of generators to return.
+
+    Returns
+    -------
+    rngs : list
+        list of random number generators.
+    '''
+    return [_make_rng(s) for s in _spawn_seeds(seed, n)]
+
+
+def _spawn_seeds(seed, n):
+    '''Derives ``n`` child seeds from ``seed``: ``SeedSequence`` objects
+    when available, integers otherwise. See :func:`_make_rng`.'''
+    if isinstance(seed, np.random.RandomState):
+        return seed.randint(2**31 - 1, size=n)
+    if hasattr(np.random, 'SeedSequence'):
+        if isinstance(seed, np.random.Generator):
+            seed = seed.integers(2**63 - 1, size=4)
+        return np.random.SeedSequence(seed).spawn(n)
+    return np.random.RandomState(seed).randint(2**31 - 1, size=n)
+
+
+def _make_rng(seed):
+    '''Random number generator of a child seed from :func:`_spawn_seeds`.'''
+    if hasattr(np.random, 'SeedSequence') and \
+            isinstance(seed, np.random.SeedSequence):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def _randint(rng, n, size):
+    '''Draws integers in [0, n) from either a Generator or a RandomState.'''
+    if hasattr(rng, 'integers'):
+        return rng.integers(0, n, size=size)
+    return rng.randint(0, n, size=size)
+
+
+def _jarz_dg(w, beta, c):
+    '''Jarzynski free energy along the last axis of ``w`` (a single set of
+    work values or one bootstrap/block sample per row), computed as a
+    log-sum-exp.'''
+    w = np.asarray(w, dtype=float)
+    n = w.shape[-1]
+    return -(logsumexp(-beta*c*w, axis=-1) - np.log(n))/beta
+
+
+def _jarz_fd(w, beta, c):
+    '''Fluctuation-dissipation free energy along the last axis of ``w``.'''
+    w = np.asarray(w, dtype=float)
+    return np.mean(c*w, axis=-1) - beta*np.var(w, axis=-1, ddof=1)/2.0
+
+
+def _bar_dg_rows(bootA, bootB, T, solver='brentq'):
+    '''BAR free energy of each row of resampled forward/reverse work.'''
+    return np.array([BAR.calc_dg(a, b, T, solver=solver)
+                     for a, b in zip(bootA, bootB)])
+
+
+def _bar_conv_rows(bootA, bootB, dg, T):
+    '''BAR convergence measure of each row of resampled forward/reverse work
+    values, see :meth:`BAR.calc_conv`.'''
+    beta = 1./(kb*T)
+    N = float(bootA.shape[1] + bootB.shape[1])
+    ratio_alpha = bootA.shape[1]/N
+    ratio_beta = bootB.shape[1]/N
+    bf = 1.0/(ratio_beta + ratio_alpha * np.exp(beta*(bootA-dg)))
+    tf = 1.0/(ratio_alpha + ratio_beta * np.exp(beta*(-bootB+dg)))
+    Ua = (np.mean(tf, axis=1) + np.mean(bf, axis=1))/2.0
+    Ua2 = (ratio_alpha * np.mean(np.power(tf, 2), axis=1) +
+           ratio_beta * np.mean(np.power(bf, 2), axis=1))
+    return (Ua-Ua2)/Ua
+
+
+def _cgi_intersect(m1, s1, m2, s2):
+    '''Vectorized intersection of two Gaussians, following the choice of
+    root made in :meth:`Crooks.calc_dg`: the root lying between the two
+    means is taken, otherwise the average of the means.
+
+    Returns
+    -------
+    dg : ndarray
+        the intersections (or mean averages).
+    inters : ndarray of bool
+        whether the intersection could be taken.
+    '''
+    m1, s1, m2, s2 = np.broadcast_arrays(*[np.asarray(a, dtype=float)
+                                           for a in (m1, s1, m2, s2)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p1 = m1/s1**2-m2/s2**2
+        p2 = np.sqrt(1/(s1**2*s2**2)*(m1-m2)**2 +
+                     2*(1/s1**2-1/s2**2)*np.log(s2/s1))
+        p3 = 1/s1**2-1/s2**2
+        x1 = (p1+p2)/p3
+        x2 = (p1-p2)/p3
+        ok1 = (x1 > m1) & (x1 < m2) | (x1 > m2) & (x1 < m1)
+        ok2 = (x2 > m1) & (x2 < m2) | (x2 > m2) & (x2 < m1)
+    dg = np.where(ok1, x1, np.where(ok2, x2, (m1 + m2) * 0.5))
+    return dg, ok1 | ok2
+
+
 # ==============================================================================
 #                               FUNCTIONS
 # ==============================================================================
@@ -900,8 +1560,9 @@ def ks_norm_test(data, alpha=0.05, refks=None):
         for normality.
     alpha : float
         significance level of the statistics. Default if 0.05.
-    refks : ???
-        ???
+    refks : list, optional
+        reference table of the Kolmogorov distribution, as (lambda, CDF)
+        pairs. Default is a cached table, see :func:`ks_reference_table`.
 
     Returns
     -------
@@ -910,76 +1571,219 @@ def ks_norm_test(data, alpha=0.05, refks=None):
     check : float
     bOk : bool
     '''
+    Q, lam0, check, bOk = ks_norm_test_many([data], alpha=alpha, refks=refks)
+    return float(Q[0]), lam0, float(check[0]), bool(bOk[0])
 
-    def ksref():
-        f = 1
-        potent = 10000
-        lamb = np.arange(0.25, 2.5, 0.001)
-        q = np.zeros(len(lamb), float)
-        res = []
-        for k in range(-potent, potent):
-            q = q + f*np.exp(-2.0*(k**2)*(lamb**2))
-            f = -f
-        for i in range(len(lamb)):
-            res.append((lamb[i], q[i]))
-        return res
-
-    def ksfunc(lamb):
-        f = 1
-        potent = 10000
-        q = 0
-        for k in range(-potent, potent):
-            q = q + f*np.exp(-2.0*(k**2)*(lamb**2))
-            f *= -1
-        return q
-
-    def edf(dg_data):
-        edf_ = []
-        ndata = []
-        data = deepcopy(dg_data)
-        data.sort()
-        N = float(len(data))
-        cnt = 0
-        for item in data:
-            cnt += 1
-            edf_.append(cnt/N)
-            ndata.append(item)
-        ndata = np.array(ndata)
-        edf_ = np.array(edf_)
-        return ndata, edf_
-
-    def cdf(dg_data):
-        data = deepcopy(dg_data)
-        data.sort()
-        mean = np.average(data)
-        sig = np.std(data)
-        cdf = 0.5*(1+erf((data-mean)/float(sig*np.sqrt(2))))
-        return cdf
-
-    N = len(data)
-    nd, ed = edf(data)
-    cd = cdf(data)
-    siglev = 1-alpha
-    dval = []
-    for i, val in enumerate(ed):
-        d = abs(val-cd[i])
-        dval.append(d)
-        if i:
-            d = abs(ed[i-1]-cd[i])
-            dval.append(d)
-    dmax = max(dval)
-    check = np.sqrt(N)*dmax
-    if not refks:
-        refks = ksref()
-    lst = filter(lambda x: x[1] > siglev, refks)
-    lam0 = lst[0][0]
-    if check >= lam0:
-        bOk = False
+
+def ks_norm_test_many(datasets, alpha=0.05, refks=None):
+    '''Performs the Kolmogorov-Smirnov test of normality of
+    :func:`ks_norm_test` on many distributions at once, e.g. the work values
+    of all edges. The distributions are sorted and compared to their fitted
+    normal CDF as rows of a single (padded) array.
+
+    Parameters
+    ----------
+    datasets : list of array_like
+        the distributions tested for normality; they may differ in length.
+    alpha : float
+        significance level of the statistics. Default if 0.05.
+    refks : list, optional
+        reference table of the Kolmogorov distribution, see
+        :func:`ks_norm_test`.
+
+    Returns
+    -------
+    Q : ndarray
+        probability of a larger deviation from normality (p-value).
+    lam0 : float
+        critical value of sqrt(N)*Dmax at the significance level alpha.
+    check : ndarray
+        sqrt(N)*Dmax of each distribution.
+    bOk : ndarray of bool
+        whether each distribution passes the test.
+    '''
+    n = np.array([len(d) for d in datasets])
+    x = np.full((len(datasets), n.max()), np.nan)
+    for i, d in enumerate(datasets):
+        x[i, :n[i]] = d
+    # NaN padding is sorted to the end of every row
+    x.sort(axis=1)
+    valid = np.arange(x.shape[1]) < n[:, np.newaxis]
+
+    # normal CDF with the mean and standard deviation of each distribution
+    mean = np.nanmean(x, axis=1)[:, np.newaxis]
+    sig = np.nanstd(x, axis=1)[:, np.newaxis]
+    cd = 0.5*(1+erf((x-mean)/(sig*np.sqrt(2))))
+    # empirical CDF, compared to the normal CDF at both ends of every step
+    ed = np.arange(1, x.shape[1]+1) / n[:, np.newaxis].astype(float)
+    d = np.abs(ed-cd)
+    d[:, 1:] = np.maximum(d[:, 1:], np.abs(ed[:, :-1]-cd[:, 1:]))
+    dmax = np.where(valid, d, 0.).max(axis=1)
+    check = np.sqrt(n)*dmax
+
+    if refks is None:
+        lamb, q = ks_reference_table()
     else:
-        bOk = True
+        lamb, q = np.transpose(refks)
+    lam0 = lamb[np.argmax(q > 1-alpha)]
+    bOk = check < lam0
+
+    Q = kolmogorov(check)
+    return Q, lam0, check, bOk
+
+
+_KS_TABLE = []
 
-    q = ksfunc(check)
-    return (1-q), lam0, check, bOk
+
+def ks_reference_table():
+    '''Returns the cumulative Kolmogorov distribution,
+    sum_k (-1)**k exp(-2 k**2 lambda**2), on the grid
+    lambda = 0.25, 0.251, ..., 2.499. It is computed in closed form
+    (scipy.special.kolmogorov) on the first call and cached.
+
+    Returns
+    -------
+    lamb : ndarray
+        the lambda values.
+    q : ndarray
+        the cumulative distribution at lamb.
+    '''
+    if not _KS_TABLE:
+        lamb = np.arange(0.25, 2.5, 0.001)
+        _KS_TABLE.extend([lamb, 1.-kolmogorov(lamb)])
+    return _KS_TABLE[0], _KS_TABLE[1]
+
+
+def convergence(wf, wr, T=None, step=10, nboots=0, solver='brentq',
+                seed=None):
+    '''Free energy estimates and their errors as a function of the number
+    of work values used, i.e. for the prefixes wf[:N], wr[:N] with
+    N = step, 2*step, ... In contrast to rerunning the estimators on every
+    prefix, the curves are obtained in a single pass with a
+    :class:`RunningEstimate`: the Jarzynski and CGI estimates are updated
+    from running sums, and every BAR root search is started from the
+    estimate of the previous prefix.
+
+    Parameters
+    ----------
+    wf : array_like or WorkArchive
+        array of forward work values, or a WorkArchive.
+    wr : array_like
+        array of reverse work values.
+    T : float, optional
+        temperature in Kelvin. Default is that of the WorkArchive, if given,
+        or 298.15 K.
+    step : int, optional
+        number of work values (per direction) added at every point of the
+        curve. Default is 10.
+    nboots : int, optional
+        number of parametric bootstrap samples for the CGI error. Default
+        is 0 (no CGI error).
+    solver : str, optional
+        BAR solver, see :class:`BAR`. Default is 'brentq'.
+    seed : int, optional
+        seed for the CGI parametric bootstrap. Default is None.
+
+    Returns
+    -------
+    conv : dict
+        dictionary of arrays, one entry per prefix: n_for, n_rev (number of
+        work values used), dg_jarz_for, err_jarz_for, dg_jarz_rev,
+        err_jarz_rev, dg_cgi, err_cgi, dg_bar and err_bar. Estimates that
+        are not available (e.g. BAR with one direction only) are NaN.
+    '''
+    wf, wr, T = _unpack_archive(wf, wr, T, default_T=298.15)
+    wf = np.asarray(wf if wf is not None else [], dtype=float)
+    wr = np.asarray(wr if wr is not None else [], dtype=float)
+    keys = ['dg_jarz_for', 'err_jarz_for', 'dg_jarz_rev', 'err_jarz_rev',
+            'dg_cgi', 'err_cgi', 'dg_bar', 'err_bar']
+    conv = dict((k, []) for k in keys + ['n_for', 'n_rev'])
+
+    run = RunningEstimate(T=T, solver=solver, nboots=nboots, seed=seed)
+    for i in range(0, max(len(wf), len(wr)), step):
+        run.add(wf=wf[i:i+step], wr=wr[i:i+step])
+        conv['n_for'].append(len(run.wf))
+        conv['n_rev'].append(len(run.wr))
+        for k in keys:
+            v = getattr(run, k)
+            conv[k].append(np.nan if v is None else v)
+    for k in conv:
+        conv[k] = np.array(conv[k])
+    return conv
+
+
+def _unpack_archive(wf, wr, T=None, default_T=None, require_T=True):
+    '''Returns the forward and reverse work values and the temperature. If
+    wf is a WorkArchive they are taken from it, unless given explicitly.'''
+    if isinstance(wf, WorkArchive):
+        if wr is None:
+            wr = wf.wr
+        if T is None:
+            T = wf.T
+        wf = wf.wf
+    if T is None:
+        T = default_T
+    if T is None and require_T:
+        raise ValueError('the temperature T is required')
+    return wf, wr, T
+
+
+def _bar_residual(x, wf, wr, beta, M):
+    '''Vectorized BAR residual: difference of the summed Fermi functions of
+    the forward and reverse work values. It increases monotonically with x,
+    going from -len(wr) to +len(wf).'''
+    sf = np.sum(expit(-beta*(M+wf-x)))
+    sr = np.sum(expit(beta*(M+wr-x)))
+    return sf - sr
+
+
+def _bar_solve(wf, wr, beta, M, x0=None, xtol=1e-10):
+    '''Solves the implicit BAR equation for the free energy by bracketing
+    the root of :func:`_bar_residual` and refining it with Brent's method.
+
+    Parameters
+    ----------
+    wf : ndarray
+        array of forward work values.
+    wr : ndarray
+        array of reverse work values.
+    beta : float
+        1/kT.
+    M : float
+        kT*log(nf/nr).
+    x0 : float, optional
+        initial guess. Default is the average of the two mean works.
+    xtol : float, optional
+        absolute tolerance on the free energy.
+
+    Returns
+    -------
+    dg : float
+        the BAR free energy estimate.
+    '''
+    if x0 is None:
+        x0 = (np.average(wf) + np.average(wr)) / 2.
+    # the residual is monotonic: step outwards from x0 until it changes sign
+    step = max(np.std(wf), np.std(wr), 1./beta)
+    lo, hi = x0 - step, x0 + step
+    flo = _bar_residual(lo, wf, wr, beta, M)
+    fhi = _bar_residual(hi, wf, wr, beta, M)
+    while flo > 0:
+        hi, fhi = lo, flo
+        step *= 2.
+        lo = lo - step
+        flo = _bar_residual(lo, wf, wr, beta, M)
+    while fhi < 0:
+        lo, flo = hi, fhi
+        step *= 2.
+        hi = hi + step
+        fhi = _bar_residual(hi, wf, wr, beta, M)
+    if flo == 0:
+        return float(lo)
+    if fhi == 0:
+        return float(hi)
+    dg = brentq(_bar_residual, lo, hi, args=(wf, wr, beta, M), xtol=xtol)
+    return float(dg)
 
 
 def data2gauss(data):
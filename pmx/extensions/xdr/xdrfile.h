@@ -64,10 +64,10 @@
  *    three decimals guaranteed accuracy, and reduces the filesize to 1/10th
  *    of normal binary data.
  *
- * We do not support getting or setting positions in XDR files, since it can
- * break in horrible ways for large (64-bit) files, resulting in silent data
- * corruption. Note that it works great to open/read/write 64-bit files if
- * your system supports it; it is just the random access we cannot trust!
+ * Positions in XDR files are only exposed through xdr_tell() and xdr_seek(),
+ * which use 64-bit file offsets. The 32-bit getpos/setpos of the XDR streams
+ * can break in horrible ways for large files, resulting in silent data
+ * corruption, and are not used.
  *
  * We also provide wrapper routines so this module can be used from FORTRAN -
  * see the file xdrfile_fortran.txt in the Gromacs distribution for 
@@ -78,6 +78,8 @@
 #ifndef _XDRFILE_H_
 #define _XDRFILE_H_
 
+#include <stdint.h>
+
 #ifdef __cplusplus
 extern "C" 
 {
@@ -141,6 +143,31 @@ extern "C"
 	xdrfile_close   (XDRFILE *       xfp);
 
 
+	/*! \brief Get the current position in a portable binary file, like ftell()
+	 *
+	 *  \param xfp  Pointer to an abstract XDRFILE datatype
+	 *
+	 *  \return     Offset in bytes from the start of the file (64-bit), or
+	 *              -1 on error.
+	 */
+	int64_t
+	xdr_tell        (XDRFILE *       xfp);
+
+
+	/*! \brief Set the position in a portable binary file, like fseek()
+	 *
+	 *  \param xfp     Pointer to an abstract XDRFILE datatype
+	 *  \param pos     Offset in bytes (64-bit)
+	 *  \param whence  SEEK_SET, SEEK_CUR or SEEK_END
+	 *
+	 *  \return        exdrOK on success, exdrNR on error.
+	 */
+	int
+	xdr_seek        (XDRFILE *       xfp,
+					 int64_t         pos,
+					 int             whence);
+
+
 
 
 	/*! \brief Read one or more \a char type variable(s) 
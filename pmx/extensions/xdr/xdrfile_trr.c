@@ -31,6 +31,7 @@
  * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
  */
 
+#include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 
@@ -496,3 +497,138 @@ int read_trr(XDRFILE *xd,int natoms,int *step,float *t,float *lambda,
 	return do_trn(xd,1,step,t,lambda,box,&natoms,x,v,f);
 }
 
+static int trn_field(XDRFILE *xd,mybool bDouble,int size,float *out,int n)
+/* Read a field of n reals into out, or skip it with a seek if out is NULL.
+   size is the size of the field in the file in bytes, 0 if it is absent. */
+{
+	double *buf;
+	int    i,result=exdrOK;
+
+	if (0 == size)
+		return exdrOK;
+	if (NULL == out)
+		return xdr_seek(xd,size,SEEK_CUR);
+	if (!bDouble)
+		return (xdrfile_read_float(out,n,xd) == n) ? exdrOK : exdrFLOAT;
+
+	if (NULL == (buf = (double *)malloc(n*sizeof(double))))
+		return exdrNOMEM;
+	if (xdrfile_read_double(buf,n,xd) == n)
+	{
+		for(i=0; (i<n); i++)
+			out[i] = buf[i];
+	}
+	else
+		result = exdrDOUBLE;
+	free(buf);
+
+	return result;
+}
+
+int read_trr_fields(XDRFILE *xd,int natoms,int *step,float *t,float *lambda,
+					matrix box,rvec *x,rvec *v,rvec *f,int *has)
+/* Read one frame. Of x, v and f only the fields that are not NULL are
+   decoded, the others are skipped; requested fields that are absent from
+   the frame are zeroed. has gets the fields present (1: x, 2: v, 4: f). */
+{
+	t_trnheader sh;
+	int result;
+
+	if ((result = do_trnheader(xd,1,&sh)) != exdrOK)
+		return result;
+	if (sh.natoms != natoms)
+		return exdrHEADER;
+	*step   = sh.step;
+	*t      = sh.tf;
+	*lambda = sh.lambdaf;
+	*has = ((sh.x_size != 0) ? 1 : 0) | ((sh.v_size != 0) ? 2 : 0) |
+		((sh.f_size != 0) ? 4 : 0);
+
+	if ((result = trn_field(xd,sh.bDouble,sh.box_size,
+							(NULL != box) ? box[0] : NULL,DIM*DIM)) != exdrOK)
+		return result;
+	if ((result = trn_field(xd,sh.bDouble,sh.vir_size,NULL,0)) != exdrOK)
+		return result;
+	if ((result = trn_field(xd,sh.bDouble,sh.pres_size,NULL,0)) != exdrOK)
+		return result;
+	if ((result = trn_field(xd,sh.bDouble,sh.x_size,
+							(NULL != x) ? x[0] : NULL,natoms*DIM)) != exdrOK)
+		return result;
+	if ((result = trn_field(xd,sh.bDouble,sh.v_size,
+							(NULL != v) ? v[0] : NULL,natoms*DIM)) != exdrOK)
+		return result;
+	if ((result = trn_field(xd,sh.bDouble,sh.f_size,
+							(NULL != f) ? f[0] : NULL,natoms*DIM)) != exdrOK)
+		return result;
+
+	if ((NULL != x) && (0 == sh.x_size))
+		memset(x,0,natoms*sizeof(rvec));
+	if ((NULL != v) && (0 == sh.v_size))
+		memset(v,0,natoms*sizeof(rvec));
+	if ((NULL != f) && (0 == sh.f_size))
+		memset(f,0,natoms*sizeof(rvec));
+
+	return exdrOK;
+}
+
+static void gather(rvec *out,rvec *in,const int *sel,int nsel)
+{
+	int j;
+
+	for (j=0; (j<nsel); j++)
+	{
+		out[j][0] = in[sel[j]][0];
+		out[j][1] = in[sel[j]][1];
+		out[j][2] = in[sel[j]][2];
+	}
+}
+
+int read_trr_chunk(XDRFILE *xd,int natoms,int maxframes,int *nread,
+				   int *step,float *t,float *lambda,matrix *box,
+				   rvec *x,rvec *v,rvec *f,int *has,
+				   const int *sel,int nsel)
+/* Read up to maxframes subsequent frames into contiguous arrays. Any of x, v
+   and f can be NULL to skip that field. If sel is not NULL, only the nsel
+   atoms it lists (0-based) are stored. */
+{
+	int i,result=exdrOK;
+	int n = (NULL == sel) ? natoms : nsel;
+	rvec *buf=NULL,*xi,*vi,*fi;
+
+	if (NULL != sel)
+	{
+		buf = (rvec *)malloc(3*(size_t)natoms*sizeof(rvec));
+		if (NULL == buf)
+			return exdrNOMEM;
+	}
+	for (i=0; (i<maxframes); i++)
+	{
+		xi = (NULL == x) ? NULL : x+(size_t)i*n;
+		vi = (NULL == v) ? NULL : v+(size_t)i*n;
+		fi = (NULL == f) ? NULL : f+(size_t)i*n;
+		if (NULL == sel)
+			result = read_trr_fields(xd,natoms,step+i,t+i,lambda+i,box[i],
+									 xi,vi,fi,has+i);
+		else
+			result = read_trr_fields(xd,natoms,step+i,t+i,lambda+i,box[i],
+									 (NULL == x) ? NULL : buf,
+									 (NULL == v) ? NULL : buf+natoms,
+									 (NULL == f) ? NULL : buf+2*natoms,
+									 has+i);
+		if (result != exdrOK)
+			break;
+		if (NULL != sel)
+		{
+			if (NULL != xi)
+				gather(xi,buf,sel,nsel);
+			if (NULL != vi)
+				gather(vi,buf+natoms,sel,nsel);
+			if (NULL != fi)
+				gather(fi,buf+2*natoms,sel,nsel);
+		}
+	}
+	free(buf);
+	*nread = i;
+
+	return result;
+}
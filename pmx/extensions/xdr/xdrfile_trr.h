@@ -51,6 +51,24 @@ extern "C" {
   extern int read_trr(XDRFILE *xd,int natoms,int *step,float *t,float *lambda,
 		      matrix box,rvec *x,rvec *v,rvec *f);
 
+  /* Read one frame of an open trr file, decoding only the fields among
+     x, v and f that are not NULL and skipping the others. Requested fields
+     that are absent from the frame are zeroed. *has gets the fields present
+     in the frame (1: x, 2: v, 4: f). */
+  extern int read_trr_fields(XDRFILE *xd,int natoms,int *step,float *t,
+			     float *lambda,matrix box,rvec *x,rvec *v,rvec *f,
+			     int *has);
+
+  /* Read up to maxframes frames of an open trr file into arrays of
+     maxframes elements (x, v, f: maxframes*natoms, any of them NULL to skip
+     the field). If sel is not NULL only the nsel atoms it lists (0-based)
+     are stored (x, v, f: maxframes*nsel). The number of frames read is
+     returned in *nread. */
+  extern int read_trr_chunk(XDRFILE *xd,int natoms,int maxframes,int *nread,
+			    int *step,float *t,float *lambda,matrix *box,
+			    rvec *x,rvec *v,rvec *f,int *has,
+			    const int *sel,int nsel);
+
   /* Write a frame to xtc file */
   extern int write_trr(XDRFILE *xd,int natoms,int step,float t,float lambda,
 		       matrix box,rvec *x,rvec *v,rvec *f);
@@ -118,6 +118,44 @@ int read_xtc(XDRFILE *xd,
 	return exdrOK;
 }
 
+int read_xtc_chunk(XDRFILE *xd,int natoms,int maxframes,int *nread,
+				   int *step,float *time,matrix *box,rvec *x,float *prec,
+				   const int *sel,int nsel)
+/* Read up to maxframes subsequent frames into contiguous arrays. If sel is
+   not NULL, only the nsel atoms it lists (0-based) are stored in x. */
+{
+	int i,j,result=exdrOK;
+	rvec *buf=NULL,*xi;
+
+	if (NULL != sel)
+	{
+		buf = (rvec *)malloc(natoms*sizeof(rvec));
+		if (NULL == buf)
+			return exdrNOMEM;
+	}
+	for (i=0; (i<maxframes); i++)
+	{
+		xi = (NULL == sel) ? x+(size_t)i*natoms : buf;
+		result = read_xtc(xd,natoms,step+i,time+i,box[i],xi,prec+i);
+		if (result != exdrOK)
+			break;
+		if (NULL != sel)
+		{
+			xi = x+(size_t)i*nsel;
+			for (j=0; (j<nsel); j++)
+			{
+				xi[j][0] = buf[sel[j]][0];
+				xi[j][1] = buf[sel[j]][1];
+				xi[j][2] = buf[sel[j]][2];
+			}
+		}
+	}
+	free(buf);
+	*nread = i;
+
+	return result;
+}
+
 int write_xtc(XDRFILE *xd,
 			  int natoms,int step,float time,
 			  matrix box,rvec *x,float prec)
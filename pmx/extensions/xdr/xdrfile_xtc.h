@@ -51,6 +51,15 @@ extern "C" {
   extern int read_xtc(XDRFILE *xd,int natoms,int *step,float *time,
 		      matrix box,rvec *x,float *prec);
   
+  /* Read up to maxframes frames of an open xtc file into arrays of
+     maxframes elements (x: maxframes*natoms). If sel is not NULL only the
+     nsel atoms it lists (0-based) are stored (x: maxframes*nsel). The
+     number of frames read is returned in *nread; the return value is
+     exdrENDOFFILE if the file ended first. */
+  extern int read_xtc_chunk(XDRFILE *xd,int natoms,int maxframes,int *nread,
+			    int *step,float *time,matrix *box,rvec *x,
+			    float *prec,const int *sel,int nsel);
+  
   /* Write a frame to xtc file */
   extern int write_xtc(XDRFILE *xd,
 		       int natoms,int step,float time,
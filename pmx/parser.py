@@ -45,7 +45,26 @@ Usage:
 """
 
 import sys
+import re
+import gzip
+import bz2
+import json
+import itertools
+import numpy as np
 from odict import *
+try:
+    import lzma
+except ImportError:
+    # not part of the python 2 standard library
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# raised when reading a truncated compressed file
+_DECOMPRESS_ERRORS = (IOError, EOFError)
+if lzma is not None:
+    _DECOMPRESS_ERRORS += (lzma.LZMAError,)
 
 class ParserError(Exception):
     def __init__(self, s):
@@ -128,6 +147,41 @@ def read_and_format(filename, format_string, comment = '#', ignore_missing = Fal
 
 
 
+def open_file( fn, mode = 'r' ):
+    """Opens a file for reading or writing text, transparently handling gzip
+    (.gz), bzip2 (.bz2) and xz (.xz) compressed files by their extension.
+    The data are (de)compressed on the fly, without temporary files.
+
+    Parameters
+    ----------
+    fn : str
+        the file name.
+    mode : str, optional
+        'r' (default), 'w' or 'a'.
+
+    Returns
+    -------
+    fp : file object
+    """
+    if sys.version_info[0] < 3:
+        # python 2 compressed files return str in binary mode
+        zmode = mode + 'b'
+    else:
+        zmode = mode + 't'
+    if fn.endswith('.gz'):
+        return gzip.open(fn, zmode)
+    elif fn.endswith('.bz2'):
+        if sys.version_info[0] < 3:
+            return bz2.BZ2File(fn, zmode)
+        return bz2.open(fn, zmode)
+    elif fn.endswith('.xz'):
+        if lzma is None:
+            raise ImportError("Cannot read %s: the lzma module is not "
+                              "available (pip install backports.lzma)" % fn)
+        return lzma.open(fn, zmode)
+    return open(fn, mode)
+
+
 #=================================================
 # some file format parsers frequently needed
 
@@ -150,17 +204,339 @@ def read_fasta( fn ):
 
 
 def read_xvg( fn,  style='xy'):
-    l = open(fn).readlines()
-    l = kickOutComments(l,'@')
-    l = kickOutComments(l,'#')
-    l = kickOutComments(l,'&')
-    res = parseList('ff', l)
+    data = read_xvg_array(fn)
+    if data.size and data.shape[1] != 2:
+        __parse_error("Cannot convert line into format: ff", fn)
     if style == 'list':
-        return res
+        return data.tolist()
     else:
-        x = map(lambda a: a[0],  res)        
-        y = map(lambda a: a[1],  res)
+        x = data[:,0].tolist()
+        y = data[:,1].tolist()
         return x,  y
 
 
+def read_xvg_array( fn, columns = None ):
+    """Reads the numeric block of an xvg file into a 2-D float array.
+
+    Header and set separator lines (starting with #, @ or &) are skipped and
+    the remaining lines are converted in one bulk call rather than line by
+    line. A ParserError is raised if the block is not rectangular, e.g.
+    because the last line of the file was cut off. Compressed files are
+    decompressed on the fly (see :func:`open_file`) and binary dH/dl files
+    are recognised by their magic string.
+
+    Parameters
+    ----------
+    fn : str
+        the xvg file.
+    columns : int or list of int, optional
+        columns to return. An integer returns a 1-D array of that column.
+        The file is then read in chunks (see :func:`iter_xvg_array`), so
+        the other columns are only held in memory for one chunk. Default is
+        all columns.
+
+    Returns
+    -------
+    data : ndarray
+        array of shape (nlines, ncolumns), or (nlines,) for a single column.
+        For binary dH/dl files (see :func:`write_dhdl_bin`) this is a
+        read-only view of the memory mapped file.
+    """
+    if is_dhdl_bin(fn):
+        data = read_dhdl_bin(fn)[0]
+        if columns is not None:
+            data = data[:,columns]
+        return data
+    if columns is not None:
+        chunks = list(iter_xvg_array(fn, columns))
+        if not chunks:
+            return np.empty((0,) + np.shape(columns))
+        return np.concatenate(chunks)
+    with open_file(fn) as fp:
+        lines = list(_xvg_lines(fn, fp))
+    ncols = len(lines[0].split()) if lines else 0
+    return _lines2array(fn, lines, ncols, columns)
+
+
+def iter_xvg_array( fn, columns = None, chunksize = 100000 ):
+    """Reads the numeric block of an xvg file in chunks of lines, so that
+    only one chunk is held in memory at any time. Header and set separator
+    lines are skipped as in :func:`read_xvg_array`, and a ParserError is
+    raised as soon as a chunk is not rectangular or the number of columns
+    changes.
+
+    Parameters
+    ----------
+    fn : str
+        the xvg file.
+    columns : int or list of int, optional
+        columns to return. Default is all columns.
+    chunksize : int, optional
+        number of lines read at once. Default is 100000.
+
+    Yields
+    ------
+    data : ndarray
+        array of shape (nlines, ncolumns), or (nlines,) for a single column,
+        with nlines <= chunksize.
+    """
+    if is_dhdl_bin(fn):
+        data = read_dhdl_bin(fn)[0]
+        if columns is not None:
+            data = data[:,columns]
+        for i in range(0, len(data), chunksize):
+            yield np.asarray(data[i:i+chunksize], dtype=float)
+        return
+    ncols = None
+    with open_file(fn) as fp:
+        data_lines = _xvg_lines(fn, fp)
+        while True:
+            lines = list(itertools.islice(data_lines, chunksize))
+            if not lines:
+                break
+            ncols = _check_ncols(fn, lines, ncols)
+            yield _lines2array(fn, lines, ncols, columns)
+
+
+def _xvg_lines( fn, fp ):
+    # data lines of an xvg file, skipping header and set separators
+    try:
+        for l in fp:
+            if l[:1] not in '#@&' and l.strip():
+                yield l
+    except _DECOMPRESS_ERRORS as e:
+        raise ParserError("Cannot read %s: %s (incomplete file?)" % (fn, e))
+
+
+def _check_ncols(fn, lines, ncols):
+    n = len(lines[0].split())
+    if ncols is not None and n != ncols:
+        raise ParserError("Number of columns in %s changes from %d to %d "
+                          "(incomplete file?)" % (fn, ncols, n))
+    return n
+
+
+def _lines2array(fn, lines, ncols, columns):
+    data = np.fromstring(''.join(lines), dtype=float, sep=' ')
+    if data.size != len(lines)*ncols:
+        raise ParserError("Cannot convert %s into a %d column array "
+                          "(incomplete file?)" % (fn, ncols))
+    data = data.reshape(len(lines), ncols)
+    if columns is None:
+        return data
+    try:
+        # a copy, so that the rest of the chunk is not kept alive
+        return np.array(data[:,columns])
+    except IndexError:
+        raise ParserError("%s has only %d columns" % (fn, ncols))
+
+
+def read_dhdl_foreign( fn ):
+    """Reads the energy differences to the foreign lambda states from a
+    dhdl.xvg file written by Gromacs with calc-lambda-neighbors (e.g. -1 for
+    all states), as needed by multistate estimators like MBAR.
+
+    The columns are identified by their legends: the Delta H columns are
+    labelled "\\xD\\f{}H \\xl\\f{} to <lambda>". Columns with the
+    total energy, dH/dl and pV are skipped; the temperature and the index
+    of the simulated state are taken from the subtitle, if present.
+
+    Parameters
+    ----------
+    fn : str
+        the dhdl.xvg file (possibly compressed).
+
+    Returns
+    -------
+    time : ndarray
+        the time of each frame.
+    dh : ndarray
+        (nframes x nstates) energy differences H_k - H_sim in kJ/mol.
+    lambdas : list of tuple
+        the lambda values of the foreign states.
+    state : int or None
+        index of the simulated state among the foreign states.
+    T : float or None
+        the temperature in Kelvin.
+    """
+    legends = {}
+    subtitle = ''
+    with open_file(fn) as fp:
+        for l in fp:
+            if l[:1] not in '#@':
+                break
+            if not l.startswith('@'):
+                continue
+            entr = l[1:].split(None, 2)
+            if len(entr) == 3 and entr[1] == 'legend' and entr[0][:1] == 's':
+                legends[int(entr[0][1:])] = entr[2].strip().strip('"')
+            elif entr and entr[0] == 'subtitle':
+                subtitle = l[1:].split(None, 1)[1].strip().strip('"')
+    cols = []
+    lambdas = []
+    for i in sorted(legends):
+        m = re.match(r'\\xD\\f\{\}H \\xl\\f\{\}(?: to)? (.*)',
+                     legends[i])
+        if m is not None:
+            cols.append(i + 1)
+            lambdas.append(tuple(float(v) for v in
+                                 re.findall(r'[-+]?\d*\.?\d+', m.group(1))))
+    if not cols:
+        raise ParserError("No foreign lambda columns found in %s" % fn)
+    data = read_xvg_array(fn)
+    T = None
+    m = re.search(r'T = ([\d.]+)', subtitle)
+    if m is not None:
+        T = float(m.group(1))
+    state = None
+    m = re.search(r'state (\d+)', subtitle)
+    if m is not None:
+        state = int(m.group(1))
+    else:
+        # single lambda component: "T = 298 (K) \xl\f{} = 0.2000"
+        m = re.search(r'= ([-+\d.]+)$', subtitle)
+        if m is not None and (float(m.group(1)),) in lambdas:
+            state = lambdas.index((float(m.group(1)),))
+    return data[:,0], np.array(data[:,cols]), lambdas, state, T
+
+
+# binary dH/dl container
+# ----------------------
+DHDL_BIN_MAGIC = b'PMXDHDL1'
+DHDL_BIN_ALIGN = 64
+
+
+def is_dhdl_bin( fn ):
+    """Returns True if fn is a binary dH/dl file written by
+    :func:`write_dhdl_bin`. Compressed files are never binary dH/dl files.
+    """
+    if fn.endswith(('.gz', '.bz2', '.xz')):
+        return False
+    try:
+        with open(fn, 'rb') as fp:
+            return fp.read(len(DHDL_BIN_MAGIC)) == DHDL_BIN_MAGIC
+    except IOError:
+        return False
+
+
+def write_dhdl_bin( fn, data, legends = None, meta = None ):
+    """Writes a time series, e.g. the time and dH/dl columns of a dhdl.xvg
+    file, to a compact binary file that can be read back without copying
+    by memory mapping it (:func:`read_dhdl_bin`).
+
+    The file consists of the magic string PMXDHDL1, the length of the header
+    as a little endian uint32, a JSON header with the shape, column legends
+    and any metadata, padding up to a multiple of 64 bytes, and the data as
+    little endian float32 in row-major order.
+
+    Parameters
+    ----------
+    fn : str
+        the output file.
+    data : array_like
+        array of shape (nframes, ncolumns).
+    legends : list of str, optional
+        names of the columns.
+    meta : dict, optional
+        additional JSON serialisable metadata, e.g. the temperature or the
+        source file.
+    """
+    data = np.ascontiguousarray(data, dtype='<f4')
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    header = {'nframes': data.shape[0],
+              'ncolumns': data.shape[1],
+              'dtype': '<f4',
+              'legends': list(legends) if legends is not None else [],
+              'meta': meta if meta is not None else {}}
+    header = json.dumps(header).encode('utf-8')
+    pre = len(DHDL_BIN_MAGIC) + 4
+    pad = (-(pre + len(header))) % DHDL_BIN_ALIGN
+    header += b' ' * pad
+    with open(fn, 'wb') as fp:
+        fp.write(DHDL_BIN_MAGIC)
+        fp.write(np.array(len(header), dtype='<u4').tobytes())
+        fp.write(header)
+        fp.write(data.tobytes())
+
+
+def read_dhdl_bin( fn ):
+    """Reads a binary dH/dl file written by :func:`write_dhdl_bin`.
+
+    Parameters
+    ----------
+    fn : str
+        the binary file.
+
+    Returns
+    -------
+    data : numpy.memmap
+        read-only array of shape (nframes, ncolumns) mapped onto the file.
+    header : dict
+        the header, with the keys nframes, ncolumns, legends and meta.
+
+    A ParserError is raised if the header cannot be read or the file is
+    shorter than the header says, e.g. because it was cut off.
+    """
+    with open(fn, 'rb') as fp:
+        if fp.read(len(DHDL_BIN_MAGIC)) != DHDL_BIN_MAGIC:
+            raise ParserError("%s is not a binary dH/dl file" % fn)
+        raw = fp.read(4)
+        if len(raw) != 4:
+            raise ParserError("%s: truncated header (incomplete file?)" % fn)
+        nhead = int(np.frombuffer(raw, dtype='<u4')[0])
+        raw = fp.read(nhead)
+        if len(raw) != nhead:
+            raise ParserError("%s: truncated header (incomplete file?)" % fn)
+        try:
+            header = json.loads(raw.decode('utf-8'))
+            shape = (int(header['nframes']), int(header['ncolumns']))
+            dtype = np.dtype(header['dtype'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ParserError("%s: invalid header (%s)" % (fn, e))
+        fp.seek(0, 2)
+        size = fp.tell()
+    offset = len(DHDL_BIN_MAGIC) + 4 + nhead
+    nbytes = shape[0] * shape[1] * dtype.itemsize
+    if size < offset + nbytes:
+        raise ParserError("%s has %d bytes of data, should be %d "
+                          "(incomplete file?)" % (fn, size - offset, nbytes))
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype), header
+    data = np.memmap(fn, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return data, header
+
+
+def xvg_to_dhdl_bin( fn, outfn, meta = None ):
+    """Converts a (possibly compressed) xvg file into a binary dH/dl file,
+    keeping the axis labels and the legends of the data sets found in the
+    xvg header.
 
+    Parameters
+    ----------
+    fn : str
+        the input xvg file.
+    outfn : str
+        the output binary file.
+    meta : dict, optional
+        additional metadata to store.
+    """
+    legends = []
+    info = {'source': fn}
+    with open_file(fn) as fp:
+        for l in fp:
+            if not l.startswith('@'):
+                if l[:1] != '#':
+                    break
+                continue
+            entr = l[1:].split(None, 2)
+            if len(entr) < 3:
+                continue
+            if entr[1] == 'legend':
+                legends.append(entr[2].strip().strip('"'))
+            elif entr[0] in ('xaxis', 'yaxis') and entr[1] == 'label':
+                info[entr[0]] = entr[2].strip().strip('"')
+    data = read_xvg_array(fn)
+    if meta is not None:
+        info.update(meta)
+    write_dhdl_bin(outfn, data, legends=legends, meta=info)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# pmx  Copyright Notice
+# ============================
+#
+# The pmx source code is copyrighted, but you can freely use and
+# copy it as long as you don't change or remove any of the copyright
+# notices.
+#
+# ----------------------------------------------------------------------
+# pmx is Copyright (C) 2006-2017 by Daniel Seeliger
+#
+#                        All Rights Reserved
+#
+# Permission to use, copy, modify, distribute, and distribute modified
+# versions of this software and its documentation for any purpose and
+# without fee is hereby granted, provided that the above copyright
+# notice appear in all copies and that both the copyright notice and
+# this permission notice appear in supporting documentation, and that
+# the name of Daniel Seeliger not be used in advertising or publicity
+# pertaining to distribution of the software without specific, written
+# prior permission.
+#
+# DANIEL SEELIGER DISCLAIMS ALL WARRANTIES WITH REGARD TO THIS
+# SOFTWARE, INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS.  IN NO EVENT SHALL DANIEL SEELIGER BE LIABLE FOR ANY
+# SPECIAL, INDIRECT OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+# ----------------------------------------------------------------------
+
+from __future__ import print_function, division
+from pmx.parser import read_and_format
+from pmx.estimators import Jarz, Crooks, BAR
+from analyze_dhdl import parse_dgdl_files, natural_sort, time_stats
+from cli import check_unknown_cmd
+import os
+import time
+import glob
+import multiprocessing
+import argparse
+import numpy as np
+
+# Constants
+kb = 0.00831447215   # kJ/(K*mol)
+# dgdl files picked up from the directories listed in a manifest
+DHDL_EXTENSIONS = ['.xvg', '.xvg.gz', '.xvg.bz2', '.xvg.xz', '.dhdl.bin']
+
+
+# ==============================================================================
+#                               FUNCTIONS
+# ==============================================================================
+def read_manifest(fn):
+    '''Reads a manifest of the edges to analyse. Every non-comment line holds
+    four columns: the edge name, the leg (e.g. water or protein), and the
+    forward and reverse dgdl.xvg files, each given as a glob pattern or as
+    a directory containing the dgdl.xvg files (plain, compressed or binary,
+    see :data:`DHDL_EXTENSIONS`):
+
+    # edge   leg      forward               reverse
+    26_44    water    26_44/water/stateA    26_44/water/stateB/dhdl*.xvg
+
+    Relative paths are taken relative to the directory of the manifest.
+
+    Parameters
+    ----------
+    fn : str
+        the manifest file.
+
+    Returns
+    -------
+    tasks : list
+        list of (edge, leg, forward files, reverse files) tuples.
+    '''
+    root = os.path.dirname(os.path.abspath(fn))
+    tasks = []
+    for edge, leg, fA, fB in read_and_format(fn, 'ssss'):
+        tasks.append((edge, leg, _expand(fA, root), _expand(fB, root)))
+    return tasks
+
+
+def _expand(pattern, root):
+    pattern = os.path.join(root, pattern)
+    if os.path.isdir(pattern):
+        files = []
+        for ext in DHDL_EXTENSIONS:
+            files += glob.glob(os.path.join(pattern, '*' + ext))
+        return natural_sort(files)
+    return natural_sort(glob.glob(pattern))
+
+
+def analyze_edge(task):
+    '''Integrates the dgdl.xvg files of one edge and leg and runs the
+    estimators on them.
+
+    Parameters
+    ----------
+    task : tuple
+        (edge, leg, forward files, reverse files, options) where options is
+        a dict with the keys T, methods, nboots, seed, reverseB, solver.
+
+    Returns
+    -------
+    res : dict
+        the estimates, keyed by column name (see :func:`_columns`). If the
+        analysis fails, e.g. because of an unreadable file, the error is
+        stored under 'error' instead of aborting the whole batch.
+    '''
+    edge, leg, filesAB, filesBA, opt = task
+    res = {'edge': edge, 'leg': leg}
+    try:
+        _analyze_edge(res, filesAB, filesBA, opt)
+    except Exception as e:
+        res['error'] = ' '.join(('%s: %s' % (type(e).__name__, e)).split())
+        print(' !! Error in %s %s: %s' % (edge, leg, res['error']))
+    return res
+
+
+def _analyze_edge(res, filesAB, filesBA, opt):
+    T = opt['T']
+    nboots = opt['nboots']
+    wf = parse_dgdl_files(filesAB, lambda0=0, invert_values=False)
+    wr = parse_dgdl_files(filesBA, lambda0=1, invert_values=opt['reverseB'])
+    res['nA'] = len(wf)
+    res['nB'] = len(wr)
+    if len(wf) < 2 or len(wr) < 2:
+        print(' !! Skipping %s %s: not enough work values'
+              % (res['edge'], res['leg']))
+        return
+
+    if 'bar' in opt['methods']:
+        bar = BAR(wf, wr, T=T, nboots=nboots, solver=opt['solver'],
+                  seed=opt['seed'])
+        res['dG_bar'] = bar.dg
+        res['err_bar'] = bar.err
+        res['conv_bar'] = bar.conv
+        if nboots > 0:
+            res['errboot_bar'] = bar.err_boot
+    if 'cgi' in opt['methods']:
+        cgi = Crooks(wf, wr, nboots=nboots, seed=opt['seed'])
+        res['dG_cgi'] = cgi.dg
+        res['err_cgi'] = cgi.err_boot1
+        if nboots > 0:
+            res['errboot_cgi'] = cgi.err_boot2
+    if 'jarz' in opt['methods']:
+        jarz = Jarz(wf, wr, T=T, nboots=nboots, seed=opt['seed'])
+        res['dG_jarz'] = jarz.dg_mean
+        if nboots > 0:
+            res['errboot_jarz'] = 0.5*np.sqrt(jarz.err_boot_for**2 +
+                                              jarz.err_boot_rev**2)
+
+
+def _columns(methods):
+    cols = ['edge', 'leg', 'nA', 'nB']
+    if 'bar' in methods:
+        cols += ['dG_bar', 'err_bar', 'errboot_bar', 'conv_bar']
+    if 'cgi' in methods:
+        cols += ['dG_cgi', 'err_cgi', 'errboot_cgi']
+    if 'jarz' in methods:
+        cols += ['dG_jarz', 'errboot_jarz']
+    return cols + ['error']
+
+
+def calc_ddg(results, legs, methods):
+    '''Computes ddG = dG(legs[1]) - dG(legs[0]) for every edge and method.
+    The errors are propagated from the bootstrap errors if available, from
+    the analytical ones otherwise.
+
+    Returns
+    -------
+    rows : list
+        list of (edge, method, ddG, err) tuples.
+    '''
+    byedge = {}
+    for r in results:
+        byedge.setdefault(r['edge'], {})[r['leg']] = r
+    rows = []
+    for edge in natural_sort(list(byedge.keys())):
+        d = byedge[edge]
+        if legs[0] not in d or legs[1] not in d:
+            continue
+        for m in methods:
+            key = 'dG_%s' % m
+            if key not in d[legs[0]] or key not in d[legs[1]]:
+                continue
+            ddg = d[legs[1]][key] - d[legs[0]][key]
+            err = np.nan
+            for ekey in ('errboot_%s' % m, 'err_%s' % m):
+                if ekey in d[legs[0]] and ekey in d[legs[1]]:
+                    err = np.sqrt(d[legs[0]][ekey]**2 + d[legs[1]][ekey]**2)
+                    break
+            rows.append((edge, m, ddg, err))
+    return rows
+
+
+def _fmt(v, prec):
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (int, np.integer)):
+        return '%d' % v
+    return '{0:.{p}f}'.format(v, p=prec)
+
+
+# ==============================================================================
+#                      COMMAND LINE OPTIONS AND MAIN
+# ==============================================================================
+def parse_options():
+
+    parser = argparse.ArgumentParser(description='Calculates free energies '
+            'from fast growth thermodynamic integration simulations for many '
+            'edges and legs of a perturbation network in a single process. '
+            'The edges are listed in a manifest file with four columns: '
+            'edge name, leg, forward dgdl.xvg files and reverse dgdl.xvg '
+            'files, the latter two given as glob patterns or directories.')
+
+    parser.add_argument('-i',
+                        metavar='manifest',
+                        dest='manifest',
+                        type=str,
+                        help='Manifest file listing the edges, legs and '
+                        'their dgdl.xvg files.',
+                        required=True)
+    parser.add_argument('-o',
+                        metavar='result file',
+                        dest='outfn',
+                        type=str,
+                        help='Table with the results for every edge and leg. '
+                        'Default is "results_batch.dat".',
+                        default='results_batch.dat')
+    parser.add_argument('-oddg',
+                        metavar='ddg file',
+                        dest='ddgfn',
+                        type=str,
+                        help='Table with the ddG values of every edge. '
+                        'Default is "ddg_batch.dat".',
+                        default='ddg_batch.dat')
+    parser.add_argument('--legs',
+                        metavar='',
+                        dest='legs',
+                        type=str,
+                        help='The two legs used for ddG = dG(second) - '
+                        'dG(first). Default is "water protein".',
+                        default=['water', 'protein'],
+                        nargs=2)
+    parser.add_argument('-m',
+                        metavar='method',
+                        type=str.lower,
+                        dest='methods',
+                        help='Choose one or more estimators to use from the '
+                        'available ones: CGI, BAR, JARZ. Default is all.',
+                        default=['cgi', 'bar', 'jarz'],
+                        nargs='+')
+    parser.add_argument('-t',
+                        metavar='temperature',
+                        dest='temperature',
+                        type=float,
+                        help='Temperature in Kelvin. Default is 298.15.',
+                        default=298.15)
+    parser.add_argument('-b',
+                        metavar='nboots',
+                        dest='nboots',
+                        type=int,
+                        help='Number of bootstrap samples to use for the '
+                        'bootstrap estimate of the standard errors. Default '
+                        'is 0 (no bootstrap).',
+                        default=0)
+    parser.add_argument('--seed',
+                        metavar='',
+                        dest='seed',
+                        type=int,
+                        help='Seed for the bootstrap random number '
+                        'generator. Default is None (random seed).',
+                        default=None)
+    parser.add_argument('--nproc',
+                        metavar='',
+                        dest='nproc',
+                        type=int,
+                        help='Number of processes; each process analyses one '
+                        'edge and leg at a time. Default is 1.',
+                        default=1)
+    parser.add_argument('--bar_solver',
+                        metavar='',
+                        dest='bar_solver',
+                        type=str.lower,
+                        help='How to solve the BAR equation, "brentq" or '
+                        '"simplex". Default is "brentq".',
+                        default='brentq',
+                        choices=['brentq', 'simplex'])
+    parser.add_argument('--reverseB',
+                        dest='reverseB',
+                        help='Whether to reverse the work values for the '
+                        'backward (B->A) transformation. Default is False.',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--units',
+                        metavar='',
+                        dest='units',
+                        type=str.lower,
+                        help='The units of the output. Choose from "kJ", '
+                        '"kcal", "kT". Default is "kJ."',
+                        default='kJ',
+                        choices=['kj', 'kcal', 'kt'])
+    parser.add_argument('--prec',
+                        metavar='',
+                        dest='precision',
+                        type=int,
+                        help='The decimal precision of the file output.'
+                        ' Default is 2.',
+                        default=2)
+
+    args, unknown = parser.parse_known_args()
+    check_unknown_cmd(unknown)
+
+    from pmx import __version__
+    args.pmx_version = __version__
+
+    return args
+
+
+def main(args):
+    """Run the main script.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments
+    """
+
+    stime = time.time()
+    T = args.temperature
+    prec = args.precision
+    methods = args.methods
+
+    units = args.units
+    if units == 'kj':
+        unit_fact = 1.
+        units = 'kJ/mol'
+    elif units == 'kcal':
+        unit_fact = 1./4.184
+        units = 'kcal/mol'
+    elif units == 'kt':
+        unit_fact = 1./(kb*T)
+        units = 'kT'
+
+    opt = {'T': T, 'methods': methods, 'nboots': args.nboots,
+           'seed': args.seed, 'reverseB': args.reverseB,
+           'solver': args.bar_solver}
+    tasks = [t + (opt,) for t in read_manifest(args.manifest)]
+    print('  %d edges/legs to analyse' % len(tasks))
+
+    pool = None
+    if args.nproc > 1:
+        pool = multiprocessing.Pool(args.nproc)
+        edges = pool.imap(analyze_edge, tasks, chunksize=1)
+    else:
+        edges = (analyze_edge(t) for t in tasks)
+
+    # results per edge and leg, written as they come in
+    cols = _columns(methods)
+    results = []
+    try:
+        with open(args.outfn, 'w') as out:
+            print("# analyze_batch.py, pmx version = %s" % args.pmx_version,
+                  file=out)
+            print("# manifest = %s" % os.path.abspath(args.manifest),
+                  file=out)
+            print("# %s (%s)" % (time.asctime(), os.environ.get('USER')),
+                  file=out)
+            print("# units = %s, T = %.2f K" % (units, T), file=out)
+            print('# ' + '\t'.join(cols), file=out)
+            for r in edges:
+                results.append(r)
+                row = []
+                for c in cols:
+                    if c == 'error':
+                        row.append(r.get(c, '-'))
+                        continue
+                    v = r.get(c, np.nan)
+                    if c.startswith('dG') or c.startswith('err'):
+                        v = v*unit_fact
+                    row.append(_fmt(v, prec))
+                print('\t'.join(row), file=out)
+                out.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    nfail = len([r for r in results if 'error' in r])
+    if nfail > 0:
+        print(' !! %d of %d edges/legs failed, see %s'
+              % (nfail, len(results), args.outfn))
+
+    # ddG across legs
+    with open(args.ddgfn, 'w') as out:
+        print("# ddG = dG(%s) - dG(%s), units = %s"
+              % (args.legs[1], args.legs[0], units), file=out)
+        print('# edge\tmethod\tddG\terr', file=out)
+        for edge, m, ddg, err in calc_ddg(results, args.legs, methods):
+            print('\t'.join([edge, m, _fmt(ddg*unit_fact, prec),
+                             _fmt(err*unit_fact, prec)]), file=out)
+
+    h, m, s = time_stats(time.time()-stime)
+    print("\n   Execution time = %02d:%02d:%02d\n" % (h, m, s))
+
+
+def entry_point():
+    args = parse_options()
+    main(args)
+
+
+if __name__ == '__main__':
+    entry_point()
@@ -30,21 +30,31 @@
 # ----------------------------------------------------------------------
 
 from __future__ import print_function, division
-from pmx.parser import read_and_format
+from pmx.parser import read_and_format, read_xvg_array, iter_xvg_array
+from pmx.parser import ParserError
 from pmx.estimators import Jarz, JarzGauss, Crooks, BAR, data2gauss, ks_norm_test
+from pmx.estimators import RunningEstimate, convergence
+from pmx.workarchive import WorkArchive
 import sys
 import os
 import time
 import re
-from matplotlib import pyplot as plt
+import glob
 import numpy as np
 from scipy.integrate import simps
 import pickle
 import argparse
+import multiprocessing
+import hashlib
+import json
+from functools import partial
 from cli import check_unknown_cmd
 
 # Constants
 kb = 0.00831447215   # kJ/(K*mol)
+# bounds on the dH/dl traces held in memory at once by parse_dgdl_files
+DGDL_BATCH_FILES = 256
+DGDL_BATCH_ELEMENTS = 2**23
 
 
 # ==============================================================================
@@ -61,34 +71,125 @@ def gauss_func(A, mean, dev, x):
 # -------------
 # Files Parsing
 # -------------
-def _longest_dgdl_file( lst ):
-    '''Takes a list of dgdl.xvg files and returns the id (starting from 0) of 
-    of the longest file.
+def parse_dgdl_files(lst, lambda0=0, invert_values=False, nproc=1,
+                     cache=None, chunksize=None, return_files=False):
+    '''Takes a list of dgdl.xvg files and returns the integrated work values
 
     Parameters
     ----------
     lst : list
         list containing the paths to the dgdl.xvg files.
+    lambda0 : [0,1]
+        whether the simulations started from lambda 0 or 1. Default is 0.
+    invert_values : bool
+        whether to invert the sign of the returned work value.
+    nproc : int
+        number of processes used to read and integrate the files.
+    cache : WorkCache, optional
+        cache of work values from previous runs. Only files that are not in
+        the cache, or changed since, are read and integrated.
+    chunksize : int, optional
+        if given, every file is integrated while reading it in chunks of
+        this many lines (see :func:`integrate_dgdl_stream`), instead of
+        holding all traces in memory. Default is None.
+    return_files : bool, optional
+        whether to also return the files the work values were obtained
+        from, i.e. without the skipped ones. Default is False.
+
+    The traces are read in batches of at most :data:`DGDL_BATCH_FILES`
+    files (or :data:`DGDL_BATCH_ELEMENTS` values), and the traces of equal
+    length in a batch are integrated together as a single 2-D array, see
+    :func:`integrate_dgdl_traces`. Only the work values of the files with
+    the expected number of data points (the largest one found) are kept;
+    shorter or incomplete files are skipped. With more than one process or a cache, the files are
+    processed in a single pass, see :func:`_parse_dgdl_files_onepass`; the
+    same holds when streaming the files.
 
     Returns
     -------
-    ind : int
-        index of the longest file
+    w : list
+        list of work values.
+    lst : list
+        list of input dgdl.xvg files corresponding to the work values in w,
+        only returned if return_files is True.
     '''
 
-    ind = 0
-    maxlen = -9999
-    for idx, f in enumerate(lst[0:]):
-        fp = open(f)
-        lines = fp.readlines()
-        if len(lines)>maxlen:
-            maxlen = len(lines)
-            ind = idx 
-    return(ind)
+    # check lambda0 is either 0 or 1
+    assert lambda0 in [0, 1]
 
+    if nproc > 1 or cache is not None or chunksize is not None:
+        return _parse_dgdl_files_onepass(lst, lambda0=lambda0,
+                                         invert_values=invert_values,
+                                         nproc=nproc, cache=cache,
+                                         chunksize=chunksize,
+                                         return_files=return_files)
+
+    # (work, number of data points) of every file, None if incomplete
+    res = [(None, None)] * len(lst)
+    batch = []
+    for i, f in enumerate(lst):
+        sys.stdout.write('\r    Reading %s' % f)
+        sys.stdout.flush()
+        y = read_dgdl(f)
+        if y is not None:
+            batch.append((i, y))
+        if len(batch) >= DGDL_BATCH_FILES or \
+                sum(len(b[1]) for b in batch) >= DGDL_BATCH_ELEMENTS:
+            _integrate_dgdl_batch(batch, res, lambda0, invert_values)
+            batch = []
+    _integrate_dgdl_batch(batch, res, lambda0, invert_values)
+    print('\n')
 
-def parse_dgdl_files(lst, lambda0=0, invert_values=False):
-    '''Takes a list of dgdl.xvg files and returns the integrated work values
+    return _select_works(lst, res, lambda0, return_files)
+
+
+def _integrate_dgdl_batch(batch, res, lambda0, invert_values):
+    '''Integrates a batch of (index, trace) pairs into res[index], stacking
+    the traces of equal length.'''
+    for n in set(len(y) for i, y in batch):
+        idx = [i for i, y in batch if len(y) == n]
+        w = integrate_dgdl_traces(np.vstack([y for i, y in batch
+                                             if len(y) == n]),
+                                  lambda0=lambda0,
+                                  invert_values=invert_values)
+        for i, wi in zip(idx, w):
+            res[i] = (wi, n)
+
+
+def _select_works(lst, res, lambda0, return_files):
+    '''Keeps the work values of the files with the largest number of data
+    points, given the (work, ndata) of every file in lst.'''
+    ndata = max([n for w, n in res if n is not None] or [0])
+    if ndata == 0:
+        return ([], []) if return_files else []
+    imax = [n for w, n in res].index(ndata)
+    _check_dgdl(lst[imax], lambda0)
+
+    w_list = []
+    files = []
+    for f, (w, n) in zip(lst, res):
+        if w is None:
+            continue
+        if n != ndata:
+            print(' !! Skipping %s ( read %d data points, should be %d )'
+                  % (f, n, ndata))
+            continue
+        w_list.append(w)
+        files.append(f)
+
+    if return_files:
+        return w_list, files
+    return w_list
+
+
+def _parse_dgdl_files_onepass(lst, lambda0=0, invert_values=False, nproc=1,
+                              cache=None, chunksize=None, return_files=False):
+    '''Reads and integrates all dgdl.xvg files in a single pass, optionally
+    over a pool of processes and skipping the files found in a cache.
+    Instead of scanning all files for their length beforehand, the expected
+    number of data points is taken afterwards as the largest one found, and
+    shorter or incomplete files are skipped. The work values are returned
+    in the order of the input files.
 
     Parameters
     ----------
@@ -98,40 +199,240 @@ def parse_dgdl_files(lst, lambda0=0, invert_values=False):
         whether the simulations started from lambda 0 or 1. Default is 0.
     invert_values : bool
         whether to invert the sign of the returned work value.
+    nproc : int
+        number of processes.
+    cache : WorkCache, optional
+        cache of work values from previous runs.
+    chunksize : int, optional
+        if given, the files are streamed in chunks of this many lines.
+    return_files : bool, optional
+        whether to also return the files the work values were obtained from.
 
     Returns
     -------
-    w : array
-        array of work values.
-    lst : list
-        sorted list of input dgdl.avg files corresponding to the work values
-        in w.
+    w : list
+        list of work values.
     '''
+    res = [None] * len(lst)
+    fingerprints = {}
+    if cache is not None:
+        for i, f in enumerate(lst):
+            res[i], fingerprints[i] = cache.lookup(f, lambda0, invert_values)
+    todo = [i for i, r in enumerate(res) if r is None]
+    if cache is not None:
+        print('    %d files found in cache, reading %d'
+              % (len(lst) - len(todo), len(todo)))
+
+    if chunksize is not None:
+        integ = partial(integrate_dgdl_stream, lambda0=lambda0,
+                        invert_values=invert_values, chunksize=chunksize)
+    else:
+        integ = partial(integrate_dgdl, lambda0=lambda0,
+                        invert_values=invert_values)
+    if nproc > 1 and len(todo) > 1:
+        print('    Reading %d files with %d processes' % (len(todo), nproc))
+        pool = multiprocessing.Pool(nproc)
+        try:
+            new = pool.map(integ, [lst[i] for i in todo],
+                           chunksize=max(1, len(todo) // (4 * nproc)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        new = [integ(lst[i]) for i in todo]
 
-    # check lambda0 is either 0 or 1
-    assert lambda0 in [0, 1]
+    for i, r in zip(todo, new):
+        res[i] = r
+        # incomplete files may still be written to, do not cache them
+        if cache is not None and r[0] is not None:
+            cache.store(lst[i], fingerprints[i], lambda0, invert_values, *r)
 
-    # identify file with the most entries
-    imax = _longest_dgdl_file( lst )
+    works = _select_works(lst, res, lambda0, return_files)
+    print('\n')
+    return works
 
-    _check_dgdl(lst[imax], lambda0)
-    first_w, ndata = integrate_dgdl(lst[imax], lambda0=lambda0,
-                                    invert_values=invert_values)
-    w_list = [first_w]
-    for idx, f in enumerate(lst[0:]):
-        if idx==imax: # already processed
-            continue
-        sys.stdout.write('\r    Reading %s' % f)
-        sys.stdout.flush()
 
-        w, _ = integrate_dgdl(f, ndata=ndata, lambda0=lambda0,
-                              invert_values=invert_values)
-        if w is not None:
-            w_list.append(w)
+class WorkCache(object):
+    '''On-disk cache of integrated work values, so that re-running the
+    analysis only reads the dhdl.xvg files that are new or have changed.
 
-    print('\n')
+    Every entry is keyed by the absolute path of the dhdl.xvg file and the
+    integration settings (lambda0, invert_values), and is valid as long as
+    the file size, modification time and a content hash (of the first and
+    last 64 kB of the file) are unchanged. The cache is stored as a numpy
+    structured array (.npy). When saving, entries not used for more than
+    ``max_age`` days are evicted, and only the ``max_entries`` most recently
+    used ones are kept.
 
-    return w_list
+    Parameters
+    ----------
+    fn : str
+        the cache file.
+    max_entries : int, optional
+        maximum number of entries kept. Default is 1000000.
+    max_age : float, optional
+        entries unused for more days than this are evicted. Default is 30.
+
+    Examples
+    --------
+    >>> cache = WorkCache('works.cache.npy')
+    >>> w = parse_dgdl_files(files, lambda0=0, cache=cache)
+    >>> cache.save()
+    '''
+
+    hash_block = 65536
+
+    def __init__(self, fn, max_entries=1000000, max_age=30):
+        self.fn = fn
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = {}
+        if os.path.isfile(fn):
+            self.load()
+
+    def load(self):
+        '''Reads the entries from the cache file.'''
+        try:
+            data = np.load(self.fn)
+        except (IOError, ValueError):
+            print(' !! Could not read work value cache %s, ignoring it'
+                  % self.fn)
+            return
+        for e in data:
+            key = (_as_str(e['path']), int(e['lambda0']), bool(e['invert']))
+            self.entries[key] = (int(e['size']), float(e['mtime']),
+                                 _as_str(e['hash']), float(e['work']),
+                                 int(e['ndata']), float(e['atime']))
+
+    def save(self):
+        '''Evicts stale entries and writes the cache file.'''
+        now = time.time()
+        entries = [(k, v) for k, v in self.entries.items()
+                   if now - v[5] <= self.max_age * 86400]
+        entries.sort(key=lambda kv: kv[1][5], reverse=True)
+        entries = entries[:self.max_entries]
+        self.entries = dict(entries)
+
+        plen = max([len(k[0]) for k, v in entries] or [1])
+        dtype = [('path', 'S%d' % plen), ('lambda0', 'i1'),
+                 ('invert', '?'), ('size', 'i8'), ('mtime', 'f8'),
+                 ('hash', 'S40'), ('work', 'f8'), ('ndata', 'i8'),
+                 ('atime', 'f8')]
+        data = np.array([(_as_bytes(k[0]), k[1], k[2], v[0], v[1],
+                          _as_bytes(v[2]), v[3], v[4], v[5])
+                         for k, v in entries], dtype=dtype)
+        # write to a temporary file first, so that concurrent readers never
+        # see a partially written cache
+        tmp = '%s.%d.tmp' % (self.fn, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.rename(tmp, self.fn)
+
+    @classmethod
+    def fingerprint(cls, fn):
+        '''Returns the (size, mtime, hash) fingerprint of a file.'''
+        st = os.stat(fn)
+        h = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            h.update(f.read(cls.hash_block))
+            if st.st_size > 2 * cls.hash_block:
+                f.seek(-cls.hash_block, 2)
+            h.update(f.read(cls.hash_block))
+        return st.st_size, st.st_mtime, h.hexdigest()
+
+    def lookup(self, fn, lambda0, invert_values):
+        '''Returns the cached (work, ndata) of a file, or None if it is not
+        cached or has changed, together with the file fingerprint.'''
+        fp = self.fingerprint(fn)
+        key = (os.path.abspath(fn), int(lambda0), bool(invert_values))
+        e = self.entries.get(key)
+        if e is None or e[:3] != fp:
+            return None, fp
+        self.entries[key] = e[:5] + (time.time(),)
+        return (e[3], e[4]), fp
+
+    def store(self, fn, fp, lambda0, invert_values, w, ndata):
+        '''Adds the work value of a file with fingerprint ``fp``.'''
+        key = (os.path.abspath(fn), int(lambda0), bool(invert_values))
+        self.entries[key] = tuple(fp) + (float(w), int(ndata), time.time())
+
+
+def _as_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def _as_str(b):
+    if isinstance(b, str):
+        return b
+    return b.decode('utf-8')
+
+
+def read_dgdl(fn):
+    '''Reads the dH/dl values from a dgdl.xvg file.
+
+    Parameters
+    ----------
+    fn : str
+        the input dgdl.xvg file from Gromacs. Files compressed with gzip,
+        bzip2 or xz and binary dH/dl files (see
+        :func:`pmx.parser.write_dhdl_bin`) are read as well.
+
+    Returns
+    -------
+    y : array
+        the dH/dl values, or None if the file is incomplete or empty.
+    '''
+    # TODO: we removed the check for file integrity. We could have an
+    # optional files integrity check before calling this integration func
+    try:
+        y = read_xvg_array(fn, columns=1)
+    except ParserError:
+        print(' !! Skipping %s (incomplete file, probably simulation crashed)\n' % fn)
+        return None
+    if len(y) == 0:
+        return None
+    # binary dH/dl files are mapped as float32
+    return np.asarray(y, dtype=float)
+
+
+def integrate_dgdl_traces(y, lambda0=0, invert_values=False):
+    '''Integrates dH/dl traces over lambda with Simpson's rule. The traces
+    are assumed to be equally spaced in lambda between 0 and 1.
+
+    Parameters
+    ----------
+    y : array
+        a single dH/dl trace, or a (n_traces x n_frames) array of traces of
+        equal length that are integrated all at once.
+    lambda0 : [0,1]
+        whether the simulations started from lambda 0 or 1. Default is 0.
+    invert_values : bool
+        whether to invert the sign of the returned work values.
+
+    Returns
+    -------
+    integr : float or array
+        the work value(s), one per trace.
+    '''
+    ndata = y.shape[-1]
+    # convert time to lambda
+    dlambda = 1./float(ndata)
+    if lambda0 == 1:
+        dlambda *= -1
+
+    # array of lambda values
+    x = lambda0 + np.arange(ndata)*dlambda
+
+    if lambda0 == 1:
+        x = x[::-1]
+        y = y[..., ::-1]
+
+    integr = simps(y, x, axis=-1)
+    if invert_values is True:
+        integr = integr * (-1)
+    return integr
 
 
 def integrate_dgdl(fn, ndata=-1, lambda0=0, invert_values=False):
@@ -159,71 +460,124 @@ def integrate_dgdl(fn, ndata=-1, lambda0=0, invert_values=False):
     # check lambda0 is either 0 or 1
     assert lambda0 in [0, 1]
 
-    lines = open(fn).readlines()
-    if not lines:
+    # extract dgdl datapoints
+    r = read_dgdl(fn)
+    if r is None:
         return None, None
 
-    # extract dgdl datapoints into r
-    # TODO: we removed the check for file integrity. We could have an
-    # optional files integrity check before calling this integration func
+    if ndata != -1 and len(r) != ndata:
+        print(' !! Skipping %s ( read %d data points, should be %d )' % (fn, len(r), ndata))
+        return None, None
 
-    lines = [l for l in lines if l[0] not in '#@&']
-    try:
-        r = map(lambda x: float(x.split()[1]), lines)
-    except:
-        r = "incomplete_file"
-        ndata = 1
+    integr = integrate_dgdl_traces(r, lambda0=lambda0,
+                                   invert_values=invert_values)
+    return integr, len(r)
 
-    if ndata != -1 and len(r) != ndata:
-        try:
-            if "incomplete_file" in r:
-                print(' !! Skipping %s (incomplete file, probably simulation crashed)\n' % fn)
+
+def integrate_dgdl_stream(fn, ndata=-1, lambda0=0, invert_values=False,
+                          chunksize=100000):
+    '''Integrates the data in a dgdl.xvg file like :func:`integrate_dgdl`,
+    but reads the file in chunks and accumulates the integral on the fly,
+    so that memory use does not grow with the length of the file.
+
+    For equally spaced points, composite Simpson's rule only needs the sums
+    of the values at even and odd positions together with the first two and
+    last two values. For an even number of points the two Simpson/trapezoid
+    combinations are averaged, as done by ``scipy.integrate.simps`` with
+    ``even='avg'``, so the result agrees with :func:`integrate_dgdl` to
+    rounding precision.
+
+    Parameters
+    ----------
+    fn : str
+        the input dgdl.xvg file from Gromacs.
+    ndata : int, optional
+        expected number of datapoints in file. If -1, any number is
+        accepted. Default is -1.
+    lambda0 : [0,1]
+        whether the simulations started from lambda 0 or 1. Default is 0.
+    invert_values : bool
+        whether to invert the sign of the returned work value.
+    chunksize : int, optional
+        number of lines read at once. Default is 100000.
+
+    Returns
+    -------
+    integr : float
+        result of the integration performed using Simpson's rule.
+    ndata : int
+        number of data points in the input file.
+    '''
+
+    # check lambda0 is either 0 or 1
+    assert lambda0 in [0, 1]
+
+    n = 0
+    s_even = 0.
+    s_odd = 0.
+    head = []
+    tail = np.zeros(2)
+    try:
+        for y in iter_xvg_array(fn, columns=1, chunksize=chunksize):
+            # parity of the first point of the chunk in the whole file
+            if n % 2 == 0:
+                s_even += y[0::2].sum()
+                s_odd += y[1::2].sum()
             else:
-                print(' !! Skipping %s ( read %d data points, should be %d )' % (fn, len(r), ndata))
-        except:
-            print(' !! Skipping %s ' % (fn))
+                s_even += y[1::2].sum()
+                s_odd += y[0::2].sum()
+            if len(head) < 2:
+                head.extend(y[:2 - len(head)])
+            tail = np.concatenate([tail, y[-2:]])[-2:]
+            n += len(y)
+    except ParserError:
+        print(' !! Skipping %s (incomplete file, probably simulation crashed)\n' % fn)
+        return None, None
+    if n == 0:
+        return None, None
+    if ndata != -1 and n != ndata:
+        print(' !! Skipping %s ( read %d data points, should be %d )' % (fn, n, ndata))
         return None, None
-    # convert time to lambda
-    ndata = len(r)
-    dlambda = 1./float(ndata)
-    if lambda0 == 1:
-        dlambda *= -1
-
-    # arrays for the integration
-    # --------------------------
-    # array of lambda values
-    x = [lambda0+i*dlambda for i, dgdl in enumerate(r)]
-    # array of dgdl
-    y = r
 
-    if lambda0 == 1:
-        x.reverse()
-        y.reverse()
+    # Simpson's rule is symmetric under reversal of the points, hence the
+    # same expression holds for both directions (see integrate_dgdl_traces)
+    h = 1./float(n)
+    if n == 1:
+        integr = 0.
+    elif n == 2:
+        integr = h/2.*(head[0] + head[1])
+    elif n % 2 == 1:
+        y0, yn = head[0], tail[1]
+        integr = h/3.*(y0 + yn + 4.*s_odd + 2.*(s_even - y0 - yn))
+    else:
+        y0, y1 = head
+        yn1, yn = tail
+        first = (h/3.*(y0 + yn1 + 4.*(s_odd - yn) + 2.*(s_even - y0 - yn1))
+                 + h/2.*(yn1 + yn))
+        last = (h/2.*(y0 + y1)
+                + h/3.*(y1 + yn + 4.*(s_even - y0) + 2.*(s_odd - y1 - yn)))
+        integr = 0.5*(first + last)
 
     if invert_values is True:
-        integr = simps(y, x) * (-1)
-        return integr, ndata
-    else:
-        integr = simps(y, x)
-        return integr, ndata
+        integr = integr * (-1)
+    return integr, n
 
 
 def _check_dgdl(fn, lambda0):
     '''Prints some info about a dgdl.xvg file.'''
-    l = open(fn).readlines()
-    if not l:
+    # only the number of points and the last time are needed
+    ndata = 0
+    for t in iter_xvg_array(fn, columns=0):
+        ndata += len(t)
+        tlast = t[-1]
+    if ndata == 0:
         return None
-    r = []
-    for line in l:
-        if line[0] not in '#@&':
-            r.append([float(x) for x in line.split()])
-    ndata = len(r)
     dlambda = 1./float(ndata)
     if lambda0 == 1:
         dlambda *= -1
 
     print('    # data points: %d' % ndata)
-    print('    Length of trajectory: %8.3f ps' % r[-1][0])
+    print('    Length of trajectory: %8.3f ps' % tlast)
     print('    Delta lambda: %8.5f' % dlambda)
 
 
@@ -233,18 +587,247 @@ def _dump_integ_file(outfn, f_lst, w_lst):
             f.write('{dhdl} {work}\n'.format(dhdl=fn, work=w))
 
 
+def _dump_work_archive(outfn, files_for, wf, files_rev, wr, T, pmx_version,
+                       with_dhdl=False):
+    '''Writes the work values of both directions into a WorkArchive. With
+    with_dhdl, the dH/dl curves are read again and stored as well.'''
+    dhdl = [None, None]
+    if with_dhdl:
+        for i, files in enumerate([files_for, files_rev]):
+            if len(files) > 0:
+                dhdl[i] = np.vstack([read_dgdl(f) for f in files])
+    archive = WorkArchive(wf=wf, wr=wr, files_for=files_for,
+                          files_rev=files_rev, T=T, pmx_version=pmx_version,
+                          dhdl_for=dhdl[0], dhdl_rev=dhdl[1])
+    archive.save(outfn)
+
+
+def _dump_conv_file(outfn, conv, unit_fact=1., units='kJ/mol', prec=2):
+    '''Writes the convergence curves returned by
+    :func:`pmx.estimators.convergence` as columns of a text file.'''
+    cols = ['dg_bar', 'err_bar', 'dg_cgi', 'err_cgi', 'dg_jarz_for',
+            'err_jarz_for', 'dg_jarz_rev', 'err_jarz_rev']
+    with open(outfn, 'w') as f:
+        f.write('# units = %s\n' % units)
+        f.write('# n_for n_rev %s\n' % ' '.join(cols))
+        for i in range(len(conv['n_for'])):
+            row = ['%d' % conv['n_for'][i], '%d' % conv['n_rev'][i]]
+            row += ['{0:.{p}f}'.format(conv[c][i]*unit_fact, p=prec)
+                    for c in cols]
+            f.write(' '.join(row) + '\n')
+
+
 def _data_from_file(fn):
     data = read_and_format(fn, 'sf')
     return map(lambda a: a[1], data)
 
 
+# ----------
+# Watch mode
+# ----------
+def watch_dgdl_files(patternsAB, patternsBA, interval=60, T=298.15,
+                     reverseB=False, nboots=0, seed=None, nproc=1,
+                     until=None, out=sys.stdout, unit_fact=1.,
+                     units='kJ/mol', prec=2):
+    '''Follows the dgdl.xvg files of running non-equilibrium transitions and
+    reports the free energy estimates whenever new transitions have finished.
+
+    Every ``interval`` seconds the glob patterns are expanded again and only
+    the files not processed yet are integrated. A file is considered
+    finished when :func:`integrate_dgdl` does not flag it as incomplete and
+    it has not been modified for at least ``interval`` seconds; otherwise
+    it is tried again in the next round. The work values are added to a
+    :class:`pmx.estimators.RunningEstimate`. As in :func:`parse_dgdl_files`,
+    only the files with the largest number of data points found so far are
+    used; when a longer file finishes, the estimates are recomputed without
+    the shorter ones.
+
+    Parameters
+    ----------
+    patternsAB : list
+        glob patterns (or paths) of the forward dgdl.xvg files.
+    patternsBA : list
+        glob patterns (or paths) of the reverse dgdl.xvg files.
+    interval : float
+        seconds between two rounds.
+    T : float
+        temperature in Kelvin.
+    reverseB : bool
+        whether to invert the sign of the reverse work values.
+    nboots : int
+        number of bootstrap samples for the error estimates.
+    seed : int
+        seed for the bootstrap.
+    nproc : int
+        number of processes for the BAR bootstrap.
+    until : int, optional
+        stop once this many trajectories were analysed in each provided
+        direction. Default is None (run until interrupted).
+    out : file
+        file to which the reports are written besides the screen.
+    unit_fact : float
+        factor converting kJ/mol into the output units.
+    units : str
+        name of the output units.
+    prec : int
+        decimal precision of the output.
+
+    Returns
+    -------
+    run : RunningEstimate
+        the estimates from all the finished transitions.
+    '''
+    run = RunningEstimate(T=T)
+    dirs = []
+    if patternsAB:
+        dirs.append(('A', patternsAB, 0, False))
+    if patternsBA:
+        dirs.append(('B', patternsBA, 1, reverseB))
+    done = dict((d[0], set()) for d in dirs)
+    # (file, work, number of points) of the finished files, in order
+    works = dict((d[0], []) for d in dirs)
+    ndata = dict((d[0], 0) for d in dirs)
+    # mtimes of incomplete files, which are only retried once modified
+    failed = {}
+
+    _tee(out, '  Watching the dgdl.xvg files every %d s (Ctrl-C to stop)'
+         % interval)
+    try:
+        while True:
+            new = {'A': [], 'B': []}
+            rebuild = False
+            for d, patterns, lambda0, invert in dirs:
+                found = []
+                files = set()
+                for p in patterns:
+                    files.update(glob.glob(p))
+                for f in natural_sort(list(files)):
+                    if f in done[d]:
+                        continue
+                    mtime = os.path.getmtime(f)
+                    # still being written to
+                    if time.time() - mtime < interval:
+                        continue
+                    if failed.get(f) == mtime:
+                        continue
+                    w, n = integrate_dgdl(f, lambda0=lambda0,
+                                          invert_values=invert)
+                    if w is None:
+                        failed[f] = mtime
+                        continue
+                    done[d].add(f)
+                    found.append((f, w, n))
+
+                # the longest file sets the expected number of points; if it
+                # grew, the work values used so far are dropped
+                nprev = ndata[d]
+                ndata[d] = max([nprev] + [n for _, _, n in found])
+                dropped = []
+                if 0 < nprev < ndata[d]:
+                    rebuild = True
+                    dropped = [x for x in works[d] if x[2] == nprev]
+                for f, w, n in dropped + [x for x in found
+                                          if x[2] != ndata[d]]:
+                    print(' !! Skipping %s ( read %d data points, '
+                          'should be %d )' % (f, n, ndata[d]))
+                works[d].extend(found)
+                new[d] = [w for _, w, n in found if n == ndata[d]]
+
+            if rebuild:
+                run = RunningEstimate(T=T)
+                run.add(wf=[w for _, w, n in works.get('A', [])
+                            if n == ndata['A']],
+                        wr=[w for _, w, n in works.get('B', [])
+                            if n == ndata['B']])
+                _report_running(run, nboots=nboots, seed=seed, nproc=nproc,
+                                out=out, unit_fact=unit_fact, units=units,
+                                prec=prec)
+            elif new['A'] or new['B']:
+                run.add(wf=new['A'], wr=new['B'])
+                _report_running(run, nboots=nboots, seed=seed, nproc=nproc,
+                                out=out, unit_fact=unit_fact, units=units,
+                                prec=prec)
+
+            if until is not None and \
+                    all(len(run.wf if d[0] == 'A' else run.wr) >= until
+                        for d in dirs):
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        _tee(out, '\n  Stopped watching.')
+    return run
+
+
+def _report_running(run, nboots=0, seed=None, nproc=1, out=sys.stdout,
+                    unit_fact=1., units='kJ/mol', prec=2):
+    '''Writes the current estimates of a RunningEstimate.'''
+    def fmt(name, dg, err=None):
+        s = '  {n:<12} dG = {dg:8.{p}f} {u}'.format(n=name, dg=dg*unit_fact,
+                                                    p=prec, u=units)
+        if err is not None:
+            s += ' +/- {e:8.{p}f}'.format(e=err*unit_fact, p=prec)
+        return s
+
+    _tee(out, '\n  %s: %d forward, %d reverse trajectories'
+         % (time.strftime('%H:%M:%S'), len(run.wf), len(run.wr)))
+    if run.dg_bar is not None:
+        err = run.err_bar
+        if nboots > 0:
+            err = BAR.calc_err_boot(run.wf, run.wr, nboots, run.T,
+                                    solver=run.solver, seed=seed,
+                                    n_jobs=nproc)
+        _tee(out, fmt('BAR:', run.dg_bar, err))
+    if run.dg_cgi is not None:
+        err = None
+        if nboots > 0:
+            err = Crooks.calc_err_boot2(run.wf, run.wr, nboots, seed=seed)
+        _tee(out, fmt('CGI:', run.dg_cgi, err))
+    for label, dg, w, c in (('JARZ for:', run.dg_jarz_for, run.wf, 1.0),
+                            ('JARZ rev:', run.dg_jarz_rev, run.wr, -1.0)):
+        if dg is not None:
+            err = None
+            if nboots > 0 and len(w) > 1:
+                err = Jarz.calc_err_boot(w, run.T, c, nboots, seed=seed)
+            _tee(out, fmt(label, dg, err))
+    for label, dg, err in (('JARZ_G for:', run.dg_gauss_for,
+                            run.err_gauss_for),
+                           ('JARZ_G rev:', run.dg_gauss_rev,
+                            run.err_gauss_rev)):
+        if dg is not None:
+            _tee(out, fmt(label, dg, err))
+    out.flush()
+
+
 # ------------------
 # Plotting functions
 # ------------------
-def plot_work_dist(wf, wr, fname='Wdist.png', nbins=20, dG=None, dGerr=None,
-                   units='kJ/mol', dpi=300, statesProvided='AB'):
-    '''Plots forward and reverse work distributions. Optionally, it adds the
-    estimate of the free energy change and its uncertainty on the plot.
+def _smooth(x, window_len=11, window='hanning'):
+    if x.ndim != 1:
+        raise ValueError("smooth only accepts 1 dimension arrays.")
+    if x.size < window_len:
+        raise ValueError("Input vector needs to be bigger than "
+                         "window size.")
+    if window_len < 3:
+        return x
+    if window not in ['flat', 'hanning', 'hamming',
+                      'bartlett', 'blackman']:
+        raise ValueError("Window is on of 'flat', 'hanning', 'hamming', "
+                         "'bartlett', 'blackman'")
+    s = np.r_[2*x[0]-x[window_len:1:-1], x, 2*x[-1]-x[-1:-window_len:-1]]
+    # moving average
+    if window == 'flat':
+        w = np.ones(window_len, 'd')
+    else:
+        w = getattr(np, window)(window_len)
+    y = np.convolve(w/w.sum(), s, mode='same')
+    return y[window_len-1:-window_len+1]
+
+
+def work_dist_data(wf, wr, nbins=20, dG=None, dGerr=None, units='kJ/mol',
+                   statesProvided='AB'):
+    '''Computes everything that is drawn by :func:`plot_work_dist`: the
+    smoothed work traces, the histograms of the work values and their
+    Gaussian fits. No plotting library is needed.
 
     Parameters
     ----------
@@ -252,8 +835,6 @@ def plot_work_dist(wf, wr, fname='Wdist.png', nbins=20, dG=None, dGerr=None,
         list of forward work values.
     wr : list
         list of reverse work values.
-    fname : str, optional
-        filename of the saved image. Default is 'Wdist.png'.
     nbins : int, optional
         number of bins to use for the histogram. Default is 20.
     dG : float, optional
@@ -262,124 +843,136 @@ def plot_work_dist(wf, wr, fname='Wdist.png', nbins=20, dG=None, dGerr=None,
         uncertainty of the free energy estimate.
     units : str, optional
         the units of dG and dGerr. Default is 'kJ/mol'.
-    dpi : int
-        resolution of the saved image file.
     statesProvided: str
         work values for two states or only one
 
     Returns
     -------
-    None
+    data : dict
+        the arrays of the plot, ready to be passed to
+        :func:`render_work_plot` or saved with :func:`save_work_plot_data`.
+    '''
+    data = {'statesProvided': statesProvided, 'units': units}
+    if dG is not None:
+        data['dG'] = float(dG)
+    if dGerr is not None:
+        data['dGerr'] = float(dGerr)
+
+    fits = []
+    for state, key, w in (('A', 'for', wf), ('B', 'rev', wr)):
+        if state not in statesProvided:
+            continue
+        w = np.asarray(w, dtype=float)
+        counts, edges = np.histogram(w, bins=nbins)
+        data['w_' + key] = w
+        data['smooth_' + key] = _smooth(w)
+        data['hist_' + key] = counts
+        data['edges_' + key] = edges
+        fits.append((key, data2gauss(w)))
+
+    w_all = np.concatenate([data['w_' + key] for key, _ in fits])
+    x = np.arange(w_all.min(), w_all.max(), .5)
+    data['gauss_x'] = x
+    for key, (m, dev, A) in fits:
+        data['gauss_' + key] = gauss_func(A, m, dev, x)
+    return data
+
+
+def save_work_plot_data(fn, data):
+    '''Writes the data returned by :func:`work_dist_data` to a compressed
+    .npz file, to be rendered later with :func:`render_work_plot`.'''
+    arrays = dict(data)
+    for key in ('statesProvided', 'units'):
+        arrays[key] = np.array(arrays[key], dtype=np.unicode_)
+    np.savez_compressed(fn, **arrays)
+
+
+def load_work_plot_data(fn):
+    '''Reads a file written by :func:`save_work_plot_data`.'''
+    data = {}
+    with np.load(fn) as npz:
+        for key in npz.files:
+            data[key] = npz[key]
+    for key in ('statesProvided', 'units'):
+        data[key] = str(data[key])
+    for key in ('dG', 'dGerr'):
+        if key in data:
+            data[key] = float(data[key])
+    return data
+
+
+def render_work_plot(data, fname='Wdist.png', dpi=300):
+    '''Draws the plot of the work distributions from the data returned by
+    :func:`work_dist_data`, or from a file written by
+    :func:`save_work_plot_data`. Matplotlib is imported only here.
+
+    Parameters
+    ----------
+    data : dict or str
+        the plot data, or the .npz file holding it.
+    fname : str, optional
+        filename of the saved image. Default is 'Wdist.png'.
+    dpi : int
+        resolution of the saved image file.
 
+    Returns
+    -------
+    None
     '''
+    from matplotlib import pyplot as plt
 
-    def smooth(x, window_len=11, window='hanning'):
-
-        if x.ndim != 1:
-            raise ValueError("smooth only accepts 1 dimension arrays.")
-        if x.size < window_len:
-            raise ValueError("Input vector needs to be bigger than "
-                             "window size.")
-        if window_len < 3:
-            return x
-        if window not in ['flat', 'hanning', 'hamming',
-                          'bartlett', 'blackman']:
-            raise ValueError("Window is on of 'flat', 'hanning', 'hamming', "
-                             "'bartlett', 'blackman'")
-        s = np.r_[2*x[0]-x[window_len:1:-1], x, 2*x[-1]-x[-1:-window_len:-1]]
-        # moving average
-        if window == 'flat':
-            w = np.ones(window_len, 'd')
-        else:
-            w = eval('np.' + window + '(window_len)')
-        y = np.convolve(w/w.sum(), s, mode='same')
-        return y[window_len-1:-window_len+1]
+    if not isinstance(data, dict):
+        data = load_work_plot_data(data)
+    traces = [('for', 'g', "Forward (0->1)"), ('rev', 'b', "Backward (1->0)")]
+    traces = [t for t in traces if 'w_' + t[0] in data]
 
-    plt.figure(figsize=(8, 6))
+    fig = plt.figure(figsize=(8, 6))
     plt.subplot(1, 2, 1)
-    x1 = 0
-    x2 = 0
-    if 'A' in statesProvided:
-        x1 = range(len(wf))
-    if 'B' in statesProvided:
-        x2 = range(len(wr))
-    if x1 > x2:
-        x = x1
-    else:
-        x = x2
-    if 'A' in statesProvided:
-        mf, devf, Af = data2gauss(wf)
-    if 'B' in statesProvided:
-        mb, devb, Ab = data2gauss(wr)
-
-    if 'AB' in statesProvided: 
-        mini = min(wf+wr)
-        maxi = max(wf+wr)
-        sm1 = smooth(np.array(wf))
-        sm2 = smooth(np.array(wr))
-        plt.plot(x1, wf, 'g-', linewidth=2, label="Forward (0->1)", alpha=.3)
-        plt.plot(x1, sm1, 'g-', linewidth=3)
-        plt.plot(x2, wr, 'b-', linewidth=2, label="Backward (1->0)", alpha=.3)
-        plt.plot(x2, sm2, 'b-', linewidth=3)
-    elif 'A' in statesProvided:
-        maxi = max(wf)
-        mini = min(wf)
-        sm1 = smooth(np.array(wf))
-        plt.plot(x1, wf, 'g-', linewidth=2, label="Forward (0->1)", alpha=.3)
-        plt.plot(x1, sm1, 'g-', linewidth=3)
-    elif 'B' in statesProvided:
-        maxi = max(wr)
-        mini = min(wr)
-        sm2 = smooth(np.array(wr))
-        plt.plot(x2, wr, 'b-', linewidth=2, label="Backward (1->0)", alpha=.3)
-        plt.plot(x2, sm2, 'b-', linewidth=3)
-
+    for key, c, label in traces:
+        w = data['w_' + key]
+        x = range(len(w))
+        plt.plot(x, w, c + '-', linewidth=2, label=label, alpha=.3)
+        plt.plot(x, data['smooth_' + key], c + '-', linewidth=3)
     plt.legend(shadow=True, fancybox=True, loc='upper center',
                prop={'size': 12})
     plt.ylabel(r'W [kJ/mol]', fontsize=20)
     plt.xlabel(r'# Snapshot', fontsize=20)
     plt.grid(lw=2)
-    plt.xlim(0, x[-1]+1)
+    plt.xlim(0, max(len(data['w_' + t[0]]) for t in traces))
     xl = plt.gca()
     for val in xl.spines.values():
         val.set_lw(2)
-    plt.subplot(1, 2, 2)
-    plt.hist(wf, bins=nbins, orientation='horizontal', facecolor='green',
-             alpha=.75, density=True)
-    plt.hist(wr, bins=nbins, orientation='horizontal', facecolor='blue',
-             alpha=.75, density=True)
-
-    x = np.arange(mini, maxi, .5)
-
-    if 'AB' in statesProvided:
-        y1 = gauss_func(Af, mf, devf, x)
-        y2 = gauss_func(Ab, mb, devb, x)
-        plt.plot(y1, x, 'g--', linewidth=2)
-        plt.plot(y2, x, 'b--', linewidth=2)
-        size = max([max(y1), max(y2)])
-    elif 'A' in statesProvided:
-        y1 = gauss_func(Af, mf, devf, x)
-        plt.plot(y1, x, 'g--', linewidth=2)
-        size = max(y1)
-    elif 'B' in statesProvided:
-        y2 = gauss_func(Ab, mb, devb, x)
-        plt.plot(y2, x, 'b--', linewidth=2)
-        size = max(y2)
 
+    plt.subplot(1, 2, 2)
+    colors = {'for': 'green', 'rev': 'blue'}
+    for key, c, label in traces:
+        edges = data['edges_' + key]
+        plt.hist(edges[:-1], bins=edges, weights=data['hist_' + key],
+                 orientation='horizontal', facecolor=colors[key],
+                 alpha=.75, density=True)
+    x = data['gauss_x']
+    size = 0.
+    for key, c, label in traces:
+        y = data['gauss_' + key]
+        plt.plot(y, x, c + '--', linewidth=2)
+        if len(y) > 0:
+            size = max(size, max(y))
+
+    dG = data.get('dG')
+    dGerr = data.get('dGerr')
     res_x = [dG, dG]
     res_y = [0, size*1.2]
     if dG is not None and dGerr is not None:
         plt.plot(res_y, res_x, 'k--', linewidth=2,
-                 label=r'$\Delta$G = %.2f $\pm$ %.2f %s' % (dG, dGerr, units))
+                 label=r'$\Delta$G = %.2f $\pm$ %.2f %s' % (dG, dGerr,
+                                                          data['units']))
         plt.legend(shadow=True, fancybox=True, loc='upper center',
                    prop={'size': 12})
     elif dG is not None and dGerr is None:
         plt.plot(res_y, res_x, 'k--', linewidth=2,
-                 label=r'$\Delta$G = %.2f %s' % (dG, units))
+                 label=r'$\Delta$G = %.2f %s' % (dG, data['units']))
         plt.legend(shadow=True, fancybox=True, loc='upper center',
                    prop={'size': 12})
-    else:
-        plt.plot(res_y, res_x, 'k--', linewidth=2)
 
     plt.xticks([])
     plt.yticks([])
@@ -388,6 +981,244 @@ def plot_work_dist(wf, wr, fname='Wdist.png', nbins=20, dG=None, dGerr=None,
         val.set_lw(2)
     plt.subplots_adjust(wspace=0.0, hspace=0.1)
     plt.savefig(fname, dpi=dpi)
+    plt.close(fig)
+
+
+def render_work_plots(files, dpi=300, ext='.png'):
+    '''Renders in one go the plots of many files written by
+    :func:`save_work_plot_data`. Each image is saved next to its data file,
+    with the extension replaced by ``ext``.
+
+    Parameters
+    ----------
+    files : list of str
+        the .npz files holding the plot data.
+    dpi : int, optional
+        resolution of the saved image files. Default is 300.
+    ext : str, optional
+        extension of the image files. Default is '.png'.
+
+    Returns
+    -------
+    images : list of str
+        the image files written.
+    '''
+    images = []
+    for fn in files:
+        fname = os.path.splitext(fn)[0] + ext
+        render_work_plot(fn, fname=fname, dpi=dpi)
+        images.append(fname)
+    return images
+
+
+def plot_work_dist(wf, wr, fname='Wdist.png', nbins=20, dG=None, dGerr=None,
+                   units='kJ/mol', dpi=300, statesProvided='AB'):
+    '''Plots forward and reverse work distributions. Optionally, it adds the
+    estimate of the free energy change and its uncertainty on the plot.
+
+    Parameters
+    ----------
+    wf : list
+        list of forward work values.
+    wr : list
+        list of reverse work values.
+    fname : str, optional
+        filename of the saved image. Default is 'Wdist.png'.
+    nbins : int, optional
+        number of bins to use for the histogram. Default is 20.
+    dG : float, optional
+        free energy estimate.
+    dGerr : float, optional
+        uncertainty of the free energy estimate.
+    units : str, optional
+        the units of dG and dGerr. Default is 'kJ/mol'.
+    dpi : int
+        resolution of the saved image file.
+    statesProvided: str
+        work values for two states or only one
+
+    Returns
+    -------
+    None
+
+    '''
+    data = work_dist_data(wf, wr, nbins=nbins, dG=dG, dGerr=dGerr,
+                          units=units, statesProvided=statesProvided)
+    render_work_plot(data, fname=fname, dpi=dpi)
+
+
+# ---------
+# Profiling
+# ---------
+class StageProfiler(object):
+    '''Records the wall time, CPU time and memory of consecutive stages of
+    an analysis, optionally together with a cProfile of the whole run.
+    Calling :meth:`stage` closes the running stage and opens the next one;
+    when disabled, all the methods do nothing.
+
+    For every stage the resident memory at its end (rss_mb) and its change
+    over the stage (rss_delta_mb) are recorded. The peak of the stage
+    itself (peak_rss_mb) needs Linux, where the peak of the process is
+    reset at the start of each stage; elsewhere it is None and only the
+    peak of the run so far (max_rss_so_far_mb) is available.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        whether to record anything. Default is True.
+    cprofile : bool, optional
+        whether to also run cProfile. Default is False.
+
+    Examples
+    --------
+    >>> prof = StageProfiler()
+    >>> prof.stage('parse')
+    >>> prof.stage('bar')
+    >>> prof.dump('results.profile.json')
+    '''
+
+    def __init__(self, enabled=True, cprofile=False):
+        self.enabled = enabled
+        self.stages = []
+        self._current = None
+        self._start = None
+        self._profile = None
+        # peak resident memory of the process before the last reset
+        self._max_rss = 0.
+        if enabled:
+            self._start = self._sample()
+            if cprofile:
+                import cProfile
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+
+    @staticmethod
+    def _sample():
+        t = os.times()
+        return time.time(), t[0] + t[1], t[2] + t[3]
+
+    @staticmethod
+    def _proc_status(key):
+        '''A memory field of /proc/self/status in MiB, or None where
+        unavailable.'''
+        try:
+            with open('/proc/self/status') as f:
+                for l in f:
+                    if l.startswith(key + ':'):
+                        return int(l.split()[1]) / 1024.
+        except (IOError, OSError, ValueError):
+            pass
+        return None
+
+    def _reset_peak(self):
+        '''Resets the peak resident memory of the process (Linux only), so
+        that it covers the next stage only. Returns whether it was reset.'''
+        hwm = self._proc_status('VmHWM')
+        if hwm is None:
+            return False
+        self._max_rss = max(self._max_rss, hwm)
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _peak_rss(self):
+        '''Peak resident memory in MiB of this process and of its waited-for
+        children (e.g. the worker pools) since the start, or None where
+        unavailable.'''
+        try:
+            import resource
+        except ImportError:
+            return None, None
+        # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # ru_maxrss follows the resets of the peak, see _reset_peak
+        hwm = self._proc_status('VmHWM')
+        rss = max([v for v in (rss, self._max_rss, hwm) if v is not None])
+        return rss, children / scale
+
+    def stage(self, name):
+        '''Closes the running stage, if any, and starts stage ``name``.'''
+        if not self.enabled:
+            return
+        self.stop()
+        reset = self._reset_peak()
+        self._current = (name, self._sample(), self._proc_status('VmRSS'),
+                         reset)
+
+    def stop(self):
+        '''Closes the running stage, if any.'''
+        if not self.enabled or self._current is None:
+            return
+        name, (wall0, cpu0, child0), rss0, reset = self._current
+        wall, cpu, child = self._sample()
+        rss = self._proc_status('VmRSS')
+        max_rss, max_rss_children = self._peak_rss()
+        self.stages.append({'name': name,
+                            'wall': wall - wall0,
+                            'cpu': cpu - cpu0,
+                            'cpu_children': child - child0,
+                            'rss_mb': rss,
+                            'rss_delta_mb': None if rss is None or rss0 is None
+                            else rss - rss0,
+                            'peak_rss_mb': self._proc_status('VmHWM')
+                            if reset else None,
+                            'max_rss_so_far_mb': max_rss,
+                            'max_rss_children_so_far_mb': max_rss_children})
+        self._current = None
+
+    def report(self, prof_fn=None, ntop=30):
+        '''Returns the recorded timings as a dictionary. If cProfile was run,
+        its statistics are written to ``prof_fn`` and the ``ntop`` functions
+        with the largest cumulative time are included.'''
+        self.stop()
+        wall, cpu, child = self._sample()
+        rss, rss_children = self._peak_rss()
+        rep = {'command': sys.argv,
+               'stages': self.stages,
+               'total_wall': wall - self._start[0],
+               'total_cpu': cpu - self._start[1],
+               'total_cpu_children': child - self._start[2],
+               'peak_rss_mb': rss,
+               'peak_rss_children_mb': rss_children}
+        if self._profile is not None:
+            import pstats
+            self._profile.disable()
+            if prof_fn is not None:
+                self._profile.dump_stats(prof_fn)
+                rep['cprofile_file'] = prof_fn
+            stats = pstats.Stats(self._profile).stats
+            top = sorted(stats.items(), key=lambda kv: -kv[1][3])[:ntop]
+            rep['cprofile_top'] = [{'function': '%s:%d(%s)' % key,
+                                    'ncalls': nc, 'tottime': tt,
+                                    'cumtime': ct}
+                                   for key, (cc, nc, tt, ct, _) in top]
+        return rep
+
+    def dump(self, fn, prof_fn=None, **extra):
+        '''Writes :meth:`report` as JSON to ``fn``, adding the key-value
+        pairs in ``extra``.'''
+        if not self.enabled:
+            return
+        rep = self.report(prof_fn=prof_fn)
+        rep.update(extra)
+        with open(fn, 'w') as f:
+            json.dump(rep, f, indent=2, sort_keys=True)
+
+
+def _dump_profile(prof, args):
+    '''Writes the profile of a run next to its output file.'''
+    if not prof.enabled:
+        return
+    base = os.path.splitext(args.outfn)[0]
+    prof_fn = base + '.prof' if args.profile == 'cprofile' else None
+    prof.dump(base + '.profile.json', prof_fn=prof_fn,
+              pmx_version=args.pmx_version, nproc=args.nproc)
+    print('\n   Profile written to %s.profile.json' % base)
 
 
 # ---------------------
@@ -470,6 +1301,23 @@ def parse_options():
                         'bootstrap estimate of the standard errors. Default '
                         'is 0 (no bootstrap).',
                         default=100)
+    parser.add_argument('--seed',
+                        metavar='',
+                        dest='seed',
+                        type=int,
+                        help='Seed for the random number generator used in '
+                        'the bootstrap, to make the error estimates '
+                        'reproducible. Default is None (random seed).',
+                        default=None)
+    parser.add_argument('--nproc',
+                        metavar='',
+                        dest='nproc',
+                        type=int,
+                        help='Number of processes to use for reading and '
+                        'integrating the dhdl.xvg files and for the BAR '
+                        'bootstrap. The results do not depend on the number '
+                        'of processes. Default is 1.',
+                        default=1)
     parser.add_argument('-n',
                         metavar='nblocks',
                         dest='nblocks',
@@ -522,6 +1370,65 @@ def parse_options():
                         'for the reverse (B->A) tranformation. Default is '
                         '"integB.dat"',
                         default='integB.dat')
+    parser.add_argument('-iW',
+                        metavar='work archive',
+                        dest='iW',
+                        type=str,
+                        help='Work archive (.npz) containing the forward and '
+                        'reverse work values and the temperature, as written '
+                        'with -oW. Replaces -iA and -iB.')
+    parser.add_argument('-oW',
+                        metavar='work archive',
+                        dest='oW',
+                        type=str,
+                        help='Work archive (.npz) where to save the forward '
+                        'and reverse work values together with the input '
+                        'files, temperature and pmx version. Default is None '
+                        '(no archive).',
+                        default=None)
+    parser.add_argument('--archive_dhdl',
+                        dest='archive_dhdl',
+                        help='Whether to store the dH/dl curves in the work '
+                        'archive as well. Default is False.',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--cache',
+                        metavar='',
+                        dest='cache',
+                        type=str,
+                        help='File in which the integrated work values of '
+                        'the dhdl.xvg files are cached between runs, so that '
+                        'only new or modified files are read again. Default '
+                        'is None (no cache).',
+                        default=None)
+    parser.add_argument('--stream',
+                        metavar='',
+                        dest='stream',
+                        type=int,
+                        help='Integrate the dhdl.xvg files while reading '
+                        'them in chunks of this many lines, keeping memory '
+                        'use constant for very long files. Default is None '
+                        '(read the whole files).',
+                        default=None)
+    parser.add_argument('--watch',
+                        metavar='',
+                        dest='watch',
+                        type=float,
+                        help='Watch mode: every this many seconds, look for '
+                        'newly finished dhdl.xvg files matching -fA/-fB, '
+                        'integrate only those and report the updated '
+                        'estimates. Quote the wildcards (e.g. -fA '
+                        '"./forward_results/dgdl*.xvg") so that new files '
+                        'are found. Default is None (no watch mode).',
+                        default=None)
+    parser.add_argument('--watch_until',
+                        metavar='',
+                        dest='watch_until',
+                        type=int,
+                        help='In watch mode, stop once this many '
+                        'trajectories have been analysed in each direction. '
+                        'Default is None (run until interrupted).',
+                        default=None)
     parser.add_argument('--reverseB',
                         dest='reverseB',
                         help='Whether to reverse the work values for the '
@@ -568,6 +1475,16 @@ def parse_options():
                         'is None (i.e. all dhdl are used).',
                         default=None,
                         nargs='+')
+    parser.add_argument('--bar_solver',
+                        metavar='',
+                        dest='bar_solver',
+                        type=str.lower,
+                        help='How to solve the BAR equation: "brentq" finds '
+                        'the root of the vectorized BAR residual, "simplex" '
+                        'minimizes its square with the Nelder-Mead simplex '
+                        'algorithm. Default is "brentq".',
+                        default='brentq',
+                        choices=['brentq', 'simplex'])
     parser.add_argument('--prec',
                         metavar='',
                         dest='precision',
@@ -596,6 +1513,23 @@ def parse_options():
                         'holds. Default is True; this flag turns it to False.',
                         default=True,
                         action='store_false')
+    parser.add_argument('--conv',
+                        metavar='',
+                        dest='conv_step',
+                        type=int,
+                        help='Compute the estimates and their errors as a '
+                        'function of the number of trajectories, adding this '
+                        'many work values per direction at every point, and '
+                        'write them to the file given with --conv_out. '
+                        'Default is None (no convergence curves).',
+                        default=None)
+    parser.add_argument('--conv_out',
+                        metavar='',
+                        dest='conv_out',
+                        type=str,
+                        help='Output file of the convergence curves. Default '
+                        'is "convergence.dat".',
+                        default='convergence.dat')
     parser.add_argument('--work_plot',
                         metavar='',
                         dest='wplot',
@@ -608,6 +1542,25 @@ def parse_options():
                         'will be chosen following the hierarchy '
                         'BAR > CGI > JARZ.',
                         default='wplot.png')
+    parser.add_argument('--plot_data',
+                        metavar='',
+                        dest='plot_data',
+                        type=str,
+                        help='Write the histograms and Gaussian fits of the '
+                        'work distributions to this .npz file, so that the '
+                        'plot can be rendered later with --render. Combine '
+                        'with "--work_plot none" to skip plotting (and '
+                        'importing matplotlib) altogether. Default is None.',
+                        default=None)
+    parser.add_argument('--render',
+                        metavar='',
+                        dest='render',
+                        type=str,
+                        nargs='+',
+                        help='Only render the plots of the given files '
+                        'written with --plot_data, each to a .png image next '
+                        'to its data file, and exit. Default is None.',
+                        default=None)
     parser.add_argument('--nbins',
                         metavar='',
                         dest='nbins',
@@ -621,6 +1574,22 @@ def parse_options():
                         type=int,
                         help='Resolution of the plot. Default is 300.',
                         default=300)
+    parser.add_argument('--profile',
+                        metavar='',
+                        dest='profile',
+                        type=str,
+                        nargs='?',
+                        const='stages',
+                        choices=['stages', 'cprofile'],
+                        help='Record the wall time, CPU time and peak memory '
+                        'of each stage of the analysis (parsing, the '
+                        'estimators, convergence curves, plotting) and write '
+                        'them as JSON next to the output file, with the '
+                        'extension .profile.json. With "--profile cprofile" '
+                        'the whole run is also profiled with cProfile, whose '
+                        'statistics go to a .prof file and whose top '
+                        'functions are added to the JSON. Default is None.',
+                        default=None)
 
     args, unknown = parser.parse_known_args()
     check_unknown_cmd(unknown)
@@ -640,15 +1609,33 @@ def main(args):
         The command line arguments
     """
 
+    # render plots saved by earlier runs
+    if args.render is not None:
+        for fname in render_work_plots(args.render, dpi=args.dpi):
+            print('   Rendered %s' % fname)
+        return
+
     # start timing
     stime = time.time()
+    prof = StageProfiler(enabled=args.profile is not None,
+                         cprofile=args.profile == 'cprofile')
+    prof.stage('setup')
 
     # input arguments
     filesAB = []
     filesBA = []
     statesProvided = 'AB'
     out = open(args.outfn, 'w')
-    if (args.iA is None) and (args.iB is None):
+    if args.iW is not None:
+        archive = WorkArchive.load(args.iW)
+        statesProvided = ''
+        if len(archive.wf) > 0:
+            statesProvided += 'A'
+        if len(archive.wr) > 0:
+            statesProvided += 'B'
+        if statesProvided != 'AB':
+            _tee(out, 'Only one directional Jarzynski estimator will be used')
+    elif (args.iA is None) and (args.iB is None):
         if (args.filesAB is None) and (args.filesBA is None):
             exit('Need to provide dhdl.xvg files or integrated work values')
         elif args.filesAB is None:
@@ -669,6 +1656,9 @@ def main(args):
             statesProvided = 'A'
         _tee(out, 'Only one directional Jarzynski estimator will be used')
     T = args.temperature
+    if args.iW is not None:
+        # the temperature the work values were obtained at
+        T = archive.T
     skip = args.skip
     prec = args.precision
     methods = args.methods
@@ -676,6 +1666,8 @@ def main(args):
     integ_only = args.integ_only
     nboots = args.nboots
     nblocks = args.nblocks
+    seed = args.seed
+    nproc = args.nproc
     do_ks_test = args.do_ks_test
 
     # -------------------
@@ -701,12 +1693,23 @@ def main(args):
     print("# command = %s" % ' '.join(sys.argv), file=out)
     _tee(out, "\n")
 
+    # ==========
+    # Watch mode
+    # ==========
+    if args.watch is not None:
+        watch_dgdl_files(args.filesAB, args.filesBA, interval=args.watch,
+                         T=T, reverseB=reverseB, nboots=nboots, seed=seed,
+                         nproc=nproc, until=args.watch_until, out=out,
+                         unit_fact=unit_fact, units=units, prec=prec)
+        out.close()
+        return
+
     # ==========
     # Parse Data
     # ==========
 
     # If list of dgdl.xvg files are provided, parse dgdl
-    if args.iA is None and args.iB is None:
+    if args.iA is None and args.iB is None and args.iW is None:
         # If random selection is chosen, do this before reading files and
         # calculating the work values.
         if args.rand is not None:
@@ -761,25 +1764,53 @@ def main(args):
         print(' ========================================================')
         res_ab = []
         res_ba = []
+        cache = None
+        if args.cache is not None:
+            cache = WorkCache(args.cache)
         if 'A' in statesProvided:
+            prof.stage('parse_forward')
             print('  Forward Data')
-            res_ab = parse_dgdl_files(filesAB, lambda0=0,invert_values=False)
+            res_ab, filesAB = parse_dgdl_files(filesAB, lambda0=0,
+                                               invert_values=False,
+                                               nproc=nproc, cache=cache,
+                                               chunksize=args.stream,
+                                               return_files=True)
             _dump_integ_file(args.oA, filesAB, res_ab)
         if 'B' in statesProvided:
+            prof.stage('parse_reverse')
             print('  Reverse Data')
-            res_ba = parse_dgdl_files(filesBA, lambda0=1,invert_values=reverseB)
+            res_ba, filesBA = parse_dgdl_files(filesBA, lambda0=1,
+                                               invert_values=reverseB,
+                                               nproc=nproc, cache=cache,
+                                               chunksize=args.stream,
+                                               return_files=True)
             _dump_integ_file(args.oB, filesBA, res_ba)
+        if cache is not None:
+            cache.save()
+        if args.oW is not None:
+            prof.stage('write_archive')
+            _dump_work_archive(args.oW, filesAB, res_ab, filesBA, res_ba, T,
+                               args.pmx_version,
+                               with_dhdl=args.archive_dhdl)
 
     # If work values are given as input instead, read those
-    elif args.iA is not None or args.iB is not None:
+    elif args.iA is not None or args.iB is not None or args.iW is not None:
+        prof.stage('read_work')
         res_ab = []
         res_ba = []
-        if 'A' in statesProvided:
-            print('  Reading integrated values (A->B) from', args.iA)
-            res_ab.extend(_data_from_file(args.iA))
-        if 'B' in statesProvided:
-            print('  Reading integrated values (B->A) from', args.iB)
-            res_ba.extend(_data_from_file(args.iB))
+        if args.iW is not None:
+            print('  Reading work values from', args.iW)
+            print('  (pmx version %s, T = %.2f K)'
+                  % (archive.pmx_version, archive.T))
+            res_ab = archive.wf
+            res_ba = archive.wr
+        else:
+            if 'A' in statesProvided:
+                print('  Reading integrated values (A->B) from', args.iA)
+                res_ab.extend(_data_from_file(args.iA))
+            if 'B' in statesProvided:
+                print('  Reading integrated values (B->A) from', args.iB)
+                res_ba.extend(_data_from_file(args.iB))
         # If slice values provided, select the files needed.
         if args.slice is not None:
             first = args.slice[0]
@@ -796,6 +1827,7 @@ def main(args):
 
     # If asked to only do the integration of dhdl.xvg, exit
     if integ_only:
+        _dump_profile(prof, args)
         print('\n    Integration done. Skipping analysis.')
         print('\n    ......done........\n')
         sys.exit(0)
@@ -820,8 +1852,10 @@ def main(args):
         _tee(out, '             Crooks Gaussian Intersection     ')
         _tee(out, ' --------------------------------------------------------')
 
+        prof.stage('cgi')
         print('  Calculating Intersection...')
-        cgi = Crooks(wf=res_ab, wr=res_ba, nboots=nboots, nblocks=nblocks)
+        cgi = Crooks(wf=res_ab, wr=res_ba, nboots=nboots, nblocks=nblocks,
+                     seed=seed)
         if args.pickle is True:
             pickle.dump(cgi, open("cgi_results.pkl", "wb"))
 
@@ -855,6 +1889,7 @@ def main(args):
     # Normality test
     # --------------
     if do_ks_test and 'AB' in statesProvided:
+        prof.stage('ks_test')
         print('\n  Running KS-test...')
         q0, lam00, check0, bOk0 = ks_norm_test(res_ab)
         q1, lam01, check1, bOk1 = ks_norm_test(res_ba)
@@ -880,9 +1915,16 @@ def main(args):
         _tee(out, '             Bennett Acceptance Ratio     ')
         _tee(out, ' --------------------------------------------------------')
 
-        print('  Running Nelder-Mead Simplex algorithm... ')
+        prof.stage('bar')
+        if args.bar_solver == 'simplex':
+            print('  Running Nelder-Mead Simplex algorithm... ')
+        else:
+            print('  Running Brent root finder... ')
 
-        bar = BAR(res_ab, res_ba, T=T, nboots=nboots, nblocks=nblocks)
+        # the bootstrap and block errors are timed as stages of their own
+        bar = BAR(res_ab, res_ba, T=T, nboots=nboots, nblocks=nblocks,
+                  solver=args.bar_solver, seed=seed, n_jobs=nproc,
+                  stage=lambda name: prof.stage('bar_' + name))
         if args.pickle:
             pickle.dump(bar, open("bar_results.pkl", "wb"))
 
@@ -907,7 +1949,8 @@ def main(args):
         _tee(out, '             Jarzynski estimator     ')
         _tee(out, ' --------------------------------------------------------')
 
-        jarz = Jarz(wf=res_ab, wr=res_ba, T=T, nboots=nboots, nblocks=nblocks, statesProvided=statesProvided)
+        prof.stage('jarz')
+        jarz = Jarz(wf=res_ab, wr=res_ba, T=T, nboots=nboots, nblocks=nblocks, statesProvided=statesProvided, seed=seed)
         if args.pickle:
             pickle.dump(jarz, open("jarz_results.pkl", "wb"))
 
@@ -940,8 +1983,9 @@ def main(args):
         # -------------------------------------
         # Jarzynski with Gaussian approximation
         # -------------------------------------
+        prof.stage('jarz_gauss')
         print('Running Jarzynski Gaussian approximation analysis...')
-        jarzGauss = JarzGauss(wf=res_ab, wr=res_ba, T=T, nboots=nboots, nblocks=nblocks, statesProvided=statesProvided)
+        jarzGauss = JarzGauss(wf=res_ab, wr=res_ba, T=T, nboots=nboots, nblocks=nblocks, statesProvided=statesProvided, seed=seed)
         if args.pickle:
             pickle.dump(jarzGauss, open("jarz_gauss_results.pkl", "wb"))
 
@@ -974,12 +2018,24 @@ def main(args):
 
     _tee(out, ' ========================================================')
 
+    # ------------------
+    # convergence curves
+    # ------------------
+    if args.conv_step is not None:
+        prof.stage('convergence')
+        print('\n   Computing convergence curves......')
+        conv = convergence(res_ab, res_ba, T=T, step=args.conv_step,
+                           nboots=nboots, solver=args.bar_solver, seed=seed)
+        _dump_conv_file(args.conv_out, conv, unit_fact, units, prec)
+
     # -----------------------
     # plot work distributions
     # -----------------------
-    if args.wplot.lower() != 'none':
-        print('\n   Plotting histograms......')
+    do_plot = args.wplot.lower() != 'none'
+    if do_plot or args.plot_data is not None:
         # hierarchy of estimators: BAR > Crooks > Jarz
+        show_dg = None
+        show_err = None
         if 'bar' in locals():
             show_dg = bar.dg * unit_fact
             # hierarchy of error estimates : blocks > boots > analytical
@@ -989,10 +2045,6 @@ def main(args):
                 show_err = bar.err_boot * unit_fact
             else:
                 show_err = bar.err * unit_fact
-            # plot
-            plot_work_dist(fname=args.wplot, wf=res_ab, wr=res_ba, dG=show_dg,
-                           dGerr=show_err, nbins=args.nbins, dpi=args.dpi,
-                           units=units)
         elif 'bar' not in locals() and 'cgi' in locals():
             show_dg = cgi.dg * unit_fact
             # hierarchy of error estimates : blocks > boots
@@ -1000,12 +2052,6 @@ def main(args):
                 show_err = cgi.err_blocks * unit_fact
             elif hasattr(cgi, 'err_boot2') and not hasattr(cgi, 'err_blocks'):
                 show_err = cgi.err_boot2 * unit_fact
-            else:
-                show_err = None
-            # plot
-            plot_work_dist(fname=args.wplot, wf=res_ab, wr=res_ba, dG=show_dg,
-                           dGerr=show_err, nbins=args.nbins, dpi=args.dpi,
-                           units=units)
         elif 'bar' not in locals() and 'cgi' not in locals() and 'jarz' in locals():
             # for the moment, show values only under specific circumstances
             if hasattr(jarz, 'dg_mean'):
@@ -1014,14 +2060,19 @@ def main(args):
                 show_dg = jarz.dg_for
             elif 'B' in statesProvided:
                 show_dg = jarz.dg_rev
-            else:
-                show_dg = None
-            show_err = None
-            # plot
-            plot_work_dist(fname=args.wplot, wf=res_ab, wr=res_ba, dG=show_dg,
-                           dGerr=show_err, nbins=args.nbins, dpi=args.dpi,
-                           units=units,statesProvided=statesProvided)
-
+        prof.stage('plot_data')
+        plot_data = work_dist_data(wf=res_ab, wr=res_ba, nbins=args.nbins,
+                                   dG=show_dg, dGerr=show_err, units=units,
+                                   statesProvided=statesProvided)
+        if args.plot_data is not None:
+            print('\n   Writing histograms to %s......' % args.plot_data)
+            save_work_plot_data(args.plot_data, plot_data)
+        if do_plot:
+            prof.stage('plot_render')
+            print('\n   Plotting histograms......')
+            render_work_plot(plot_data, fname=args.wplot, dpi=args.dpi)
+
+    _dump_profile(prof, args)
     print('\n   ......done...........\n')
 
     if args.pickle:
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# pmx  Copyright Notice
+# ============================
+#
+# The pmx source code is copyrighted, but you can freely use and
+# copy it as long as you don't change or remove any of the copyright
+# notices.
+#
+# ----------------------------------------------------------------------
+# pmx is Copyright (C) 2006-2017 by Daniel Seeliger
+#
+#                        All Rights Reserved
+#
+# Permission to use, copy, modify, distribute, and distribute modified
+# versions of this software and its documentation for any purpose and
+# without fee is hereby granted, provided that the above copyright
+# notice appear in all copies and that both the copyright notice and
+# this permission notice appear in supporting documentation, and that
+# the name of Daniel Seeliger not be used in advertising or publicity
+# pertaining to distribution of the software without specific, written
+# prior permission.
+#
+# DANIEL SEELIGER DISCLAIMS ALL WARRANTIES WITH REGARD TO THIS
+# SOFTWARE, INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS.  IN NO EVENT SHALL DANIEL SEELIGER BE LIABLE FOR ANY
+# SPECIAL, INDIRECT OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+# ----------------------------------------------------------------------
+
+from __future__ import print_function, division
+from pmx.parser import read_dhdl_foreign
+from pmx.estimators import MBAR
+from analyze_dhdl import natural_sort, time_stats
+from cli import check_unknown_cmd
+import os
+import time
+import argparse
+import numpy as np
+
+# Constants
+kb = 0.00831447215   # kJ/(K*mol)
+
+
+# ==============================================================================
+#                               FUNCTIONS
+# ==============================================================================
+def mbar_input_from_dhdl(files, T=None, begin=0., stride=1):
+    '''Builds the reduced potential matrix for MBAR from the dhdl.xvg files
+    of a set of lambda windows, using the energy differences to all lambda
+    states written by Gromacs (calc-lambda-neighbors = -1).
+
+    Parameters
+    ----------
+    files : list
+        the dhdl.xvg files, one (or more) per simulated lambda state.
+    T : float, optional
+        temperature in Kelvin. Default is the one found in the files.
+    begin : float, optional
+        frames with a time (ps) before begin are discarded. Default is 0.
+    stride : int, optional
+        use only every stride-th frame. Default is 1.
+
+    Returns
+    -------
+    u_kn : ndarray
+        (K x N) reduced potentials.
+    N_k : ndarray
+        number of samples from each state.
+    lambdas : list
+        the lambda values of the K states.
+    T : float
+        the temperature used.
+    '''
+    blocks = []
+    lambdas = None
+    for i, fn in enumerate(files):
+        t, dh, lams, state, Tf = read_dhdl_foreign(fn)
+        if lambdas is None:
+            lambdas = lams
+        elif lams != lambdas:
+            raise ValueError('%s has different foreign lambda states than %s'
+                             % (fn, files[0]))
+        if state is None:
+            # no state in the header, assume one file per state in order
+            state = i
+        if T is None:
+            T = Tf
+        print('    %s: state %d, %d frames' % (fn, state, len(t)))
+        blocks.append((state, dh[t >= begin][::stride]))
+    if T is None:
+        T = 298.15
+    beta = 1./(kb*T)
+
+    K = len(lambdas)
+    N_k = np.zeros(K, dtype=int)
+    for state, dh in blocks:
+        N_k[state] += len(dh)
+    # only differences between the states of every sample matter, hence
+    # the energy of the simulated state can be left out
+    u_kn = np.empty((K, N_k.sum()))
+    i = 0
+    for state, dh in sorted(blocks, key=lambda b: b[0]):
+        u_kn[:, i:i+len(dh)] = beta * dh.T
+        i += len(dh)
+    return u_kn, N_k, lambdas, T
+
+
+# ==============================================================================
+#                      COMMAND LINE OPTIONS AND MAIN
+# ==============================================================================
+def parse_options():
+
+    parser = argparse.ArgumentParser(description='Calculates the free '
+            'energy differences between the lambda states of discrete TI '
+            '(equilibrium) simulations with MBAR. The dhdl.xvg files need to '
+            'contain the energy differences to all lambda states, i.e. the '
+            'simulations need to be run with calc-lambda-neighbors = -1.')
+
+    parser.add_argument('-f',
+                        metavar='dhdl',
+                        dest='files',
+                        type=str,
+                        help='dhdl.xvg files, one for every lambda window.',
+                        required=True,
+                        nargs='+')
+    parser.add_argument('-o',
+                        metavar='result file',
+                        dest='outfn',
+                        type=str,
+                        help='Results file. Default is "mbar_results.txt".',
+                        default='mbar_results.txt')
+    parser.add_argument('-t',
+                        metavar='temperature',
+                        dest='temperature',
+                        type=float,
+                        help='Temperature in Kelvin. Default is the one '
+                        'found in the dhdl.xvg files, or 298.15.',
+                        default=None)
+    parser.add_argument('-b',
+                        metavar='begin',
+                        dest='begin',
+                        type=float,
+                        help='Time (ps) of the first frame to use. Default '
+                        'is 0.',
+                        default=0.)
+    parser.add_argument('--stride',
+                        metavar='',
+                        dest='stride',
+                        type=int,
+                        help='Use only every n-th frame. Default is 1.',
+                        default=1)
+    parser.add_argument('--chunk',
+                        metavar='',
+                        dest='chunk',
+                        type=int,
+                        help='Number of samples evaluated at once by MBAR. '
+                        'Default is 100000.',
+                        default=100000)
+    parser.add_argument('--units',
+                        metavar='',
+                        dest='units',
+                        type=str.lower,
+                        help='The units of the output. Choose from "kJ", '
+                        '"kcal", "kT". Default is "kJ."',
+                        default='kJ',
+                        choices=['kj', 'kcal', 'kt'])
+    parser.add_argument('--prec',
+                        metavar='',
+                        dest='precision',
+                        type=int,
+                        help='The decimal precision of the file output.'
+                        ' Default is 2.',
+                        default=2)
+
+    args, unknown = parser.parse_known_args()
+    check_unknown_cmd(unknown)
+
+    from pmx import __version__
+    args.pmx_version = __version__
+
+    return args
+
+
+def main(args):
+    """Run the main script.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments
+    """
+
+    stime = time.time()
+    prec = args.precision
+
+    print('  Reading dhdl.xvg files')
+    u_kn, N_k, lambdas, T = mbar_input_from_dhdl(natural_sort(args.files),
+                                                 T=args.temperature,
+                                                 begin=args.begin,
+                                                 stride=args.stride)
+    print('  Running MBAR on %d states, %d samples' % (len(N_k), N_k.sum()))
+    mbar = MBAR(u_kn, N_k, T=T, chunksize=args.chunk)
+    if not mbar.converged:
+        print('  MBAR: not converged after %d iterations' % mbar.niter)
+
+    units = args.units
+    if units == 'kj':
+        unit_fact = 1.
+        units = 'kJ/mol'
+    elif units == 'kcal':
+        unit_fact = 1./4.184
+        units = 'kcal/mol'
+    elif units == 'kt':
+        unit_fact = 1./(kb*T)
+        units = 'kT'
+
+    def fmt(v):
+        return '{0:10.{p}f}'.format(v*unit_fact, p=prec)
+
+    with open(args.outfn, 'w') as out:
+        print("# analyze_mbar.py, pmx version = %s" % args.pmx_version,
+              file=out)
+        print("# pwd = %s" % os.getcwd(), file=out)
+        print("# %s (%s)" % (time.asctime(), os.environ.get('USER')),
+              file=out)
+        print("# units = %s, T = %.2f K, %d iterations%s"
+              % (units, T, mbar.niter,
+                 '' if mbar.converged else ' (not converged)'), file=out)
+        print("# state  lambda  N  dG(0->state)  err  dG(state-1->state)  "
+              "err", file=out)
+        for k, lam in enumerate(lambdas):
+            row = ['%5d' % k, ','.join('%.4f' % l for l in lam),
+                   '%8d' % N_k[k], fmt(mbar.dg[0, k]), fmt(mbar.err[0, k])]
+            if k > 0:
+                row += [fmt(mbar.dg[k-1, k]), fmt(mbar.err[k-1, k])]
+            print('  '.join(row), file=out)
+
+    print('\n  MBAR: dG = {dg:8.{p}f} {u}'.format(dg=mbar.dg[0, -1]*unit_fact,
+                                                 p=prec, u=units))
+    print('  MBAR: Std Err (analytical) = {e:8.{p}f} {u}'.format(
+          e=mbar.err[0, -1]*unit_fact, p=prec, u=units))
+
+    h, m, s = time_stats(time.time()-stime)
+    print("\n   Execution time = %02d:%02d:%02d\n" % (h, m, s))
+
+
+def entry_point():
+    args = parse_options()
+    main(args)
+
+
+if __name__ == '__main__':
+    entry_point()
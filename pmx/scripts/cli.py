@@ -19,6 +19,8 @@ class PmxCli:
         mutate       Mutate protein or DNA/RNA
         gentop       Fill hybrid topology with B states
         analyse      Estimate free energy from Gromacs xvg files
+        batch        Estimate free energies for many edges at once
+        mbar         Estimate free energies of lambda windows with MBAR
 
         gmxlib       Show/set GMXLIB path''',
             formatter_class=RawTextHelpFormatter)
@@ -48,6 +50,14 @@ class PmxCli:
         import analyze_dhdl
         analyze_dhdl.entry_point()
 
+    def batch(self):
+        import analyze_batch
+        analyze_batch.entry_point()
+
+    def mbar(self):
+        import analyze_mbar
+        analyze_mbar.entry_point()
+
     def gmxlib(self):
         import set_gmxlib
         set_gmxlib.entry_point()
@@ -58,7 +68,7 @@ def check_unknown_cmd(unknowns):
     commands are found.
     '''
     expected = ['pmx', 'analyse', 'mutate', 'doublebox', 'gentop', 'gmxlib',
-                'genlib', 'abfe']
+                'genlib', 'abfe', 'batch', 'mbar']
 
     for cmd in unknowns:
         if cmd not in expected:
@@ -0,0 +1,146 @@
+"""Archive of the non-equilibrium work values of an edge.
+
+A :class:`WorkArchive` holds the forward and reverse work values of a whole
+edge together with the dhdl.xvg files they were integrated from, the
+temperature, the pmx version and, optionally, the dH/dl curves themselves.
+It is stored as a NumPy .npz file whose members are not compressed, so that
+the large arrays can be memory mapped when the archive is read back::
+
+    >>> arch = WorkArchive(wf, wr, files_for, files_rev, T=298.15)
+    >>> arch.save('edge_26_44.npz')
+    >>> arch = WorkArchive.load('edge_26_44.npz')
+    >>> bar = BAR(arch)
+"""
+
+import zipfile
+import numpy as np
+
+# arrays that are memory mapped when reading an archive
+MMAP_ARRAYS = ['wf', 'wr', 'dhdl_for', 'dhdl_rev']
+
+
+class WorkArchive(object):
+    '''Forward and reverse work values of an edge, with their provenance.
+    All the estimators accept an archive in place of the work values.
+
+    Parameters
+    ----------
+    wf : array_like
+        forward work values.
+    wr : array_like
+        reverse work values.
+    files_for : list of str, optional
+        the dhdl.xvg files the forward work values were obtained from.
+    files_rev : list of str, optional
+        the dhdl.xvg files the reverse work values were obtained from.
+    T : float, optional
+        temperature in Kelvin. Default is 298.15.
+    pmx_version : str, optional
+        version of pmx that produced the work values. Default is the version
+        in use.
+    dhdl_for : array_like, optional
+        the forward dH/dl curves, of shape (n_traj x n_frames).
+    dhdl_rev : array_like, optional
+        the reverse dH/dl curves, of shape (n_traj x n_frames).
+
+    Attributes
+    ----------
+    wf, wr, files_for, files_rev, T, pmx_version, dhdl_for, dhdl_rev
+        as above; dhdl_for and dhdl_rev are None if not stored.
+    '''
+
+    def __init__(self, wf=(), wr=(), files_for=(), files_rev=(), T=298.15,
+                 pmx_version=None, dhdl_for=None, dhdl_rev=None):
+        self.wf = np.asarray(wf, dtype=float)
+        self.wr = np.asarray(wr, dtype=float)
+        self.files_for = [str(f) for f in files_for]
+        self.files_rev = [str(f) for f in files_rev]
+        self.T = float(T)
+        if pmx_version is None:
+            from pmx import __version__ as pmx_version
+        self.pmx_version = str(pmx_version)
+        self.dhdl_for = dhdl_for
+        self.dhdl_rev = dhdl_rev
+
+    def save(self, fn):
+        '''Writes the archive to a .npz file (the extension is added if
+        missing). The members are stored uncompressed, so that they can be
+        memory mapped by :meth:`load`.
+
+        Parameters
+        ----------
+        fn : str
+            the output file.
+        '''
+        arrays = {'wf': self.wf,
+                  'wr': self.wr,
+                  'files_for': np.array(self.files_for, dtype=np.unicode_),
+                  'files_rev': np.array(self.files_rev, dtype=np.unicode_),
+                  'T': np.array(self.T),
+                  'pmx_version': np.array(self.pmx_version,
+                                          dtype=np.unicode_)}
+        if self.dhdl_for is not None:
+            arrays['dhdl_for'] = np.asarray(self.dhdl_for, dtype=np.float32)
+        if self.dhdl_rev is not None:
+            arrays['dhdl_rev'] = np.asarray(self.dhdl_rev, dtype=np.float32)
+        np.savez(fn, **arrays)
+
+    @classmethod
+    def load(cls, fn, mmap_mode='r'):
+        '''Reads an archive written by :meth:`save`.
+
+        Parameters
+        ----------
+        fn : str
+            the .npz file.
+        mmap_mode : str or None, optional
+            memory mapping mode of the work values and dH/dl curves (see
+            ``numpy.memmap``). Default is 'r'; with None the arrays are read
+            into memory. Compressed archives are always read into memory.
+
+        Returns
+        -------
+        arch : WorkArchive
+        '''
+        arrays = {}
+        with np.load(fn) as npz:
+            for key in npz.files:
+                arr = None
+                if mmap_mode is not None and key in MMAP_ARRAYS:
+                    arr = _mmap_npz_member(fn, key + '.npy', mmap_mode)
+                if arr is None:
+                    arr = npz[key]
+                arrays[key] = arr
+        return cls(wf=arrays['wf'], wr=arrays['wr'],
+                   files_for=arrays['files_for'],
+                   files_rev=arrays['files_rev'],
+                   T=arrays['T'], pmx_version=arrays['pmx_version'],
+                   dhdl_for=arrays.get('dhdl_for'),
+                   dhdl_rev=arrays.get('dhdl_rev'))
+
+
+def _mmap_npz_member(fn, name, mmap_mode):
+    '''Memory maps a .npy member of an uncompressed .npz file. Returns None
+    if the member is compressed or holds Python objects.'''
+    with zipfile.ZipFile(fn) as zf:
+        info = zf.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fn, 'rb') as fp:
+        # the local file header has a fixed size of 30 bytes, followed by
+        # the file name and an extra field of variable length
+        fp.seek(info.header_offset + 26)
+        nname, nextra = np.frombuffer(fp.read(4), dtype='<u2')
+        fp.seek(info.header_offset + 30 + int(nname) + int(nextra))
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(fp)
+        offset = fp.tell()
+    if dtype.hasobject:
+        return None
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode=mmap_mode, offset=offset,
+                     shape=shape, order='F' if fortran else 'C')
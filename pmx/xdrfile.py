@@ -30,8 +30,11 @@
 #  Adapted by Daniel Seeliger for use in the pmx package (Aug 2015)
 #
 import numpy as np
+from numpy import empty, float32
+from numpy.ctypeslib import ndpointer
 from ctypes import *
 import os.path
+import struct
 
 mTrr,mNumPy=1,2
 auto_mode=0
@@ -40,14 +43,16 @@ out_mode=42
 
 class Frame:
     #variables
-    #x: rvec*natoms / numpy array if installed
+    #x: rvec*natoms / numpy array if installed, None if not read (fields)
     #box DIM*DIM
     #step 
     #time 
     #prec 
     #lam: lambda
+    #v, f: velocities and forces (.trr), only if written or read (fields)
+    #has: fields present in a .trr frame, 1: x, 2: v, 4: f
 
-    def __init__(self,n,mode,x=None,box=None,units=None,v=None,f=None):
+    def __init__(self,n,mode,x=None,box=None,units=None,v=None,f=None,fields=('x',)):
         #create vector for x
         self.natoms = n
         # x (coordinates)
@@ -61,20 +66,27 @@ class Frame:
                 for dim in range(0,3):
                     self.x[a][dim] = scale*x[i]
                     i+=1
+        elif 'x' not in fields:
+            self.x=None
         elif mode&mNumPy and mode!=out_mode:
             self.x=empty((n,3),dtype=float32)
         else:
             self.x=((c_float*3)*n)() 
 
-        # dummy v and f for .trr
+        # v and f for .trr, a NULL pointer if not used
         self.v_size = c_size_t(0)
         self.f_size = c_size_t(0)
-        if mode&mNumPy and mode!=out_mode:
-            self.v=empty((n,3),dtype=float32)
-            self.f=empty((n,3),dtype=float32)
+        if mode==out_mode:
+            # velocities scale as lengths, forces inversely
+            self.v=c_size_t(0) if v is None else _c_rvecs(v,n,scale)
+            self.f=c_size_t(0) if f is None else _c_rvecs(f,n,1.0/scale)
+        elif mode&mNumPy:
+            self.v=empty((n,3),dtype=float32) if 'v' in fields else None
+            self.f=empty((n,3),dtype=float32) if 'f' in fields else None
         else:
-            self.v=c_size_t(0)#((c_float*3)*n)()
-            self.f=c_size_t(0)#((c_float*3)*n)()
+            self.v=((c_float*3)*n)() if 'v' in fields else c_size_t(0)
+            self.f=((c_float*3)*n)() if 'f' in fields else c_size_t(0)
+        self.has = 0
 
         # box
         if box!=None:
@@ -139,11 +151,248 @@ class Frame:
 
 
 
+def _c_rvecs(vals, n, scale=1.0):
+    # ctypes rvec array from n*3 values
+    a = np.ascontiguousarray(np.reshape(vals, (n, 3)), dtype=np.float32)*scale
+    a = a.astype(np.float32)
+    r = ((c_float*3)*n)()
+    memmove(r, a.ctypes.data, a.nbytes)
+    return r
+
+
+def _ptr(a):
+    # address of an optional array, NULL if None
+    return None if a is None else a.ctypes.data
+
+
+class FrameChunk:
+    """A block of consecutive frames decoded into NumPy arrays:
+
+        x      (nframes, natoms, 3) float32 coordinates
+        v      (nframes, natoms, 3) float32 velocities (trr only)
+        f      (nframes, natoms, 3) float32 forces (trr only)
+        has    (nframes,) int32 fields present in each frame, 1: x, 2: v, 4: f
+        box    (nframes, 3, 3) float32 box vectors
+        time   (nframes,) float32 times
+        step   (nframes,) int32 steps
+        prec   (nframes,) float32 precisions (xtc only)
+        lam    (nframes,) float32 lambda values (trr only)
+        first  number of the first frame in the file
+        nframes  number of frames held
+
+    The arrays are allocated once, for capacity frames, and filled in place
+    by XDRFile.read_chunk; after a short read they are views of the first
+    nframes entries. Of x, v and f only the fields requested are allocated,
+    the others are None.
+    """
+
+    def __init__(self, capacity, natoms, fields=('x',)):
+        self.capacity = capacity
+        self.natoms = natoms
+        self.fields = tuple(fields)
+        for name in ('x', 'v', 'f'):
+            arr = None
+            if name in self.fields:
+                arr = np.zeros((capacity, natoms, 3), dtype=np.float32)
+            setattr(self, '_' + name, arr)
+        self._has = np.zeros(capacity, dtype=np.int32)
+        self._box = np.zeros((capacity, 3, 3), dtype=np.float32)
+        self._time = np.zeros(capacity, dtype=np.float32)
+        self._step = np.zeros(capacity, dtype=np.int32)
+        self._prec = np.zeros(capacity, dtype=np.float32)
+        self._lam = np.zeros(capacity, dtype=np.float32)
+        self.first = 0
+        self._set_size(0)
+
+    def _set_size(self, n):
+        self.nframes = n
+        for name in ('x', 'v', 'f'):
+            arr = getattr(self, '_' + name)
+            setattr(self, name, None if arr is None else arr[:n])
+        self.has = self._has[:n]
+        self.box = self._box[:n]
+        self.time = self._time[:n]
+        self.step = self._step[:n]
+        self.prec = self._prec[:n]
+        self.lam = self._lam[:n]
+
+    def __len__(self):
+        return self.nframes
+
+    def __getstate__(self):
+        # the views are rebuilt on unpickling, so the data is sent once
+        state = self.__dict__.copy()
+        for key in ('x', 'v', 'f', 'has', 'box', 'time', 'step', 'prec', 'lam'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_size(self.nframes)
+
+    def __str__(self):
+        return '< xdrlib.FrameChunk: natoms = %d | frames %d-%d >' % (
+            self.natoms, self.first, self.first + self.nframes - 1)
+
+
+XTC_MAGIC = 1995
+TRR_MAGIC = 1993
+
+
+class FrameIndex:
+    """Byte offsets, steps and times of the frames of an xtc or trr file.
+
+    The index is built by reading only the frame headers, and can be stored
+    next to the trajectory (see index_filename) so that the scan is done once::
+
+        >>> idx = frame_index('traj.xtc')
+        >>> len(idx), idx.offsets[5000], idx.times[5000]
+    """
+
+    def __init__(self, offsets, steps, times, natoms=0, size=0, mtime=0.):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.natoms = int(natoms)
+        self.size = int(size)
+        self.mtime = float(mtime)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def scan(cls, fn, ft="Auto"):
+        """Builds the index of file fn by scanning its frame headers. A
+        truncated last frame is not included."""
+        if ft == "Auto":
+            ft = os.path.splitext(fn)[1][1:]
+        if ft == "xtc":
+            read_header = _xtc_frame_header
+        elif ft == "trr":
+            read_header = _trr_frame_header
+        else:
+            raise IOError("Only xtc and trr supported")
+        st = os.stat(fn)
+        offsets, steps, times = [], [], []
+        natoms = 0
+        pos = 0
+        with open(fn, 'rb') as fp:
+            while pos < st.st_size:
+                fp.seek(pos)
+                head = read_header(fp)
+                if head is None:
+                    break
+                natoms, step, time, framesize = head
+                if pos + framesize > st.st_size:
+                    break
+                offsets.append(pos)
+                steps.append(step)
+                times.append(time)
+                pos += framesize
+        return cls(offsets, steps, times, natoms, st.st_size, st.st_mtime)
+
+    def save(self, fn):
+        """Writes the index to the .npz file fn."""
+        np.savez(fn, offsets=self.offsets, steps=self.steps, times=self.times,
+                 natoms=self.natoms, size=self.size, mtime=self.mtime)
+
+    @classmethod
+    def load(cls, fn):
+        """Reads an index written by save."""
+        with np.load(fn) as npz:
+            return cls(npz['offsets'], npz['steps'], npz['times'],
+                       npz['natoms'], npz['size'], npz['mtime'])
+
+    def is_valid_for(self, fn):
+        """Whether the index still matches the size and modification time of
+        trajectory fn."""
+        st = os.stat(fn)
+        return self.size == st.st_size and self.mtime == float(st.st_mtime)
+
+
+def index_filename(fn):
+    """Name of the file the frame index of trajectory fn is stored in: a hidden
+    .npz file in the same directory."""
+    head, tail = os.path.split(os.path.abspath(fn))
+    return os.path.join(head, '.%s_offsets.npz' % tail)
+
+
+def frame_index(fn, ft="Auto", persist=True):
+    """Returns the FrameIndex of trajectory fn. A stored index is used if it
+    is still valid; otherwise the file is scanned and, with persist, the
+    index is stored next to it (silently skipped if that is not possible).
+    """
+    idxfn = index_filename(fn)
+    if os.path.isfile(idxfn):
+        try:
+            idx = FrameIndex.load(idxfn)
+            if idx.is_valid_for(fn):
+                return idx
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    idx = FrameIndex.scan(fn, ft)
+    if persist:
+        try:
+            idx.save(idxfn)
+        except (IOError, OSError):
+            pass
+    return idx
+
+
+def _xtc_frame_header(fp):
+    # magic, natoms, step, time, box[9], natoms; then either 3*natoms floats
+    # or prec, minint[3], maxint[3], smallidx, nbytes and the packed bytes
+    buf = fp.read(92)
+    if len(buf) < 56:
+        return None
+    magic, natoms, step = struct.unpack('>3i', buf[:12])
+    if magic != XTC_MAGIC:
+        raise IOError("Bad xtc frame header at byte %d" % (fp.tell()-len(buf)))
+    time = struct.unpack('>f', buf[12:16])[0]
+    if natoms <= 9:
+        return natoms, step, time, 56 + 12*natoms
+    if len(buf) < 92:
+        return None
+    nbytes = struct.unpack('>i', buf[88:92])[0]
+    return natoms, step, time, 92 + 4*((nbytes + 3)//4)
+
+
+def _trr_frame_header(fp):
+    buf = fp.read(12)
+    if len(buf) < 12:
+        return None
+    magic, slen, strlen = struct.unpack('>3i', buf)
+    if magic != TRR_MAGIC:
+        raise IOError("Bad trr frame header at byte %d" % (fp.tell()-len(buf)))
+    headsize = 12 + 4*((strlen + 3)//4)
+    fp.seek(headsize - 12, 1)
+    buf = fp.read(52)
+    if len(buf) < 52:
+        return None
+    (ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size,
+     x_size, v_size, f_size, natoms, step, nre) = struct.unpack('>13i', buf)
+    if box_size:
+        flsz = box_size // 9
+    elif x_size or v_size or f_size:
+        flsz = (x_size or v_size or f_size) // (natoms*3)
+    else:
+        raise IOError("Cannot determine the precision of trr frame")
+    buf = fp.read(2*flsz)
+    if len(buf) < 2*flsz:
+        return None
+    time = struct.unpack('>d' if flsz == 8 else '>f', buf[:flsz])[0]
+    headsize += 52 + 2*flsz
+    body = box_size + vir_size + pres_size + x_size + v_size + f_size
+    return natoms, step, time, headsize + body
+
+
 class XDRFile:
     exdrOK, exdrHEADER, exdrSTRING, exdrDOUBLE, exdrINT, exdrFLOAT, exdrUINT, exdr3DX, exdrCLOSE, exdrMAGIC, exdrNOMEM, exdrENDOFFILE, exdrNR = range(13)
 
-    #
-    def __init__(self,fn,mode="Auto",ft="Auto",atomNum=False):
+    #fields: which of x, v and f to read from a .trr file; the others are
+    #skipped in the file and not allocated (Frame.v, FrameChunk.v are None)
+    #index: FrameIndex of the file, if already known (see frame_index)
+    def __init__(self,fn,mode="Auto",ft="Auto",atomNum=False,atoms=None,fields=('x',),index=None):
         if mode=="NumPy":
           self.mode=mNumPy
           try:
@@ -161,6 +410,8 @@ class XDRFile:
           
         if ft=="Auto":
           ft = os.path.splitext(fn)[1][1:]
+        self.fn = fn
+        self.ft = ft
          
         if self.mode!=out_mode:
             if ft=="trr":
@@ -169,6 +420,11 @@ class XDRFile:
                 pass
             else:
                 raise IOError("Only xtc and trr supported")
+        self.fields = tuple(fields)
+        if not set(self.fields) <= set(['x', 'v', 'f']):
+            raise ValueError("fields can only be 'x', 'v' and 'f'")
+        if not self.mode&mTrr and self.mode!=out_mode and self.fields != ('x',):
+            raise ValueError("xtc files only hold coordinates")
         
         #load libxdrfil
         try: 
@@ -176,14 +432,29 @@ class XDRFile:
           self.xdr=cdll.LoadLibrary(p)
         except:
           raise IOError("_xdrio.so can't be loaded")
+
+        #the file handle is a pointer: keep all 64 bits of it
+        self.xdr.xdrfile_open.restype=c_void_p
+        self.xdr.xdrfile_close.argtypes=[c_void_p]
+        self.xdr.xdr_tell.restype=c_int64
+        self.xdr.xdr_tell.argtypes=[c_void_p]
+        self.xdr.xdr_seek.argtypes=[c_void_p,c_int64,c_int]
+        c_f32=ndpointer(dtype=float32,flags='C_CONTIGUOUS')
+        c_i32=ndpointer(dtype=np.int32,flags='C_CONTIGUOUS')
+        self.xdr.read_xtc_chunk.argtypes=[c_void_p,c_int,c_int,POINTER(c_int),
+          c_i32,c_f32,c_f32,c_f32,c_f32,c_void_p,c_int]
+        self.xdr.read_trr_chunk.argtypes=[c_void_p,c_int,c_int,POINTER(c_int),
+          c_i32,c_f32,c_f32,c_f32,c_void_p,c_void_p,c_void_p,c_i32,c_void_p,c_int]
  
           
         #open file
         if self.mode==out_mode:
-            self.xd = self.xdr.xdrfile_open(fn,"w")
+            self.xd = c_void_p(self.xdr.xdrfile_open(fn,"w"))
         else:
-            self.xd = self.xdr.xdrfile_open(fn,"r")
+            self.xd = c_void_p(self.xdr.xdrfile_open(fn,"r"))
         if not self.xd: raise IOError("Cannot open file: '%s'"%fn)
+        self._index = index
+        self._frame = 0
         
         #read natoms
         natoms=c_int()
@@ -198,18 +469,20 @@ class XDRFile:
                 r=self.xdr.read_xtc_natoms(fn,byref(natoms))
             if r!=self.exdrOK: raise IOError("Error reading: '%s'"%fn)
             self.natoms=natoms.value
+        self.select_atoms(atoms)
         
         #for NumPy define argtypes - ndpointer is not automatically converted to POINTER(c_float)
         #alternative of ctypes.data_as(POINTER(c_float)) requires two version for numpy and c_float array
         if self.mode&mNumPy and self.mode!=out_mode:
-            self.xdr.read_xtc.argtypes=[c_int,c_int,POINTER(c_int),POINTER(c_float),
+            self.xdr.read_xtc.argtypes=[c_void_p,c_int,POINTER(c_int),POINTER(c_float),
               ndpointer(ndim=2,dtype=float32),ndpointer(ndim=2,dtype=float32),POINTER(c_float)]
-            self.xdr.read_trr.argtypes=[c_int,c_int,POINTER(c_int),POINTER(c_float),POINTER(c_float),
+            self.xdr.read_trr.argtypes=[c_void_p,c_int,POINTER(c_int),POINTER(c_float),POINTER(c_float),
               ndpointer(ndim=2,dtype=float32),ndpointer(ndim=2,dtype=float32),
               POINTER(c_float),POINTER(c_float)]
 
-    def write_xtc_frame( self, step=0, time=0.0, prec=1000.0, lam=0.0, box=False, x=False, units='A', bTrr=False ):
-        f = Frame(self.natoms,self.mode,box=box,x=x,units=units)
+    def write_xtc_frame( self, step=0, time=0.0, prec=1000.0, lam=0.0, box=False, x=False, units='A', bTrr=False, v=None, f=None ):
+        #v and f (natoms*3 values) are only written to .trr files
+        f = Frame(self.natoms,self.mode,box=box,x=x,units=units,v=v,f=f)
         step = c_int(step)
         time = c_float(time)
         prec = c_float(prec)
@@ -218,32 +491,215 @@ class XDRFile:
             result = self.xdr.write_trr(self.xd,self.natoms,step,time,lam,f.box,f.x,f.v,f.f)
         else:
             result = self.xdr.write_xtc(self.xd,self.natoms,step,time,f.box,f.x,prec)
+
+    def close(self):
+        """Closes the file. Needed to flush the frames written in 'Out'
+        mode."""
+        if self.xd:
+            self.xdr.xdrfile_close(self.xd)
+            self.xd = c_void_p(None)
+
+    @property
+    def index(self):
+        """FrameIndex of the file, built (or read from next to the file) on
+        first use."""
+        if self._index is None:
+            self._index = frame_index(self.fn, self.ft)
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def seek(self, frame):
+        """Moves to frame number frame (negative values count from the end),
+        so that it is the next frame read."""
+        n = len(self)
+        if frame < 0:
+            frame += n
+        if frame < 0 or frame > n:
+            raise IndexError("Frame %d out of range (%d frames)" % (frame, n))
+        if frame == n:
+            r = self.xdr.xdr_seek(self.xd, 0, 2)
+        else:
+            r = self.xdr.xdr_seek(self.xd, int(self.index.offsets[frame]), 0)
+        if r != self.exdrOK: raise IOError("Cannot seek in '%s'" % self.fn)
+        self._frame = frame
+
+    def tell(self):
+        """Number of the next frame to be read."""
+        return self._frame
+
+    def select_atoms(self, atoms=None):
+        """Restricts reading to a subset of the atoms: an ndx.IndexGroup, or
+        a sequence of atom ids (1-based, as in index files). Frames and
+        FrameChunks then hold only these atoms, in this order; each frame is
+        still decoded once, and gathered into the compact buffers in C.
+        None selects all the atoms again."""
+        self._chunk1 = None
+        if atoms is None:
+            self.atoms = None
+            self.nsel = self.natoms
+            self._sel_ptr = None
+            if self.mode&mTrr and self.mode!=out_mode and self.fields != ('x',):
+                self._chunk1 = FrameChunk(1, self.nsel, self.fields)
+            return
+        ids = np.asarray(getattr(atoms, 'ids', atoms), dtype=np.int64)
+        if ids.ndim != 1 or len(ids) == 0:
+            raise ValueError("Need a non-empty list of atom ids")
+        if ids.min() < 1 or ids.max() > self.natoms:
+            raise ValueError("Atom ids out of range 1-%d" % self.natoms)
+        self.atoms = np.ascontiguousarray(ids - 1, dtype=np.int32)
+        self.nsel = len(self.atoms)
+        self._sel_ptr = self.atoms.ctypes.data
+        self._chunk1 = FrameChunk(1, self.nsel, self.fields)
+
+    def _read_via_chunk(self, f):
+        #read the next frame into f through read_chunk, for atom selections
+        #and trr velocities and forces
+        c = self.read_chunk(1, out=self._chunk1)
+        if c.nframes == 0:
+            return self.exdrENDOFFILE
+        for name in self.fields + ('box',):
+            src = getattr(c, '_' + name)
+            if self.mode&mNumPy:
+                getattr(f, name)[:] = src[0]
+            else:
+                memmove(getattr(f, name), src.ctypes.data, src[0].nbytes)
+        f.has = int(c.has[0])
+        f.step = int(c.step[0])
+        f.time = float(c.time[0])
+        f.prec = float(c.prec[0])
+        f.lam = float(c.lam[0])
+        return self.exdrOK
+
+    def _read(self, f, step, time, prec, lam):
+        #read next frame into f, returns the xdr status
+        if self._chunk1 is not None:
+            return self._read_via_chunk(f)
+        if not self.mode&mTrr:
+            result = self.xdr.read_xtc(self.xd,self.natoms,byref(step),byref(time),f.box,f.x,byref(prec))
+            f.prec=prec.value
+        else:
+            result = self.xdr.read_trr(self.xd,self.natoms,byref(step),byref(time),byref(lam),f.box,f.x,None,None) #v,f: see fields
+            f.lam=lam.value
+
+        #check return value
+        if result==self.exdrENDOFFILE: return result
+        if result==self.exdrINT and self.mode&mTrr:
+          return self.exdrENDOFFILE  #TODO: dirty hack. read_trr return exdrINT not exdrENDOFFILE
+        if result!=self.exdrOK: raise IOError("Error reading xdr file")
+
+        #convert c_type to python
+        f.step=step.value
+        f.time=time.value
+        self._frame += 1
+        return result
+
+    def _frames(self, frames):
+        #yields the given frames, seeking only where they are not contiguous
+        f = Frame(self.nsel,self.mode,fields=self.fields)
+        step = c_int()
+        time = c_float()
+        prec = c_float()
+        lam = c_float()
+        for i in frames:
+            if i != self._frame:
+                self.seek(i)
+            if self._read(f, step, time, prec, lam) != self.exdrOK:
+                raise IOError("Unexpected end of file reading frame %d" % i)
+            yield f
+
+    def read_chunk(self, nframes=100, out=None):
+        """Decodes up to nframes frames from the current position in one call
+        into the C library, straight into the arrays of a FrameChunk. Fewer
+        frames are returned at the end of the file (none past it), and before
+        a truncated or corrupt frame; IOError if that is the first one.
+
+        out: FrameChunk to fill in place, instead of allocating a new one.
+        """
+        if out is None:
+            out = FrameChunk(nframes, self.nsel, self.fields)
+        elif nframes > out.capacity or out.natoms != self.nsel:
+            raise ValueError("FrameChunk too small for %d frames" % nframes)
+        elif out.fields != self.fields:
+            raise ValueError("FrameChunk holds fields %s, not %s" % (out.fields, self.fields))
+        nread = c_int()
+        first = self._frame
+        if self.mode&mTrr:
+            result = self.xdr.read_trr_chunk(self.xd,self.natoms,nframes,byref(nread),
+                out._step,out._time,out._lam,out._box,_ptr(out._x),_ptr(out._v),_ptr(out._f),
+                out._has,self._sel_ptr,self.nsel)
+            if result==self.exdrINT: result = self.exdrENDOFFILE  #see _read
+        else:
+            result = self.xdr.read_xtc_chunk(self.xd,self.natoms,nframes,byref(nread),
+                out._step,out._time,out._box,out._x,out._prec,self._sel_ptr,self.nsel)
+            out._has[:nread.value] = 1
+        self._frame += nread.value
+        out.first = first
+        out._set_size(nread.value)
+        if result not in (self.exdrOK, self.exdrENDOFFILE):
+            if nread.value == 0:
+                raise IOError("Error reading xdr file")
+            #a truncated or corrupt frame after good ones (e.g. the last
+            #frame of a killed run): return the good frames as a short read,
+            #positioned at the start of the bad one
+            self.seek(self._frame)
+        return out
+
+    def iter_chunks(self, chunksize=100, start=0, stop=None, reuse=True):
+        """Iterates over frames start to stop (default: to the end; a
+        truncated last frame is left out) in FrameChunks of chunksize
+        frames. With reuse, the same FrameChunk is filled again at every
+        step, so no memory is allocated after the first chunk; pass
+        reuse=False to keep the chunks."""
+        #stop at the last complete frame of the index, so that a truncated
+        #last frame is not read at all
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start != self._frame:
+            self.seek(start)
+        out = None
+        while True:
+            k = min(chunksize, stop - self._frame)
+            if k <= 0:
+                break
+            out = self.read_chunk(k, out=out if reuse else None)
+            if out.nframes == 0:
+                break
+            yield out
+            if out.nframes < k:
+                break
+
+    def __getitem__(self, key):
+        """Random access to the frames, through the frame index. An integer
+        returns a new Frame; a slice or a sequence of frame numbers returns
+        an iterator over the frames, which like iteration reuses a single
+        Frame object."""
+        if isinstance(key, slice):
+            return self._frames(range(*key.indices(len(self))))
+        if np.ndim(key) == 1:
+            n = len(self)
+            return self._frames([int(i) + n if i < 0 else int(i) for i in key])
+        frame = int(key)
+        if frame < 0:
+            frame += len(self)
+        if frame < 0 or frame >= len(self):
+            raise IndexError("Frame %d out of range (%d frames)" % (key, len(self)))
+        for f in self._frames([frame]):
+            return f
         
     def __iter__(self):
-        f = Frame(self.natoms,self.mode)
+        f = Frame(self.nsel,self.mode,fields=self.fields)
         #temporary c_type variables (frame variables are python type)
         step = c_int()
         time = c_float()
         prec = c_float()
         lam = c_float()
         if self.mode!=out_mode:
+            #always start from the first frame
+            if self._frame != 0:
+                self.xdr.xdr_seek(self.xd, 0, 0)
+                self._frame = 0
             while 1:
                 #read next frame
-                if not self.mode&mTrr:
-                    result = self.xdr.read_xtc(self.xd,self.natoms,byref(step),byref(time),f.box,f.x,byref(prec))
-                    f.prec=prec.value
-                else:
-                    result = self.xdr.read_trr(self.xd,self.natoms,byref(step),byref(time),byref(lam),f.box,f.x,None,None) #TODO: make v,f possible
-                    f.lam=lam.value
-                
-                #check return value
-                if result==self.exdrENDOFFILE: break
-                if result==self.exdrINT and self.mode&mTrr: 
-                  break  #TODO: dirty hack. read_trr return exdrINT not exdrENDOFFILE
-                if result!=self.exdrOK: raise IOError("Error reading xdr file")
-            
-                #convert c_type to python 
-                f.step=step.value
-                f.time=time.value
+                if self._read(f, step, time, prec, lam) != self.exdrOK: break
                 yield f
-        
@@ -29,6 +29,9 @@
 # ----------------------------------------------------------------------
 
 import sys, os, xdrfile
+import multiprocessing
+from multiprocessing.util import Finalize
+import numpy as np
 
 
 class Trajectory(xdrfile.XDRFile):
@@ -42,7 +45,217 @@ class Trajectory(xdrfile.XDRFile):
         return self.natoms
 
 
+class MultiTrajectory(object):
+    """A trajectory split over several xtc/trr files (e.g. the traj.partNNNN.xtc
+    pieces of a continued run), read as one.
 
+    The frames of all the files are numbered with one global index, built from
+    the frame index of each file (see xdrfile.frame_index), so that len(),
+    indexing and slicing work across file boundaries. With dedup, as in gmx
+    trjcat, the frames of the previous files with times not earlier than the
+    first frame of a file are dropped: a run continued from a checkpoint
+    writes again the frames from the checkpoint on.
 
+    The files are opened when they are read, and only one at a time, so any
+    number of parts can be read; close() closes the open one.
 
+    Chunks of frames can be decoded by a pool of processes with map_chunks::
 
+        >>> traj = MultiTrajectory(sorted(glob('traj.part*.xtc')), atoms=lig)
+        >>> rmsd = np.concatenate(list(traj.map_chunks(calc_rmsd, nproc=8)))
+    """
+
+    def __init__(self, filenames, dedup=True, atoms=None, mode="Auto",
+                 fields=('x',)):
+        self.filenames = list(filenames)
+        if len(self.filenames) == 0:
+            raise IOError("No trajectory files given")
+        self.mode = mode
+        self.fields = tuple(fields)
+        self.atoms = None
+        if atoms is not None:
+            self.atoms = np.array(getattr(atoms, 'ids', atoms), dtype=np.int64)
+        self.parts = [None]*len(self.filenames)
+        self.indexes = []
+        for fn in self.filenames:
+            part = xdrfile.XDRFile(fn, mode=mode, atoms=self.atoms,
+                                   fields=self.fields)
+            try:
+                if not self.indexes:
+                    self.natoms = part.natoms
+                    self.nsel = part.nsel
+                elif part.natoms != self.natoms:
+                    raise IOError("'%s' has %d atoms, '%s' %d" % (
+                        fn, part.natoms, self.filenames[0], self.natoms))
+                self.indexes.append(part.index)
+            finally:
+                part.close()
+
+        # [file, first, stop] of the frames kept from each file
+        runs = []
+        for i, idx in enumerate(self.indexes):
+            if len(idx) == 0:
+                continue
+            while dedup and runs:
+                j, first, stop = runs[-1]
+                # times only increase within a file
+                stop = first + int(np.searchsorted(
+                    self.indexes[j].times[first:stop], idx.times[0],
+                    side='left'))
+                if stop > first:
+                    runs[-1][2] = stop
+                    break
+                runs.pop()
+            runs.append([i, 0, len(idx)])
+        cat = lambda arrs, dt: (np.concatenate(arrs) if arrs
+                                else np.zeros(0, dtype=dt))
+        self.part = cat([np.repeat(i, stop - first)
+                         for i, first, stop in runs], np.int64)
+        self.local = cat([np.arange(first, stop)
+                          for i, first, stop in runs], np.int64)
+        self.times = cat([self.indexes[i].times[first:stop]
+                          for i, first, stop in runs], np.float64)
+        self.steps = cat([self.indexes[i].steps[first:stop]
+                          for i, first, stop in runs], np.int64)
+
+    def __len__(self):
+        return len(self.part)
+
+    def get_natoms(self):
+        return self.natoms
+
+    def _part(self, p):
+        # the XDRFile of file p, opened on first use; the file open before
+        # is closed
+        if self.parts[p] is None:
+            self.close()
+            self.parts[p] = xdrfile.XDRFile(self.filenames[p], mode=self.mode,
+                                            atoms=self.atoms,
+                                            fields=self.fields,
+                                            index=self.indexes[p])
+        return self.parts[p]
+
+    def close(self):
+        """Closes the open file, if any."""
+        for p, part in enumerate(self.parts):
+            if part is not None:
+                part.close()
+                self.parts[p] = None
+
+    def _global(self, frames):
+        # global frame numbers of an int, slice or sequence
+        if isinstance(frames, slice):
+            return np.arange(*frames.indices(len(self)))
+        frames = np.asarray(frames, dtype=np.int64)
+        frames = np.where(frames < 0, frames + len(self), frames)
+        if len(frames) and (frames.min() < 0 or frames.max() >= len(self)):
+            raise IndexError("Frame out of range (%d frames)" % len(self))
+        return frames
+
+    def _runs(self, frames, chunksize=None):
+        # splits global frames into (part, local frames, first global frame)
+        # runs of consecutive frames of one file, of at most chunksize frames
+        frames = self._global(frames)
+        if len(frames) == 0:
+            return
+        p = self.part[frames]
+        l = self.local[frames]
+        breaks = np.flatnonzero((np.diff(p) != 0) | (np.diff(l) != 1)) + 1
+        for run in np.split(np.arange(len(frames)), breaks):
+            step = chunksize or len(run)
+            for k in range(0, len(run), step):
+                sub = run[k:k+step]
+                yield int(p[sub[0]]), l[sub], int(frames[sub[0]])
+
+    def __getitem__(self, key):
+        """An integer returns a new Frame; a slice or a sequence of global
+        frame numbers returns an iterator over the frames."""
+        if isinstance(key, slice) or np.ndim(key) == 1:
+            return self._iter_frames(key)
+        frame = int(self._global([key])[0])
+        return self._part(self.part[frame])[int(self.local[frame])]
+
+    def _iter_frames(self, frames):
+        for p, local, first in self._runs(frames):
+            for f in self._part(p)._frames(local):
+                yield f
+
+    def __iter__(self):
+        return self._iter_frames(slice(None))
+
+    def iter_chunks(self, chunksize=100, start=0, stop=None):
+        """Iterates over global frames start to stop in FrameChunks of at
+        most chunksize consecutive frames; chunks end at file boundaries.
+        FrameChunk.first is the global number of the first frame."""
+        for p, local, first in self._runs(slice(start, stop), chunksize):
+            part = self._part(p)
+            if part.tell() != local[0]:
+                part.seek(int(local[0]))
+            chunk = part.read_chunk(len(local))
+            chunk.first = first
+            yield chunk
+
+    def map_chunks(self, func=None, chunksize=100, start=0, stop=None,
+                   nproc=1):
+        """Decodes global frames start to stop in chunks of chunksize frames
+        on a pool of nproc processes, and yields, in order, func(chunk) for
+        every FrameChunk (or the chunks themselves if func is None). func
+        must be picklable, i.e. defined at module level. Every worker keeps
+        one file open and seeks to its chunks through the frame index, so
+        the chunks are read independently of each other."""
+        if nproc == 1:
+            for chunk in self.iter_chunks(chunksize, start, stop):
+                yield chunk if func is None else func(chunk)
+            return
+        tasks = [(p, int(local[0]), len(local), first, func)
+                 for p, local, first in self._runs(slice(start, stop),
+                                                   chunksize)]
+        # the workers open their own files
+        self.close()
+        pool = multiprocessing.Pool(nproc, _init_worker,
+                                    (self.filenames, self.mode, self.atoms,
+                                     self.fields, self.indexes))
+        try:
+            for res in pool.imap(_decode_chunk, tasks):
+                yield res
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+
+# the trajectory read by a map_chunks worker process and its open file, set
+# up by _init_worker for the lifetime of the pool
+_WORKER = {}
+
+
+def _init_worker(filenames, mode, atoms, fields, indexes):
+    _WORKER.clear()
+    _WORKER.update(filenames=filenames, mode=mode, atoms=atoms, fields=fields,
+                   indexes=indexes, open=None)
+    Finalize(None, _close_worker_file, exitpriority=10)
+
+
+def _close_worker_file():
+    if _WORKER.get('open') is not None:
+        _WORKER['open'][1].close()
+    _WORKER.clear()
+
+
+def _decode_chunk(task):
+    p, start, nframes, first, func = task
+    if _WORKER['open'] is None or _WORKER['open'][0] != p:
+        if _WORKER['open'] is not None:
+            _WORKER['open'][1].close()
+        part = xdrfile.XDRFile(_WORKER['filenames'][p], mode=_WORKER['mode'],
+                               atoms=_WORKER['atoms'],
+                               fields=_WORKER['fields'],
+                               index=_WORKER['indexes'][p])
+        _WORKER['open'] = (p, part)
+    part = _WORKER['open'][1]
+    part.seek(start)
+    chunk = part.read_chunk(nframes)
+    chunk.first = first
+    if func is None:
+        return chunk
+    return func(chunk)
@@ -0,0 +1,30 @@
+"""Tests of the dH/dl integration in pmx.scripts.analyze_dhdl."""
+
+import numpy as np
+from pmx.scripts.analyze_dhdl import integrate_dgdl, integrate_dgdl_stream
+
+
+def write_xvg(fn, y):
+    with open(fn, 'w') as f:
+        f.write('# dH/dl\n@    title "dH/dl"\n')
+        for t, v in enumerate(y):
+            f.write('%.4f %.10f\n' % (t*0.2, v))
+
+
+def test_stream_matches_simps(tmpdir):
+    # integrate_dgdl uses scipy's simps(even='avg'); the streamed sums have
+    # to reproduce it for odd and even numbers of points and any chunking
+    rng = np.random.RandomState(7)
+    for n in (1, 2, 3, 4, 5, 10, 11, 1001):
+        fn = str(tmpdir.join('dhdl%d.xvg' % n))
+        write_xvg(fn, rng.normal(50., 20., n))
+        for lambda0 in (0, 1):
+            ref, nref = integrate_dgdl(fn, lambda0=lambda0)
+            for chunksize in (1, 2, 3, 100000):
+                w, ndata = integrate_dgdl_stream(fn, lambda0=lambda0,
+                                                 chunksize=chunksize)
+                assert ndata == nref == n
+                assert abs(w - ref) < 1e-12 * max(1., abs(ref))
+            w, _ = integrate_dgdl_stream(fn, lambda0=lambda0,
+                                         invert_values=True)
+            assert abs(w + ref) < 1e-12 * max(1., abs(ref))
@@ -0,0 +1,141 @@
+"""Tests of the free energy estimators in pmx.estimators."""
+
+from functools import partial
+import numpy as np
+from pmx.estimators import (BAR, MBAR, bootstrap, convergence, kb,
+                             _bar_dg_rows)
+from pmx.workarchive import WorkArchive
+
+T = 298.15
+
+# fixed-seed Gaussian work sets: (seed, (mean, sd, n) forward,
+# (mean, sd, n) reverse), and the free energy found for them by the
+# original Nelder-Mead BAR solver
+BAR_REFERENCE = [(1, (10., 3., 200), (-6., 3., 200), 2.315481436578398),
+                 (2, (25., 8., 150), (-5., 8., 300), 9.352550239710993),
+                 (3, (2., 1., 500), (-1.5, 1., 100), 1.0657287313458288)]
+
+
+def gaussian_work(seed, forward, reverse):
+    rng = np.random.RandomState(seed)
+    wf = rng.normal(forward[0], forward[1], forward[2])
+    wr = rng.normal(reverse[0], reverse[1], reverse[2])
+    return wf, wr
+
+
+def test_bar_solver_matches_simplex():
+    # the simplex solver converges to ~1e-4 only, brentq to 1e-10
+    for seed, forward, reverse, dg_ref in BAR_REFERENCE:
+        wf, wr = gaussian_work(seed, forward, reverse)
+        dg = BAR.calc_dg(wf, wr, T)
+        assert abs(dg - dg_ref) < 1e-4
+        assert abs(dg - BAR.calc_dg(wf, wr, T, solver='simplex')) < 1e-4
+
+
+def test_bar_stage_hook():
+    wf, wr = gaussian_work(1, (10., 3., 100), (-6., 3., 100))
+    names = []
+    bar = BAR(wf, wr, T=T, nboots=10, nblocks=2, seed=3, stage=names.append)
+    ref = BAR(wf, wr, T=T, nboots=10, nblocks=2, seed=3)
+    assert names == ['bootstrap', 'blocks']
+    assert (bar.err_boot, bar.conv_err_boot, bar.err_blocks) == \
+        (ref.err_boot, ref.conv_err_boot, ref.err_blocks)
+
+
+def test_convergence_uses_archive_temperature():
+    wf, wr = gaussian_work(1, (10., 3., 200), (-6., 3., 200))
+    conv = convergence(WorkArchive(wf, wr, T=310.), None, step=50)
+    ref = convergence(wf, wr, T=310., step=50)
+    for k in ref:
+        np.testing.assert_array_equal(conv[k], ref[k])
+    assert abs(conv['dg_bar'][-1] - BAR(wf, wr, T=310.).dg) < 1e-8
+    assert abs(conv['dg_bar'][-1] -
+               convergence(wf, wr, step=50)['dg_bar'][-1]) > 1e-3
+
+
+def mean_difference(bootA, bootB):
+    return np.mean(bootA, axis=1) - np.mean(bootB, axis=1)
+
+
+def test_bootstrap_chunksize_invariance():
+    wf, wr = gaussian_work(1, (10., 3., 50), (-6., 3., 40))
+    ref = bootstrap(mean_difference, [wf, wr], 37, seed=5, chunksize=37)
+    assert len(np.unique(ref)) > 1
+    for chunksize in (1, 4, 10, None):
+        boots = bootstrap(mean_difference, [wf, wr], 37, seed=5,
+                          chunksize=chunksize)
+        assert np.array_equal(boots, ref)
+    err = BAR.calc_err_boot(wf, wr, 20, T, seed=5)
+    assert np.std(bootstrap(partial(_bar_dg_rows, T=T), [wf, wr], 20, seed=5,
+                            chunksize=7)) == err
+
+
+def test_bootstrap_n_jobs_invariance():
+    wf, wr = gaussian_work(2, (25., 8., 60), (-5., 8., 80))
+    ref = bootstrap(mean_difference, [wf, wr], 45, seed=11, chunksize=4)
+    boots = bootstrap(mean_difference, [wf, wr], 45, seed=11, chunksize=4,
+                      n_jobs=3)
+    assert np.array_equal(boots, ref)
+    assert BAR.calc_err_boot(wf, wr, 30, T, seed=11, n_jobs=2) == \
+        BAR.calc_err_boot(wf, wr, 30, T, seed=11)
+
+
+def two_state_mbar(wf, wr, **kwargs):
+    # reduced potentials of the forward (state 0) and reverse (state 1)
+    # samples, taking u_0 = 0 and u_1 - u_0 from the work values
+    u_kn = np.zeros((2, len(wf) + len(wr)))
+    u_kn[1] = np.concatenate([wf, wr]) / (kb*T)
+    return MBAR(u_kn, [len(wf), len(wr)], T=T, **kwargs)
+
+
+def harmonic_states(seed, K=5, n=200):
+    # samples of K harmonic oscillators with known free energies
+    rng = np.random.RandomState(seed)
+    k = np.linspace(1., 10., K)
+    mu = np.linspace(0., 1.5, K)
+    x = np.concatenate([rng.normal(mu[i], 1./np.sqrt(k[i]), n)
+                        for i in range(K)])
+    u_kn = 0.5*k[:, np.newaxis]*(x[np.newaxis, :] - mu[:, np.newaxis])**2
+    return u_kn, [n]*K, 0.5*np.log(k/k[0])
+
+
+def test_mbar_two_states_matches_bar():
+    for seed, forward, reverse, _ in BAR_REFERENCE:
+        wf, wr = gaussian_work(seed, forward, reverse)
+        mbar = two_state_mbar(wf, wr)
+        bar = BAR(wf, wr, T=T)
+        assert abs(mbar.dg[0, 1] - bar.dg) < 1e-6
+        assert abs(mbar.err[0, 1] - bar.err) < 1e-6
+        assert abs(mbar.dg[1, 0] + bar.dg) < 1e-6
+
+
+def test_mbar_chunksize_invariance():
+    u_kn, N_k, f_ref = harmonic_states(0)
+    ref = MBAR(u_kn, N_k, T=T)
+    assert np.allclose(ref.f_k, f_ref, atol=0.1)
+    for chunksize in (1, 7, 333):
+        mbar = MBAR(u_kn, N_k, T=T, chunksize=chunksize)
+        assert np.allclose(mbar.dg, ref.dg, rtol=0, atol=1e-8)
+        assert np.allclose(mbar.err, ref.err, rtol=0, atol=1e-8)
+
+
+def test_mbar_converges_from_bad_start():
+    wf, wr = gaussian_work(*BAR_REFERENCE[0][:3])
+    ref = two_state_mbar(wf, wr)
+    for f_k in ([0., 500.], [0., -500.], [100., 0.]):
+        mbar = two_state_mbar(wf, wr, f_k=f_k)
+        assert mbar.niter < mbar.maxiter
+        assert abs(mbar.dg[0, 1] - ref.dg[0, 1]) < 1e-6
+    u_kn, N_k, _ = harmonic_states(1)
+    ref = MBAR(u_kn, N_k, T=T)
+    mbar = MBAR(u_kn, N_k, T=T, f_k=np.linspace(0., -200., len(N_k)))
+    assert mbar.converged and mbar.niter < mbar.maxiter
+    assert np.allclose(mbar.f_k, ref.f_k, rtol=0, atol=1e-8)
+
+
+def test_mbar_not_converged(capsys):
+    u_kn, N_k, _ = harmonic_states(1)
+    mbar = MBAR(u_kn, N_k, T=T, maxiter=2,
+                f_k=np.linspace(0., -200., len(N_k)))
+    assert not mbar.converged and mbar.niter == 2
+    assert capsys.readouterr()[0] == ''
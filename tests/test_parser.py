@@ -0,0 +1,42 @@
+"""Tests of the xvg readers in pmx.parser."""
+
+import gzip
+import numpy as np
+import pytest
+from pmx.parser import read_xvg_array, iter_xvg_array, ParserError
+
+
+def write_xvg(fn, data, opener=open):
+    with opener(fn, 'wb') as f:
+        f.write(b'# dhdl.xvg\n@    title "dH/dl"\n@ s0 legend "dH/dl"\n')
+        for row in data:
+            f.write((' '.join('%.6f' % v for v in row) + '\n').encode())
+
+
+@pytest.mark.parametrize('opener', [open, gzip.open])
+def test_columns_match_full_read(tmpdir, opener):
+    rng = np.random.RandomState(3)
+    ref = np.round(rng.normal(0., 50., (1001, 4)), 6)
+    fn = str(tmpdir.join('dhdl.xvg' + ('.gz' if opener is gzip.open else '')))
+    write_xvg(fn, ref, opener)
+    data = read_xvg_array(fn)
+    assert np.array_equal(data, ref)
+    for columns in (1, 0, -1, [3, 1], [2]):
+        sel = read_xvg_array(fn, columns=columns)
+        assert sel.shape == ref[:,columns].shape
+        assert np.array_equal(sel, ref[:,columns])
+        for chunksize in (1, 7, 1000, 5000):
+            chunks = list(iter_xvg_array(fn, columns, chunksize=chunksize))
+            assert np.array_equal(np.concatenate(chunks), ref[:,columns])
+    with pytest.raises(ParserError):
+        read_xvg_array(fn, columns=4)
+
+
+def test_incomplete_last_line(tmpdir):
+    fn = str(tmpdir.join('dhdl.xvg'))
+    write_xvg(fn, np.ones((10, 3)))
+    with open(fn, 'ab') as f:
+        f.write(b'2.0 1.0\n')
+    for columns in (None, 1, [0, 2]):
+        with pytest.raises(ParserError):
+            read_xvg_array(fn, columns=columns)
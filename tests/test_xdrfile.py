@@ -0,0 +1,217 @@
+"""Round trips of xtc and trr files through pmx.xdrfile: the frame index,
+random access and chunked reading are checked against sequential reading."""
+
+import os
+import struct
+import numpy as np
+import pytest
+from pmx.xdrfile import XDRFile, FrameIndex, frame_index, index_filename
+
+
+def write_traj(fn, natoms, nframes, seed=0):
+    # random frames, written in nm so that no unit conversion is applied
+    rng = np.random.RandomState(seed)
+    ft = os.path.splitext(fn)[1][1:]
+    out = XDRFile(fn, mode='Out', ft=ft, atomNum=natoms)
+    for i in range(nframes):
+        x = rng.uniform(0., 3., (natoms, 3))
+        box = [[3., 0., 0.], [0., 3., 0.], [0., 0., 3. + 0.01*i]]
+        out.write_xtc_frame(step=10*i, time=0.5*i, lam=0.01*i, box=box,
+                            x=list(x.ravel()), units='nm', bTrr=ft == 'trr')
+    out.close()
+
+
+def write_trr_vf(fn, natoms, nframes, seed=0):
+    # random frames with velocities and forces in all but every third frame;
+    # returns the arrays written and the fields present in each frame
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0., 3., (nframes, natoms, 3)).astype(np.float32)
+    v = rng.normal(0., 1., (nframes, natoms, 3)).astype(np.float32)
+    f = rng.normal(0., 500., (nframes, natoms, 3)).astype(np.float32)
+    has = np.array([1 if i % 3 == 0 else 7 for i in range(nframes)])
+    out = XDRFile(fn, mode='Out', ft='trr', atomNum=natoms)
+    for i in range(nframes):
+        kw = {}
+        if has[i] == 7:
+            kw = dict(v=list(v[i].ravel()), f=list(f[i].ravel()))
+        out.write_xtc_frame(step=i, time=0.1*i, box=np.eye(3).tolist(),
+                            x=list(x[i].ravel()), units='nm', bTrr=True, **kw)
+    out.close()
+    return x, v, f, has
+
+
+def read_all(t):
+    # (step, time, box, x) of every frame, by sequential iteration
+    return [(f.step, f.time, np.array(f.box), np.array(f.x)) for f in t]
+
+
+def same_frame(f, ref):
+    return (f.step == ref[0] and f.time == ref[1] and
+            np.array_equal(np.array(f.box), ref[2]) and
+            np.array_equal(np.array(f.x), ref[3]))
+
+
+def check_frames(frames, ref):
+    # frames yields a reused Frame: compare each one as it is read
+    n = 0
+    for f in frames:
+        assert same_frame(f, ref[n])
+        n += 1
+    assert n == len(ref)
+
+
+def to_double_trr(src, dst):
+    # rewrites a single precision trr file in double precision
+    data = open(src, 'rb').read()
+    out = []
+    pos = 0
+    while pos < len(data):
+        strlen = struct.unpack('>i', data[pos+8:pos+12])[0]
+        head = 12 + 4*((strlen + 3)//4)
+        out.append(data[pos:pos+head])
+        sizes = list(struct.unpack('>13i', data[pos+head:pos+head+52]))
+        pos += head + 52
+        # box, vir, pres, x, v and f hold reals
+        for i in (2, 3, 4, 7, 8, 9):
+            sizes[i] *= 2
+        out.append(struct.pack('>13i', *sizes))
+        n = 2 + sum(sizes[i] for i in (2, 3, 4, 7, 8, 9))//8
+        vals = struct.unpack('>%df' % n, data[pos:pos+4*n])
+        out.append(struct.pack('>%dd' % n, *vals))
+        pos += 4*n
+    open(dst, 'wb').write(b''.join(out))
+
+
+@pytest.mark.parametrize('ft', ['xtc', 'trr'])
+@pytest.mark.parametrize('natoms', [5, 40])
+def test_random_access_matches_iteration(tmpdir, ft, natoms):
+    # xtc files with up to 9 atoms are not compressed
+    fn = str(tmpdir.join('traj.' + ft))
+    write_traj(fn, natoms, 23)
+    t = XDRFile(fn)
+    ref = read_all(t)
+    assert len(ref) == len(t) == 23
+    assert list(t.index.steps) == [r[0] for r in ref]
+    assert np.allclose(t.index.times, [r[1] for r in ref])
+    for i in (7, 0, 22, 7, -1, -23):
+        assert same_frame(t[i], ref[i])
+    with pytest.raises(IndexError):
+        t[23]
+    check_frames(t[3:20:4], ref[3:20:4])
+    check_frames(t[[5, 0, 22, 5, -2]], [ref[i] for i in (5, 0, 22, 5, 21)])
+    # the iteration after random access starts from the first frame again
+    check_frames(t, ref)
+
+    chunks = list(t.iter_chunks(6, reuse=False))
+    assert [c.first for c in chunks] == [0, 6, 12, 18]
+    assert np.array_equal(np.concatenate([c.x for c in chunks]),
+                          [r[3] for r in ref])
+    assert np.array_equal(np.concatenate([c.step for c in chunks]),
+                          [r[0] for r in ref])
+    x = np.concatenate([c.x for c in t.iter_chunks(4, start=5, stop=-3,
+                                                   reuse=False)])
+    assert np.array_equal(x, [r[3] for r in ref[5:-3]])
+
+
+def test_double_precision_trr(tmpdir):
+    fn = str(tmpdir.join('single.trr'))
+    dfn = str(tmpdir.join('double.trr'))
+    write_traj(fn, 12, 9)
+    to_double_trr(fn, dfn)
+    assert os.path.getsize(dfn) > os.path.getsize(fn)
+    ref = read_all(XDRFile(fn))
+    t = XDRFile(dfn)
+    assert len(t) == 9
+    assert list(t.index.steps) == [r[0] for r in ref]
+    check_frames(t, ref)
+    assert same_frame(t[6], ref[6])
+    x = np.concatenate([c.x for c in t.iter_chunks(4, reuse=False)])
+    assert np.array_equal(x, [r[3] for r in ref])
+
+
+@pytest.mark.parametrize('ft', ['xtc', 'trr'])
+def test_truncated_last_frame(tmpdir, ft):
+    fn = str(tmpdir.join('traj.' + ft))
+    write_traj(fn, 30, 18)
+    ref = read_all(XDRFile(fn))
+    data = open(fn, 'rb').read()
+    open(fn, 'wb').write(data[:-20])
+    t = XDRFile(fn)
+    assert len(t) == 17
+    assert same_frame(t[-1], ref[16])
+    assert same_frame(t[3], ref[3])
+    for chunksize in (5, 17, 100):
+        x = np.concatenate([c.x for c in t.iter_chunks(chunksize,
+                                                       reuse=False)])
+        assert np.array_equal(x, [r[3] for r in ref[:17]])
+    # without the index, the frames before the bad one are a short read
+    t.seek(15)
+    c = t.read_chunk(5)
+    assert (c.first, c.nframes, t.tell()) == (15, 2, 17)
+    assert np.array_equal(c.x, [r[3] for r in ref[15:17]])
+    assert t.read_chunk(5).nframes == 0
+
+
+def test_index_reuse_and_invalidation(tmpdir, monkeypatch):
+    fn = str(tmpdir.join('traj.xtc'))
+    write_traj(fn, 20, 12)
+    idx = frame_index(fn)
+    assert len(idx) == 12
+    assert os.path.isfile(index_filename(fn))
+
+    # a stored index that still matches the file is not scanned again
+    def no_scan(*args):
+        raise AssertionError('index scanned again')
+    monkeypatch.setattr(FrameIndex, 'scan', classmethod(no_scan))
+    assert np.array_equal(frame_index(fn).offsets, idx.offsets)
+    monkeypatch.undo()
+
+    # rewriting the file invalidates it
+    write_traj(fn, 20, 7, seed=1)
+    st = os.stat(fn)
+    os.utime(fn, (st.st_atime, st.st_mtime + 10))
+    assert len(frame_index(fn)) == 7
+    assert len(XDRFile(fn)) == 7
+    assert FrameIndex.load(index_filename(fn)).is_valid_for(fn)
+
+
+@pytest.mark.parametrize('mode', ['Std', 'NumPy'])
+def test_trr_velocities_and_forces(tmpdir, mode):
+    fn = str(tmpdir.join('vf.trr'))
+    x, v, f, has = write_trr_vf(fn, 15, 20)
+    vf = has == 7
+    t = XDRFile(fn, mode=mode, fields=('x', 'v', 'f'))
+    for i, fr in enumerate(t):
+        assert fr.has == has[i]
+        assert np.array_equal(fr.x, x[i])
+        if vf[i]:
+            assert np.array_equal(fr.v, v[i])
+            assert np.array_equal(fr.f, f[i])
+    assert i == 19
+    t.seek(0)
+    c = t.read_chunk(20)
+    assert np.array_equal(c.has, has)
+    assert np.array_equal(c.x, x)
+    assert np.array_equal(c.v[vf], v[vf])
+    assert np.array_equal(c.f[vf], f[vf])
+
+    # only the velocities: x and f are skipped in the file, not allocated
+    t = XDRFile(fn, mode=mode, fields=('v',))
+    fr = t[4]
+    assert fr.x is None
+    assert np.array_equal(fr.v, v[4])
+    for fr in t:
+        assert fr.x is None
+        if vf[fr.step]:
+            assert np.array_equal(fr.v, v[fr.step])
+    for c in t.iter_chunks(6):
+        assert c.x is None and c.f is None
+        m = vf[c.first:c.first + c.nframes]
+        assert np.array_equal(c.v[m], v[c.first:c.first + c.nframes][m])
+
+    sel = [3, 1, 15]
+    t = XDRFile(fn, mode=mode, fields=('v',), atoms=sel)
+    assert np.array_equal(t[7].v, v[7][[2, 0, 14]])
+    assert t[7].x is None
+    V = np.concatenate([c.v for c in t.iter_chunks(7, reuse=False)])
+    assert np.array_equal(V[vf], v[vf][:, [2, 0, 14]])
@@ -0,0 +1,73 @@
+"""Tests of reading trajectories split over several files with
+pmx.xtc.MultiTrajectory."""
+
+import numpy as np
+from pmx.xdrfile import XDRFile
+from pmx.xtc import MultiTrajectory
+
+NATOMS = 12
+
+
+def write_part(fn, steps, offset=0.):
+    # frames at time 0.5*step, with all the coordinates set to step + offset
+    # so that the file a frame was read from can be told
+    out = XDRFile(fn, mode='Out', ft='xtc', atomNum=NATOMS)
+    for step in steps:
+        x = np.full((NATOMS, 3), (step + offset)/100.)
+        out.write_xtc_frame(step=step, time=0.5*step, box=np.eye(3).tolist(),
+                            x=list(x.ravel()), units='nm')
+    out.close()
+
+
+def origin(x):
+    # offset of the file the frame was read from
+    return int(round(x[0, 0]*100. % 1 * 10))
+
+
+def com(chunk):
+    return chunk.first, chunk.x.mean(axis=1)
+
+
+def test_dedup_keeps_later_files(tmpdir):
+    # the second and third files continue from checkpoints at steps 8 and 5
+    fns = [str(tmpdir.join('p%d.xtc' % i)) for i in range(3)]
+    write_part(fns[0], range(0, 10), 0.1)
+    write_part(fns[1], range(8, 14), 0.2)
+    write_part(fns[2], range(5, 20), 0.3)
+    m = MultiTrajectory(fns)
+    assert list(m.steps) == list(range(20))
+    assert np.array_equal(m.times, 0.5*np.arange(20))
+    origins = [origin(np.array(f.x)) for f in m]
+    assert origins == [1]*5 + [3]*15
+    assert len(MultiTrajectory(fns, dedup=False)) == 10 + 6 + 15
+
+    # a file that starts before all the previous ones replaces them
+    write_part(fns[2], range(0, 3), 0.3)
+    m = MultiTrajectory(fns)
+    assert list(m.steps) == [0, 1, 2]
+    assert [origin(c.x[0]) for c in m.iter_chunks(2)] == [3, 3]
+
+
+def test_parts_opened_one_at_a_time(tmpdir):
+    fns = [str(tmpdir.join('p%02d.xtc' % i)) for i in range(20)]
+    for i, fn in enumerate(fns):
+        write_part(fn, range(5*i, 5*i + 6), 0.1)
+    m = MultiTrajectory(fns)
+    assert len(m) == 101
+    assert all(p is None for p in m.parts)
+    x = np.concatenate([c.x for c in m.iter_chunks(7)])
+    assert np.allclose(x[:, 0, 0], np.arange(101)/100. + 0.001)
+    assert sum(p is not None for p in m.parts) == 1
+    assert m[3].step == 3 and m[-1].step == 100
+    m.close()
+    assert all(p is None for p in m.parts)
+
+    ref = list(m.map_chunks(com, chunksize=9))
+    for nproc in (2, 3):
+        res = list(m.map_chunks(com, chunksize=9, nproc=nproc))
+        assert [r[0] for r in res] == [r[0] for r in ref]
+        assert np.array_equal(np.concatenate([r[1] for r in res]),
+                              np.concatenate([r[1] for r in ref]))
+    chunks = list(m.map_chunks(chunksize=9, nproc=2, start=10, stop=-10))
+    assert chunks[0].first == 10
+    assert sum(c.nframes for c in chunks) == 81